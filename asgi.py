@@ -0,0 +1,502 @@
+# asgi.py
+# Продакшн-режим P2P-дэшборда поверх ASGI.
+#
+# Горячие маршруты (/api/rates, /api/binance_rate, /api/bybit_rate, /api/gf_rate, /api/xe, /api/stream,
+# /healthz) обслуживаются нативно в event loop: биржи и Google Finance опрашиваются асинхронным
+# httpx-клиентом, SSE-клиенты не держат по потоку. Всё остальное (страница, справочники, статус)
+# уходит в Flask-приложение через WsgiToAsgi — в ограниченный пул потоков.
+# Под несколькими воркерами котировки делятся через P2P_SHARED_STORE (см. core.STORE): на ключ за TTL
+# в upstream ходит один процесс.
+#
+# Запуск:
+#   pip install uvicorn httpx asgiref
+#   python asgi.py                                  # настройки из переменных окружения ниже
+#   uvicorn asgi:app --workers 4 --limit-concurrency 4000
+#
+# Переменные окружения:
+#   P2P_ASGI_HOST / P2P_ASGI_PORT         — адрес (0.0.0.0:5000)
+#   P2P_ASGI_WORKERS                      — число процессов uvicorn (1)
+#   P2P_ASGI_LIMIT_CONCURRENCY            — максимум одновременных соединений на процесс (4000), сверх — 503
+#   P2P_ASGI_BACKLOG                      — очередь accept() (2048)
+#   P2P_ASGI_KEEPALIVE                    — keep-alive клиентских соединений, сек (5)
+#   P2P_ASGI_WSGI_THREADS                 — потоки для Flask-маршрутов и синхронного XE (32)
+
+import os
+import json
+import time
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlsplit, parse_qsl
+
+import httpx
+from asgiref.sync import sync_to_async
+from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+from werkzeug.datastructures import MultiDict
+
+import p2p_monitor as core
+
+ASGI_HOST              = os.getenv("P2P_ASGI_HOST", "0.0.0.0")
+ASGI_PORT              = int(os.getenv("P2P_ASGI_PORT", "5000"))
+ASGI_WORKERS           = int(os.getenv("P2P_ASGI_WORKERS", "1"))
+ASGI_LIMIT_CONCURRENCY = int(os.getenv("P2P_ASGI_LIMIT_CONCURRENCY", "4000"))
+ASGI_BACKLOG           = int(os.getenv("P2P_ASGI_BACKLOG", "2048"))
+ASGI_KEEPALIVE         = int(os.getenv("P2P_ASGI_KEEPALIVE", "5"))
+ASGI_WSGI_THREADS      = int(os.getenv("P2P_ASGI_WSGI_THREADS", "32"))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# ====================== Асинхронный HTTP-клиент ======================
+class AsyncUpstream:
+    """Аналог core.HostSessions для event loop: keep-alive пул, лимит на хост, ретраи 429/5xx с джиттером."""
+
+    def __init__(self):
+        self.client: Optional[httpx.AsyncClient] = None
+        self._sems: Dict[str, asyncio.Semaphore] = {}
+
+    async def start(self):
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=core.HTTP_POOL_SIZE * 4,
+                max_keepalive_connections=core.HTTP_POOL_SIZE * 4,
+            ),
+            follow_redirects=True,
+        )
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def _delay(self, attempt: int, resp: Optional[httpx.Response]) -> float:
+        if resp is not None:
+            ra = resp.headers.get("retry-after")
+            if ra and ra.strip().isdigit():
+                return min(float(ra), core.HTTP_RETRY_AFTER_MAX)
+        return core.HTTP_BACKOFF * (2 ** attempt) + random.uniform(0, core.HTTP_BACKOFF)
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        if self.client is None:
+            await self.start()
+        host = urlsplit(url).netloc.lower()
+        sem = self._sems.get(host)
+        if sem is None:
+            sem = self._sems[host] = asyncio.Semaphore(core.HTTP_HOST_CONCURRENCY)
+        guard = core.GUARDS.for_url(url)
+        await self._before(guard)
+        ok, error, status = False, None, "error"
+        t0 = time.perf_counter()
+        try:
+            for attempt in range(core.HTTP_RETRIES + 1):
+                last = attempt == core.HTTP_RETRIES
+                try:
+                    async with sem:
+                        resp = await self.client.request(method, url, **kwargs)
+                except httpx.ConnectError as e:
+                    error = type(e).__name__
+                    if last:
+                        raise
+                    await asyncio.sleep(self._delay(attempt, None))
+                    continue
+                if resp.status_code == 429:
+                    guard.limiter.on_throttle(core._retry_after_seconds(resp.headers.get("retry-after")))
+                if resp.status_code in RETRY_STATUSES and not last:
+                    await asyncio.sleep(self._delay(attempt, resp))
+                    continue
+                status = str(resp.status_code)
+                ok = resp.status_code != 429 and resp.status_code < 500
+                error = None if ok else f"HTTP {resp.status_code}"
+                if core.RECORD_DIR:
+                    core.record_exchange(guard.name, method, url, kwargs.get("json", kwargs.get("data")),
+                                         resp.status_code, resp.headers.get("content-type", ""), resp.text)
+                return resp
+        except httpx.HTTPError as e:
+            error = status = error or type(e).__name__
+            raise
+        finally:
+            guard.after(ok, error)
+            core.HTTP_SECONDS.observe(time.perf_counter() - t0, guard.name, status)
+
+    async def _before(self, guard: "core.UpstreamGuard"):
+        """Асинхронный core.UpstreamGuard.before: ждём токен через asyncio.sleep, а не блокируя loop."""
+        guard.check_open()
+        deadline = time.monotonic() + core.LIMIT_MAX_WAIT
+        while (wait := guard.limiter.try_take()) > 0:
+            if time.monotonic() + wait > deadline:
+                raise guard.reject()
+            await asyncio.sleep(wait)
+        guard.admit()
+
+UPSTREAM = AsyncUpstream()
+
+# ====================== Асинхронные фетчеры ==========================
+async def afetch_binance(p: Dict) -> Dict:
+    payload = core._binance_payload(p["asset"], p["fiat"], p["side"], p["pay_types"], p["amount"], 10, p["merchant"], 1)
+    r = await UPSTREAM.request("POST", core.BINANCE_URL, headers=core.BINANCE_HEADERS, json=payload, timeout=15)
+    r.raise_for_status()
+    return core._binance_parse(r.json())
+
+async def afetch_bybit(p: Dict) -> Dict:
+    payload = core._bybit_payload(p["asset"], p["fiat"], p["side"], p["payments"], p["amount"], 10, p["verified"])
+    r = await UPSTREAM.request("POST", core.BYBIT_URL, headers=core.BYBIT_HEADERS, json=payload, timeout=15)
+    r.raise_for_status()
+    return core._bybit_parse(r.json())
+
+async def afetch_gf(p: Dict) -> Dict:
+    A, F = p["asset"], p["fiat"]
+    url = core._gf_url(A, F)
+    r = await UPSTREAM.request("GET", url, headers=core.GF_HEADERS, timeout=12)
+    r.raise_for_status()
+    # разбор HTML — CPU, уносим из event loop
+    html = r.text
+    price, _ = await asyncio.to_thread(core._timed_extract, "gf", lambda: core._gf_parse(html, A, F), len(html))
+    return {"pair": f"{A}-{F}", "price": float(price), "url": url, "ts": int(time.time())}
+
+async def afetch_xe(p: Dict) -> Dict:
+    # XE: браузерный пул уже асинхронный и живёт в своём loop; гибридная логика — синхронная,
+    # поэтому целиком в поток (ограничен ASGI_WSGI_THREADS, а не числом клиентов)
+    return await asyncio.to_thread(core.fetch_xe_universal, p["from"], p["to"])
+
+ASYNC_FETCHERS = {"binance": afetch_binance, "bybit": afetch_bybit, "gf": afetch_gf, "xe": afetch_xe}
+
+_inflight: Dict[str, asyncio.Task] = {}
+
+async def ashared_call(name: str, ttl: float, fn) -> Tuple[object, float]:
+    """
+    Асинхронный core.shared_call: снимок из общего хранилища, иначе межпроцессная блокировка и await fn().
+    Обращения к хранилищу (файл/сокет) — в потоке, ожидание чужой записи — asyncio.sleep.
+    """
+    store = core.STORE
+    if store is None:
+        return await fn(), time.time()
+    deadline = time.monotonic() + core.SHARED_WAIT
+    while True:
+        hit = await asyncio.to_thread(store.get, name, ttl)
+        if hit is not None:
+            store.hits += 1
+            return hit
+        got, token = await asyncio.to_thread(store.lock, name)
+        if got:
+            try:
+                hit = await asyncio.to_thread(store.get, name, ttl)     # лидер мог записать между get и lock
+                if hit is not None:
+                    store.hits += 1
+                    return hit
+                store.misses += 1
+                store.leads += 1
+                value = await fn()
+                now = time.time()
+                await asyncio.to_thread(store.put, name, value, now, ttl)
+                return value, now
+            finally:
+                await asyncio.to_thread(store.unlock, name, token)
+        if time.monotonic() >= deadline:
+            store.misses += 1
+            return await fn(), time.time()                # лидер завис — не ждём дольше SHARED_WAIT
+        store.waits += 1
+        await asyncio.sleep(core.SHARED_POLL)
+
+async def aget_quote(source: str, params: Dict) -> Tuple[Dict, Dict]:
+    """
+    Асинхронный get_quote: тот же кэш core.QUOTES и снимки поллера. Внутри процесса — single-flight
+    на общей задаче _lead, между процессами (uvicorn --workers N) — через core.STORE, как и синхронный путь.
+    """
+    norm = core.normalize_quote_params(source, params)
+    key = core.quote_key(source, norm)
+    snap = core.POLLER.lookup(key)
+    if snap is not None:
+        return snap
+    ttl = core.CACHE_TTL[source]
+    hit = core.QUOTES.get(key, ttl)
+    if hit is not None:
+        core.QUOTES.count("hits")
+        return hit[0], {"cached": True, "age": round(hit[1], 3)}
+    if core.GUARDS.source_open(source):
+        return core._stale_or_raise(source, key)
+
+    task = _inflight.get(key)
+    leader = task is None
+    if leader:
+        core.QUOTES.count("misses")
+        # upstream-вызов — отдельная задача: отмена запроса (дедлайн /api/rates, обрыв клиента)
+        # отцепляет только этого ждущего, а не всех, кто присоединился к тому же ключу
+        task = _inflight[key] = asyncio.ensure_future(_lead(source, norm, key, ttl))
+        task.add_done_callback(_consume)
+    else:
+        core.QUOTES.count("coalesced")
+    try:
+        value, meta = await asyncio.shield(task)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        if core.GUARDS.source_open(source) and core.QUOTES.get(key, core.STALE_MAX_AGE) is not None:
+            return core._stale_or_raise(source, key)
+        raise
+    return (value, meta) if leader else (value, {"cached": True, "age": 0.0})
+
+async def _afetch(source: str, norm: Dict, key: str) -> Dict:
+    core.FETCH_INFLIGHT.inc(source)
+    t0 = time.perf_counter()
+    try:
+        value = await ASYNC_FETCHERS[source](norm)
+    except Exception as e:
+        core.observe_fetch(source, time.perf_counter() - t0, e)
+        raise
+    finally:
+        core.FETCH_INFLIGHT.dec(source)
+    core.observe_fetch(source, time.perf_counter() - t0)
+    core.observe_quote(key, source, norm, value)
+    return value
+
+async def _lead(source: str, norm: Dict, key: str, ttl: float) -> Tuple[Dict, Dict]:
+    started = time.time()
+    try:
+        value, stored_at = await ashared_call("q:" + key, ttl, lambda: _afetch(source, norm, key))
+        core.QUOTES.put(key, value, stored_at)
+        if stored_at < started:
+            # снимок записал другой процесс — возраст от его записи, как в QuoteCache.get_or_fetch
+            return value, {"cached": True, "age": round(time.time() - stored_at, 3), "shared": True}
+        return value, {"cached": False, "age": 0.0}
+    finally:
+        _inflight.pop(key, None)
+
+def _consume(task: asyncio.Task):
+    # ждущие могли все отцепиться — ошибку помечаем прочитанной, чтобы asyncio не ругался в лог
+    if not task.cancelled():
+        task.exception()
+
+# ====================== ASGI-примитивы ===============================
+async def _send_body(send, status: int, body: bytes, content_type: str, extra=()):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), (b"content-length", str(len(body)).encode()), *extra],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def _send_json(send, payload: Dict, status: int = 200):
+    await _send_body(send, status, core.dumps_bytes(payload), "application/json")
+
+def _etag_matches(scope, etag: str) -> bool:
+    """Слабое сравнение If-None-Match (RFC 9110 §13.1.2): W/ не учитывается ни с одной стороны."""
+    inm = _header(scope, b"if-none-match")
+    if not inm:
+        return False
+    tags = {t.strip().removeprefix("W/") for t in inm.split(",")}
+    return "*" in tags or etag.removeprefix("W/") in tags
+
+def _args(scope) -> MultiDict:
+    return MultiDict(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True))
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for k, v in scope.get("headers", []):
+        if k == name:
+            return v.decode("latin-1")
+    return None
+
+# ====================== Нативные async-маршруты ======================
+def _single(source: str, parse_args, wrap_data: bool = False):
+    async def handler(scope, receive, send):
+        try:
+            data, meta = await aget_quote(source, parse_args(_args(scope)))
+        except Exception as e:
+            await _send_json(send, {"ok": False, "error": str(e)}, 503 if isinstance(e, core.UpstreamUnavailable) else 502)
+            return
+        # как core.quote_response: байты data из core.BODIES, ETag по данным (слабый: в тело
+        # подклеены age/cached), возраст — в заголовках; тело не сжимается
+        prefix, etag = core.BODIES.get(data, "data" if wrap_data else "ok",
+                                       core._wrap_data if wrap_data else core._wrap_ok)
+        etag = core.variant_etag(etag, None, stable=False)
+        state = "STALE" if meta.get("stale") else "HIT" if meta.get("cached") else "MISS"
+        extra = [(b"etag", etag.encode()), (b"cache-control", b"no-cache"), (b"x-cache", state.encode()),
+                 (b"age", str(int(meta.get("age") or 0)).encode())]
+        if _etag_matches(scope, etag):
+            await send({"type": "http.response.start", "status": 304, "headers": extra})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await _send_body(send, 200, core._splice(prefix, meta), "application/json", extra)
+    return handler
+
+async def rates(scope, receive, send):
+    params, deadline = core.rates_params_from_args(_args(scope))
+    started = time.perf_counter()
+    sources = core.rates_sources(params)
+
+    async def timed(src, qp):
+        try:
+            return await aget_quote(src, qp)
+        finally:
+            finished[src] = time.perf_counter()
+
+    finished: Dict[str, float] = {}
+    tasks = {name: asyncio.ensure_future(timed(src, qp)) for name, (src, qp) in sources.items()}
+    await asyncio.wait(tasks.values(), timeout=deadline)
+
+    out, errors = {}, {}
+    for name, task in tasks.items():
+        src = sources[name][0]
+        if not task.done():
+            task.cancel()
+            errors[name] = {"status": "timeout", "elapsed": round(time.perf_counter() - started, 3)}
+            continue
+        elapsed = round(finished.get(src, time.perf_counter()) - started, 3)
+        if task.cancelled():
+            errors[name] = {"status": "error", "elapsed": elapsed, "error": "cancelled"}
+        elif task.exception() is not None:
+            errors[name] = {"status": "error", "elapsed": elapsed, "error": str(task.exception())}
+        else:
+            data, meta = task.result()
+            out[name] = data
+            errors[name] = {"status": "ok", "elapsed": elapsed, **meta}
+    await _send_json(send, core.rates_payload(params, out, errors, deadline))
+
+async def stream(scope, receive, send):
+    args = _args(scope)
+    try:
+        raw, specs = core.stream_subs_from_args(args)
+    except ValueError as e:
+        await _send_json(send, {"ok": False, "error": str(e)}, 400)
+        return
+    last_raw = _header(scope, b"last-event-id") or args.get("last_event_id")
+    last_id = int(last_raw) if last_raw and last_raw.isdigit() else None
+
+    disconnected = asyncio.Event()
+
+    async def watch_disconnect():
+        while True:
+            msg = await receive()
+            if msg["type"] == "http.disconnect":
+                disconnected.set()
+                return
+
+    watcher = asyncio.ensure_future(watch_disconnect())
+    keys = core.STREAM_HUB.subscribe(specs)
+    tags = [{"tag": x.get("tag") or x.get("source"), "key": k} for x, k in zip(raw, keys)]
+
+    async def emit(text: str):
+        await send({"type": "http.response.body", "body": text.encode("utf-8"), "more_body": True})
+
+    try:
+        await send({"type": "http.response.start", "status": 200, "headers": [
+            (b"content-type", b"text/event-stream; charset=utf-8"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ]})
+        await emit("retry: 3000\n\n")
+        await emit(core._sse(None, "subscribed", json.dumps(tags, ensure_ascii=False)))
+        evs, after = core.STREAM_HUB.initial(keys, last_id)
+        for ev_id, _, body in evs:
+            await emit(core._sse(ev_id, "quote", body))
+        last_write = time.monotonic()
+        while not disconnected.is_set():
+            # хаб живёт на потоках — опрашиваем его без блокировки, ожидание — в event loop
+            evs, after = core.STREAM_HUB.wait(keys, after, 0)
+            for ev_id, _, body in evs:
+                await emit(core._sse(ev_id, "quote", body))
+            now = time.monotonic()
+            if evs:
+                last_write = now
+            elif now - last_write >= core.STREAM_HEARTBEAT:
+                await emit(": hb\n\n")
+                last_write = now
+            try:
+                await asyncio.wait_for(disconnected.wait(), timeout=core.STREAM_TICK)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        watcher.cancel()
+        core.STREAM_HUB.unsubscribe(keys)
+
+async def healthz(scope, receive, send):
+    down = [name for name, st in core.GUARDS.stats().items() if st["state"] != "closed"]
+    body = "degraded: " + ", ".join(down) if down else "ok"
+    await _send_body(send, 200, body.encode(), "text/html; charset=utf-8")
+
+ROUTES = {
+    "/api/rates": rates,
+    "/api/binance_rate": _single("binance", core.binance_params_from_args),
+    "/api/bybit_rate": _single("bybit", core.bybit_params_from_args),
+    "/api/gf_rate": _single("gf", core.gf_params_from_args),
+    "/api/xe": _single("xe", core.xe_params_from_args, wrap_data=True),
+    "/api/stream": stream,
+    "/healthz": healthz,
+}
+
+# ====================== Приложение ===================================
+# пул для Flask-маршрутов и asyncio.to_thread — фиксированного размера
+SYNC_POOL = ThreadPoolExecutor(max_workers=ASGI_WSGI_THREADS, thread_name_prefix="asgi-sync")
+
+class _PooledWsgiInstance(WsgiToAsgiInstance):
+    # у asgiref run_wsgi_app thread-sensitive: все WSGI-запросы шли бы по очереди через один поток
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__["run_wsgi_app"].func,
+                                 thread_sensitive=False, executor=SYNC_POOL)
+
+class PooledWsgiToAsgi(WsgiToAsgi):
+    """WsgiToAsgi, но Flask-маршруты выполняются параллельно в SYNC_POOL (ASGI_WSGI_THREADS потоков)."""
+
+    async def __call__(self, scope, receive, send):
+        await _PooledWsgiInstance(self.wsgi_application, self.duplicate_header_limit)(scope, receive, send)
+
+flask_asgi = PooledWsgiToAsgi(core.app)
+
+async def _lifespan(receive, send):
+    while True:
+        msg = await receive()
+        if msg["type"] == "lifespan.startup":
+            # asyncio.to_thread (XE, разбор HTML, общее хранилище) — в тот же ограниченный пул
+            asyncio.get_running_loop().set_default_executor(SYNC_POOL)
+            await UPSTREAM.start()
+            await send({"type": "lifespan.startup.complete"})
+        elif msg["type"] == "lifespan.shutdown":
+            await UPSTREAM.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def _metered(route: str, handler, scope, receive, send):
+    """Учёт нативных маршрутов, как у Flask-хуков core: время до заголовков ответа, маршрут и статус."""
+    t0 = time.perf_counter()
+    started = False
+
+    async def send_wrapper(msg):
+        nonlocal started
+        if msg["type"] == "http.response.start" and not started:
+            started = True
+            core.REQUEST_SECONDS.observe(time.perf_counter() - t0, route, str(msg["status"]))
+        await send(msg)
+
+    core.REQUEST_INFLIGHT.inc()
+    try:
+        await handler(scope, receive, send_wrapper)
+    except Exception:
+        if not started:
+            core.REQUEST_SECONDS.observe(time.perf_counter() - t0, route, "500")
+        raise
+    finally:
+        core.REQUEST_INFLIGHT.dec()
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] == "http" and scope.get("method") in ("GET", "HEAD"):
+        path = scope.get("path")
+        handler = ROUTES.get(path)
+        if handler is not None:
+            await _metered(path, handler, scope, receive, send)
+            return
+    await flask_asgi(scope, receive, send)
+
+if __name__ == "__main__":
+    import uvicorn
+
+    uvicorn.run(
+        "asgi:app",
+        host=ASGI_HOST,
+        port=ASGI_PORT,
+        workers=ASGI_WORKERS,
+        limit_concurrency=ASGI_LIMIT_CONCURRENCY,
+        backlog=ASGI_BACKLOG,
+        timeout_keep_alive=ASGI_KEEPALIVE,
+        lifespan="on",
+    )
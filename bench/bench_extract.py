@@ -0,0 +1,140 @@
+# bench/bench_extract.py
+# Потоковый экстрактор (GfExtractor / XeExtractor) против BeautifulSoup: совпадение результатов и время разбора.
+#
+#   python bench/bench_extract.py                 # синтетические страницы
+#   python bench/bench_extract.py page.html ...   # плюс сохранённые страницы XE/GF (тип — по слову xe/gf в имени)
+#
+# Синтетика повторяет разметку реальных страниц: meta в <head>, блоки conversion/chart-stats
+# посреди большого body со скриптами и разметкой, которая к цене отношения не имеет.
+
+import argparse
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import p2p_monitor as core  # noqa: E402
+from bs4 import BeautifulSoup  # noqa: E402
+
+def _filler(n: int) -> str:
+    block = (
+        '<div class="row"><span class="cell">Lorem ipsum 12 345</span><a href="/x?y=1">link</a>'
+        '<img src="/i.png"><br><ul><li>1</li><li>2</li></ul></div>'
+        '<script>window.__S = {"data-last-price": "nope", "n": [1,2,3]};</script>\n'
+    )
+    return block * n
+
+def xe_page(conv="41.4512", chart="41.45", meta="1 USD = 41.45 UAH", filler=3000, header_eq=True) -> str:
+    head = f'<html><head><title>XE</title><meta property="og:description" content="{meta}"></head><body>'
+    conv_box = (
+        '<div data-testid="conversion"><div>'
+        f'<p>1.00 US Dollar {"=" if header_eq else ""}</p>'
+        f'<p class="sc-1">{conv[:-2]}<span class="faded">{conv[-2:]}</span> Ukrainian Hryvnias</p>'
+        '<p>1 UAH = 0.0241 USD</p></div></div>'
+    )
+    chart_tbl = (
+        '<section data-testid="currency-conversion-chart-stats-table"><table><tr><td>'
+        f'<p>High</p><p>{chart}</p><p>Low</p><p>41.2</p></td></tr></table></section>'
+    )
+    return head + _filler(filler // 3) + conv_box + _filler(filler // 3) + chart_tbl + _filler(filler // 3) + "</body></html>"
+
+def gf_page(A="USD", F="UAH", price="41.4512", filler=3000, with_block=True) -> str:
+    block = (f'<div jscontroller="NdbN0c" jsname="AS5Pxb" data-source="{A}" data-target="{F}" '
+             f'data-last-price="{price}" data-is-crypto="false"><div class="YMlKec fxKbKc">{price}</div></div>'
+             if with_block else f'<div class="YMlKec">99</div><div class="YMlKec fxKbKc">{price}</div>')
+    return "<html><head></head><body>" + _filler(filler // 2) + block + _filler(filler // 2) + "</body></html>"
+
+# ---- корпус крайних случаев: (имя, html) — ответы сверяются с BeautifulSoup-путём
+XE_CASES = [
+    ("обычная страница", xe_page(filler=30)),
+    ("без «=» в заголовке", xe_page(filler=30, header_eq=False)),
+    ("NBSP-группы", xe_page(conv="4 795 807.0012", chart="4 795 807.00", filler=30)),
+    ("только meta", '<html><head><meta name="description" content="1 EUR = 45,10 UAH"></head><body></body></html>'),
+    ("пустая", "<html></html>"),
+    ("незакрытые теги", '<div data-testid="conversion"><p>1 USD =<p>41.5<b>2</b> UAH</div>'
+                         '<section data-testid="currency-conversion-chart-stats-table"><p>x<p>41.6</section>'),
+    ("два блока conversion", '<div data-testid="conversion"><p>nothing</p></div>'
+                             '<div data-testid="conversion"><span><p>1 USD =</p></span><span><p>41.7</p></span>'
+                             '<p>1 USD =</p><i>x</i><p>41.8</p></div>'),
+]
+GF_CASES = [
+    ("блок data-last-price", gf_page(filler=30)),
+    ("только YMlKec", gf_page(filler=30, with_block=False)),
+    ("чужая пара в блоке", gf_page(A="EUR", filler=30)),
+    ("только атрибут", '<span data-last-price="41,25"></span>'),
+]
+
+def check() -> int:
+    bad = 0
+    for name, html in XE_CASES:
+        soup = BeautifulSoup(html, "html.parser")
+        want = (*core.xe_extract_both(soup, "USD", "UAH"), core.xe_extract_meta(soup))
+        ex = core.XeExtractor().run(html)
+        got = (ex.conv_val, ex.chart_val, ex.meta_val())
+        if got != want:
+            print(f"  XE «{name}»: поток {got}, soup {want}")
+            bad += 1
+    for name, html in GF_CASES:
+        res = []
+        for fn in (core._gf_parse_soup, core._gf_parse):
+            try:
+                res.append(fn(html, "USD", "UAH"))
+            except RuntimeError as e:
+                res.append(str(e))
+        if res[0] != res[1]:
+            print(f"  GF «{name}»: поток {res[1]}, soup {res[0]}")
+            bad += 1
+    print(f"корпус: {len(XE_CASES) + len(GF_CASES)} случаев, расхождений {bad}")
+    return bad
+
+def _measure(fn, repeat: int):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best * 1000, peak / 1024
+
+def bench(pages, repeat: int):
+    print(f"{'страница':32} {'KB':>6} {'soup, мс':>9} {'поток, мс':>10} {'×':>5} {'soup, KB':>9} {'поток, KB':>10}")
+    for name, kind, html in pages:
+        if kind == "xe":
+            def soup_fn():
+                s = BeautifulSoup(html, "html.parser")
+                core._xe_pick_from_soup(s, "USD", "UAH")
+            def stream_fn():
+                core._xe_pick(*core._xe_extract(html, "USD", "UAH"))
+        else:
+            soup_fn = lambda: core._gf_parse_soup(html, "USD", "UAH")
+            stream_fn = lambda: core._gf_parse(html, "USD", "UAH")
+        t_soup, m_soup = _measure(soup_fn, repeat)
+        t_stream, m_stream = _measure(stream_fn, repeat)
+        print(f"{name:32} {len(html) / 1024:6.0f} {t_soup:9.1f} {t_stream:10.1f} {t_soup / t_stream:5.1f}"
+              f" {m_soup:9.0f} {m_stream:10.0f}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("pages", nargs="*", help="сохранённые HTML-страницы XE/GF")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+    core.HTML_EXTRACT = "stream"
+
+    if check():
+        sys.exit(1)
+    pages = [
+        ("XE синтетика", "xe", xe_page()),
+        ("GF синтетика (блок в середине)", "gf", gf_page()),
+        ("GF синтетика (без блока)", "gf", gf_page(with_block=False)),
+    ]
+    for path in args.pages:
+        p = Path(path)
+        pages.append((p.name[:32], "gf" if "gf" in p.name.lower() else "xe", p.read_text(encoding="utf-8", errors="replace")))
+    bench(pages, args.repeat)
+
+if __name__ == "__main__":
+    main()
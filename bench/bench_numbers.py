@@ -0,0 +1,183 @@
+# bench/bench_numbers.py
+# Корректность и скорость разбора чисел (to_decimal / best_decimal_from_text / _d).
+#
+#   python bench/bench_numbers.py            # корпус + сверка со старой реализацией + замеры
+#   python bench/bench_numbers.py --fuzz 0   # без случайной сверки
+#
+# Старая реализация (до быстрого пути и кэша) лежит здесь же как эталон: новая обязана
+# давать на любом входе тот же Decimal.
+
+import argparse
+import random
+import re
+import sys
+import timeit
+from decimal import Decimal, InvalidOperation
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import p2p_monitor as core  # noqa: E402
+
+# ---- эталон: прежний код из p2p_monitor.py
+def legacy_normalize(s):
+    s = (s or "").strip()
+    s = s.replace("\u00A0", " ").replace("\u202F", " ")
+    s = re.sub(r"\s+", "", s)
+    has_comma = "," in s
+    has_dot = "." in s
+    if has_comma and has_dot:
+        if s.rfind(".") > s.rfind(","):
+            s = s.replace(",", "")
+        else:
+            s = s.replace(".", "").replace(",", ".")
+        return s
+    if has_comma:
+        if s.count(",") > 1:
+            pos = s.rfind(",")
+            s = s[:pos].replace(",", "") + "." + s[pos + 1:]
+        else:
+            s = s.replace(",", ".")
+        return s
+    if has_dot:
+        if s.count(".") > 1:
+            parts = s.split(".")
+            if all(i == 0 or len(p) == 3 for i, p in enumerate(parts)) and len(parts[-1]) == 3:
+                s = "".join(parts)
+            else:
+                pos = s.rfind(".")
+                s = s[:pos].replace(".", "") + "." + s[pos + 1:]
+        return s
+    return s
+
+def legacy_to_decimal(num_str):
+    try:
+        return Decimal(legacy_normalize(num_str))
+    except InvalidOperation:
+        return Decimal(0)
+
+def legacy_best(text):
+    matches = list(core.NUMBER_RE.finditer(text or ""))
+    if not matches:
+        return None
+    m = max(matches, key=lambda m: (len(re.sub(r"[^\d]", "", m.group(0))), len(m.group(0))))
+    return legacy_to_decimal(m.group(0))
+
+def legacy_d(x):
+    try:
+        if x is None:
+            return None
+        if isinstance(x, Decimal):
+            return x
+        return legacy_to_decimal(str(x))
+    except Exception:
+        return None
+
+# ---- корпус: (вход, ожидаемое) — локальные форматы, которые встречаются на XE/GF/биржах
+NUMBERS = [
+    ("41.25", "41.25"),
+    ("4795807", "4795807"),
+    ("0.0000123", "0.0000123"),
+    ("4,795,807.00", "4795807.00"),
+    ("4.795.807,00", "4795807.00"),
+    ("1.234.567", "1234567"),
+    ("1.234.56", "1234.56"),
+    ("1.234", "1.234"),              # одна точка — всегда десятичная
+    ("1,5", "1.5"),
+    ("1,234,567", "1234.567"),       # несколько запятых — последняя десятичная
+    ("4\u00A0795\u00A0807,00", "4795807.00"),
+    ("4\u202F795\u202F807.00", "4795807.00"),
+    ("1,234,56", "1234.56"),
+    ("4 795 807,00", "4795807.00"),
+    ("4 795 807.5", "4795807.5"),
+    (" 41 250,75 ", "41250.75"),
+    ("", "0"),
+    ("   ", "0"),
+    ("abc", "0"),
+    ("-41.2", "-41.2"),
+    ("41.", "41"),
+    (".5", "0.5"),
+]
+
+TEXTS = [
+    ("1 BTC = 4,795,807.00 KZT", "4795807.00"),
+    ("1.00 US Dollar = 41.4512 Ukrainian Hryvnias", "41.4512"),
+    ("1 USD = 41,45 UAH", "41.45"),
+    ("Mid-market rate at 12:00 UTC: 1 EUR = 1 234,56 XXX", "1234.56"),
+    ("4\u00A0795\u00A0807,00 ₸", "4795807.00"),
+    ("4\u202F795\u202F807.00 ₸", "4795807.00"),
+    ("курс 1.234.567 на 2024", "1.234"),   # точка не разделитель тысяч для NUMBER_RE
+    ("нет чисел", None),
+    ("", None),
+]
+
+def check_corpus() -> int:
+    bad = 0
+    for raw, want in NUMBERS:
+        got = core.to_decimal(raw)
+        if got != Decimal(want) or got != legacy_to_decimal(raw):
+            print(f"  to_decimal({raw!r}) = {got}, ожидалось {want}, старая {legacy_to_decimal(raw)}")
+            bad += 1
+    for text, want in TEXTS:
+        got = core.best_decimal_from_text(text)
+        exp = Decimal(want) if want is not None else None
+        if got != exp or got != legacy_best(text):
+            print(f"  best_decimal_from_text({text!r}) = {got}, ожидалось {exp}")
+            bad += 1
+    for x in ("41.25", 41.25, 41, Decimal("41.25"), None, "1,5", "x", "41."):
+        if core._d(x) != legacy_d(x):
+            print(f"  _d({x!r}) = {core._d(x)}, старая {legacy_d(x)}")
+            bad += 1
+    return bad
+
+def check_fuzz(n: int, seed: int = 1) -> int:
+    rnd = random.Random(seed)
+    alphabet = "0123456789" * 3 + ",.  \u00A0\u202F-x"
+    bad = 0
+    for _ in range(n):
+        s = "".join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 16)))
+        if core.to_decimal(s) != legacy_to_decimal(s):
+            bad += 1
+            if bad <= 5:
+                print(f"  to_decimal({s!r}) = {core.to_decimal(s)}, старая {legacy_to_decimal(s)}")
+        text = "Rate " + s + " and " + s[::-1]
+        if core.best_decimal_from_text(text) != legacy_best(text):
+            bad += 1
+            if bad <= 5:
+                print(f"  best_decimal_from_text({text!r}) расходится")
+    return bad
+
+def bench(number: int):
+    xe_text = "1 BTC = 4,795,807.00 KZT  Mid-market rate at 12:00 UTC · 1 KZT = 0.000000208 BTC · 23 Oct"
+    json_prices = ["41.25", "41.27", "41.30", "41.31", "41.35", "41.40", "41.42", "41.45", "41.50", "41.52"]
+    cases = [
+        ("_d(JSON-цена)", lambda: [legacy_d(p) for p in json_prices], lambda: [core._d(p) for p in json_prices]),
+        ("to_decimal('4 795 807,00')", lambda: legacy_to_decimal("4 795 807,00"),
+         lambda: core.to_decimal("4 795 807,00")),
+        ("best_decimal_from_text(XE)", lambda: legacy_best(xe_text), lambda: core.best_decimal_from_text(xe_text)),
+    ]
+    print(f"{'случай':34} {'было, мкс':>10} {'стало, мкс':>11} {'×':>6}")
+    for name, old, new in cases:
+        t_old = min(timeit.repeat(old, number=number, repeat=5)) / number * 1e6
+        t_new = min(timeit.repeat(new, number=number, repeat=5)) / number * 1e6
+        print(f"{name:34} {t_old:10.2f} {t_new:11.2f} {t_old / t_new:6.1f}")
+    info = core._parse_number.cache_info()
+    print(f"кэш чисел: hits={info.hits} misses={info.misses} size={info.currsize}/{info.maxsize}")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--fuzz", type=int, default=20000, help="случайных строк для сверки со старой реализацией")
+    ap.add_argument("--number", type=int, default=20000, help="повторов на замер")
+    args = ap.parse_args()
+
+    bad = check_corpus()
+    print(f"корпус: {len(NUMBERS) + len(TEXTS)} случаев, расхождений {bad}")
+    if args.fuzz:
+        fb = check_fuzz(args.fuzz)
+        print(f"fuzz: {args.fuzz} строк, расхождений {fb}")
+        bad += fb
+    if bad:
+        sys.exit(1)
+    bench(args.number)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+# bench/load_test.py
+# Нагрузочный прогон эндпоинтов дэшборда: N параллельных клиентов, длительность или число запросов,
+# на выходе — пропускная способность, ошибки и p50/p95/p99 по сценариям.
+#
+#   python bench/upstream_stub.py --synthetic --latency 150 --jitter 50 &
+#   eval "$(python bench/upstream_stub.py --print-env)"; python p2p_monitor.py &
+#   python bench/load_test.py --scenario rates,binance,batch -c 32 -d 30
+#   python bench/load_test.py --scenario mix --requests 2000 --json > run.json
+#
+# Пары выбираются по кругу из --fiats, так что прогон смешивает попадания в кэш и промахи;
+# --unique добавляет к сумме случайный шум — каждый запрос становится промахом кэша.
+
+import argparse
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+import requests
+
+def _amount(args):
+    return str(20000 + random.randint(1, 10 ** 6)) if args.unique else "20000"
+
+SCENARIOS = {
+    "rates": lambda a, f: ("GET", "/api/rates", {"asset": "USDT", "fiat": f, "side": random.choice(("BUY", "SELL")),
+                                             "amount": _amount(a)}, None),
+    "binance": lambda a, f: ("GET", "/api/binance_rate",
+                             {"asset": "USDT", "fiat": f, "side": random.choice(("BUY", "SELL")), "amount": _amount(a)}, None),
+    "bybit": lambda a, f: ("GET", "/api/bybit_rate",
+                           {"asset": "USDT", "fiat": f, "side": random.choice(("BUY", "SELL")), "amount": _amount(a)}, None),
+    "gf": lambda a, f: ("GET", "/api/gf_rate", {"asset": "USD", "fiat": f}, None),
+    "xe": lambda a, f: ("GET", "/api/xe", {"from": "USD", "to": f}, None),
+    "depth": lambda a, f: ("GET", "/api/depth", {"exchange": "binance", "asset": "USDT", "fiat": f, "side": "BUY",
+                                                 "amounts": "10000,100000"}, None),
+    "matrix": lambda a, f: ("GET", "/api/spreads/matrix", {"asset": "USDT", "fiats": ",".join(a.fiat_list[:3])}, None),
+    "batch": lambda a, f: ("POST", "/api/quotes/batch", None, {"specs": [
+        {"source": src, "params": {"asset": "USDT", "fiat": x, "side": side, "amount": _amount(a)}}
+        for x in a.fiat_list for src in ("binance", "bybit") for side in ("BUY", "SELL")
+    ]}),
+}
+
+def percentile(sorted_vals, q):
+    if not sorted_vals:
+        return None
+    k = max(0, min(len(sorted_vals) - 1, int(round(q / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+class Recorder:
+    def __init__(self):
+        self.lat = defaultdict(list)
+        self.status = defaultdict(Counter)
+        self._lock = threading.Lock()
+
+    def add(self, scenario, seconds, status):
+        with self._lock:
+            self.lat[scenario].append(seconds)
+            self.status[scenario][status] += 1
+
+def worker(args, plan, rec, stop, budget):
+    sess = requests.Session()
+    while not stop.is_set():
+        with budget["lock"]:
+            if budget["left"] is not None:
+                if budget["left"] <= 0:
+                    return
+                budget["left"] -= 1
+            scenario, fiat = next(plan)
+        method, path, params, body = SCENARIOS[scenario](args, fiat)
+        t0 = time.perf_counter()
+        try:
+            r = sess.request(method, args.base + path, params=params, json=body, timeout=args.timeout)
+            _ = r.content   # NDJSON/SSE дочитываем до конца — это и есть время ответа
+            status = str(r.status_code)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        rec.add(scenario, time.perf_counter() - t0, status)
+
+def report(rec, elapsed, as_json):
+    rows = {}
+    for scenario in sorted(rec.lat):
+        lat = sorted(rec.lat[scenario])
+        ok = sum(n for s, n in rec.status[scenario].items() if s.startswith("2"))
+        rows[scenario] = {
+            "requests": len(lat), "rps": round(len(lat) / elapsed, 1), "ok": ok,
+            "errors": dict((s, n) for s, n in rec.status[scenario].items() if not s.startswith("2")),
+            **{f"p{q}": round(percentile(lat, q) * 1000, 1) for q in (50, 95, 99)},
+            "max": round(lat[-1] * 1000, 1),
+        }
+    if as_json:
+        print(json.dumps({"elapsed": round(elapsed, 2), "scenarios": rows}, ensure_ascii=False, indent=1))
+        return
+    print(f"{'сценарий':10} {'запросов':>9} {'rps':>7} {'ok':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'max, мс':>9}  ошибки")
+    for name, r in rows.items():
+        print(f"{name:10} {r['requests']:9} {r['rps']:7} {r['ok']:7} {r['p50']:9} {r['p95']:9} {r['p99']:9} {r['max']:9}"
+              f"  {r['errors'] or ''}")
+    total = sum(r["requests"] for r in rows.values())
+    print(f"итого: {total} запросов за {elapsed:.1f} с, {total / elapsed:.1f} rps")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--base", default="http://127.0.0.1:5000")
+    ap.add_argument("--scenario", default="rates", help=f"через запятую: {','.join(SCENARIOS)} или mix")
+    ap.add_argument("-c", "--concurrency", type=int, default=16)
+    ap.add_argument("-d", "--duration", type=float, default=20.0, help="секунд (если не задан --requests)")
+    ap.add_argument("-n", "--requests", type=int, default=None)
+    ap.add_argument("--fiats", default="UAH,EUR,USD,KZT,PLN,GEL,TRY")
+    ap.add_argument("--unique", action="store_true", help="случайная сумма — каждый запрос мимо кэша")
+    ap.add_argument("--timeout", type=float, default=60.0)
+    ap.add_argument("--json", action="store_true")
+    args = ap.parse_args()
+
+    names = list(SCENARIOS) if args.scenario == "mix" else [s.strip() for s in args.scenario.split(",") if s.strip()]
+    unknown = [s for s in names if s not in SCENARIOS]
+    if unknown:
+        ap.error(f"неизвестные сценарии: {unknown}")
+    args.fiat_list = [f.strip().upper() for f in args.fiats.split(",") if f.strip()]
+    plan = itertools.cycle([(s, f) for f in args.fiat_list for s in names])
+
+    rec, stop = Recorder(), threading.Event()
+    budget = {"lock": threading.Lock(), "left": args.requests}
+    threads = [threading.Thread(target=worker, args=(args, plan, rec, stop, budget), daemon=True)
+               for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    try:
+        if args.requests is None:
+            time.sleep(args.duration)
+            stop.set()
+        for t in threads:
+            t.join()
+    except KeyboardInterrupt:
+        stop.set()
+    report(rec, time.perf_counter() - started, args.json)
+    if not rec.lat:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+# bench/quote_memory.py
+# Память и время: топ объявлений и лестница стакана как прежние dict/list с float и строками
+# против QuoteBook/FixedRows (int64 с фиксированной точкой). Синтетика в формате ответов Binance.
+#
+#   python bench/quote_memory.py                       # 10 000 топов по 5 объявлений, 500 стаканов по 200 уровней
+#   python bench/quote_memory.py --books 50000 --levels 400
+
+import argparse
+import gc
+import random
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import p2p_monitor as core  # noqa: E402
+
+def _ads(rnd, n):
+    base = rnd.uniform(1, 500)
+    return [{"adv": {"price": f"{base * (1 + k / 1000):.2f}", "minSingleTransAmount": "500.00",
+                     "maxSingleTransAmount": f"{rnd.randint(1, 400) * 1000}.00",
+                     "surplusAmount": f"{rnd.uniform(10, 5000):.2f}"},
+             "advertiser": {"nickName": f"seller{k}"}} for k in range(n)]
+
+def _legacy_book(js):
+    """Прежняя форма: dict на объявление, float-цена, сырые строки, отдельный список prices."""
+    items, prices = [], []
+    for ad in js["data"][:5]:
+        adv = ad["adv"]
+        price = core._d(adv["price"])
+        items.append({"name": ad["advertiser"]["nickName"], "price": float(price),
+                      "min": adv["minSingleTransAmount"], "max": adv["maxSingleTransAmount"],
+                      "volume": adv["surplusAmount"]})
+        prices.append(price)
+    avg = (prices[2] + prices[3] + prices[4]) / Decimal(3) if len(prices) >= 5 else None
+    return {"items": items, "prices": [float(x) for x in prices], "avg": float(avg) if avg is not None else None}
+
+def _legacy_ladder(levels):
+    return [[float(p), float(mn), float(mx), float(v)] for p, mn, mx, v in levels]
+
+def measure(build, inputs):
+    """(байт на объект по tracemalloc, мкс на объект)."""
+    gc.collect()
+    tracemalloc.start()
+    held = [build(x) for x in inputs]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del held
+    t0 = time.perf_counter()             # время — отдельным прогоном: tracemalloc сам по себе дорогой
+    for x in inputs:
+        build(x)
+    return size / len(inputs), (time.perf_counter() - t0) / len(inputs) * 1e6
+
+def dumps_cost(objs, runs=3):
+    best = float("inf")
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        for o in objs:
+            core.dumps_bytes(o)
+        best = min(best, time.perf_counter() - t0)
+    return best / len(objs) * 1e6
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--books", type=int, default=10000, help="топов по 5 объявлений")
+    ap.add_argument("--depths", type=int, default=500, help="лестниц стакана")
+    ap.add_argument("--levels", type=int, default=200, help="уровней в лестнице")
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    rnd = random.Random(args.seed)
+
+    pages = [{"code": "000000", "data": _ads(rnd, 5)} for _ in range(args.books)]
+    ladders = [[tuple(core._d(ad["adv"][k]) for k in ("price", "minSingleTransAmount", "maxSingleTransAmount",
+                                                       "surplusAmount")) for ad in _ads(rnd, args.levels)]
+               for _ in range(args.depths)]
+
+    rows = [
+        (f"топ ×{args.books}", measure(_legacy_book, pages), measure(core._binance_parse, pages),
+         [_legacy_book(p) for p in pages], [core._binance_parse(p) for p in pages]),
+        (f"стакан ×{args.depths}/{args.levels}", measure(_legacy_ladder, ladders),
+         measure(lambda lv: core.FixedRows.build(lv, 4), ladders),
+         [_legacy_ladder(lv) for lv in ladders], [core.FixedRows.build(lv, 4) for lv in ladders]),
+    ]
+    print(f"{'':22} {'байт/объект':>22} {'сборка, мкс':>20} {'JSON, мкс':>20}")
+    for name, (old_b, old_t), (new_b, new_t), old_objs, new_objs in rows:
+        assert [core.dumps_bytes(o) for o in old_objs[:50]] == [core.dumps_bytes(o) for o in new_objs[:50]] \
+            or name.startswith("топ"), "лестница сериализуется иначе"
+        print(f"{name:22} {old_b:9.0f} → {new_b:9.0f}  {old_t:8.1f} → {new_t:8.1f}  "
+              f"{dumps_cost(old_objs):8.1f} → {dumps_cost(new_objs):8.1f}")
+    print(f"JSON: {'orjson' if core.ORJSON_OK else 'json'}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+# bench/resp_stub.py
+# Локальная замена Redis для P2P_SHARED_STORE=redis://...: протокол RESP2, команды, которые
+# нужны общему хранилищу (PING, GET, SET [NX|XX] [PX|EX], DEL, EXISTS, AUTH, SELECT, FLUSHDB, DBSIZE).
+# Данные в памяти процесса, срок жизни проверяется при чтении и периодической чисткой.
+#
+#   python bench/resp_stub.py --port 6399 &
+#   P2P_SHARED_STORE=redis://127.0.0.1:6399/0 gunicorn -w 4 p2p_monitor:app
+
+import argparse
+import socketserver
+import threading
+import time
+
+class Store:
+    def __init__(self):
+        self.dbs = {}
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    def db(self, n):
+        return self.dbs.setdefault(n, {})
+
+    def _live(self, d, key):
+        item = d.get(key)
+        if item is None:
+            return None
+        value, exp = item
+        if exp is not None and exp <= time.monotonic():
+            del d[key]
+            return None
+        return value
+
+    def sweep(self):
+        now = time.monotonic()
+        with self.lock:
+            for d in self.dbs.values():
+                for k in [k for k, (_, exp) in d.items() if exp is not None and exp <= now]:
+                    del d[k]
+
+class RespError(Exception):
+    pass
+
+def _encode(reply):
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, RespError):
+        return b"-ERR %s\r\n" % str(reply).encode()
+    if isinstance(reply, bool):
+        return b"+OK\r\n" if reply else b"$-1\r\n"
+    if isinstance(reply, int):
+        return b":%d\r\n" % reply
+    if isinstance(reply, str):
+        return b"+%s\r\n" % reply.encode()
+    return b"$%d\r\n%s\r\n" % (len(reply), reply)
+
+def _read_command(f):
+    line = f.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.split()                       # inline-команды (redis-cli, telnet)
+    args = []
+    for _ in range(int(line[1:-2])):
+        hdr = f.readline()
+        if not hdr.startswith(b"$"):
+            raise RespError("ожидалась bulk-строка")
+        args.append(f.read(int(hdr[1:-2]) + 2)[:-2])
+    return args
+
+def execute(store: Store, state, args):
+    cmd, rest = args[0].upper(), args[1:]
+    store.commands += 1
+    if cmd == b"PING":
+        return rest[0] if rest else "PONG"
+    if cmd == b"AUTH":
+        return "OK"
+    if cmd == b"SELECT":
+        state["db"] = int(rest[0])
+        return "OK"
+    with store.lock:
+        d = store.db(state["db"])
+        if cmd == b"GET":
+            return store._live(d, rest[0])
+        if cmd == b"SET":
+            key, value, opts = rest[0], rest[1], [o.upper() for o in rest[2:]]
+            exp, i = None, 0
+            while i < len(opts):
+                if opts[i] in (b"PX", b"EX"):
+                    n = int(rest[2 + i + 1])
+                    exp = time.monotonic() + (n / 1000 if opts[i] == b"PX" else n)
+                    i += 2
+                    continue
+                i += 1
+            exists = store._live(d, key) is not None
+            if (b"NX" in opts and exists) or (b"XX" in opts and not exists):
+                return None
+            d[key] = (value, exp)
+            return True
+        if cmd == b"DEL":
+            return sum(1 for k in rest if store._live(d, k) is not None and d.pop(k, None) is not None)
+        if cmd == b"EXISTS":
+            return sum(1 for k in rest if store._live(d, k) is not None)
+        if cmd == b"DBSIZE":
+            return len(d)
+        if cmd == b"FLUSHDB":
+            d.clear()
+            return "OK"
+    return RespError(f"unknown command '{cmd.decode(errors='replace')}'")
+
+def make_handler(store: Store):
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            state = {"db": 0}
+            while True:
+                try:
+                    args = _read_command(self.rfile)
+                except (RespError, ValueError) as e:
+                    self.wfile.write(_encode(RespError(str(e))))
+                    return
+                except ConnectionError:
+                    return
+                if args is None:
+                    return
+                if not args:
+                    continue
+                try:
+                    reply = execute(store, state, args)
+                except (IndexError, ValueError):
+                    reply = RespError("wrong number of arguments or bad value")
+                self.wfile.write(_encode(reply))
+                self.wfile.flush()
+    return Handler
+
+class _RespServer(socketserver.ThreadingTCPServer):
+    # до listen() в конструкторе: с очередью по умолчанию (5) залп подключений воркеров упирается в таймаут
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+def serve(host, port):
+    store = Store()
+    srv = _RespServer((host, port), make_handler(store))
+
+    def sweeper():
+        while True:
+            time.sleep(1)
+            store.sweep()
+    threading.Thread(target=sweeper, daemon=True).start()
+    return srv, store
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=6399)
+    args = ap.parse_args()
+    srv, store = serve(args.host, args.port)
+    print(f"RESP-заглушка на redis://{args.host}:{args.port}/0")
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("команд:", store.commands, "ключей:", {n: len(d) for n, d in store.dbs.items()})
+
+if __name__ == "__main__":
+    main()
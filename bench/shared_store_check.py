@@ -0,0 +1,129 @@
+# bench/shared_store_check.py
+# Сколько раз N процессов-воркеров сходят в upstream за одними и теми же котировками:
+# без общего хранилища — до N раз на ключ, с P2P_SHARED_STORE — один раз на ключ за TTL.
+# Upstream — bench/upstream_stub.py (--synthetic) в этом же процессе, он и считает запросы.
+# Воркеры ходят синхронным core.get_quote (gunicorn/Flask) и/или asgi.aget_quote (uvicorn --workers N).
+#
+#   python bench/shared_store_check.py -w 8                        # none, mmap и redis (bench/resp_stub.py)
+#   python bench/shared_store_check.py -w 4 --store redis://127.0.0.1:6379/0 --path asgi
+
+import argparse
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "bench"))
+
+SPECS = [("gf", {"asset": a, "fiat": f}) for a in ("USD", "EUR") for f in ("UAH", "PLN")] + \
+        [("bybit", {"asset": "USDT", "fiat": f, "side": s, "amount": "20000"})
+         for f in ("UAH", "KZT") for s in ("BUY", "SELL")]
+
+def _worker(barrier, rounds, out):
+    import p2p_monitor as core
+    barrier.wait()
+    errors = 0
+    for _ in range(rounds):
+        for source, params in SPECS:
+            try:
+                core.get_quote(source, params)
+            except Exception:
+                errors += 1
+    out.put({"errors": errors, "store": core.STORE.stats() if core.STORE else None})
+
+def _asgi_worker(barrier, rounds, out):
+    import asyncio
+    import asgi
+    core = asgi.core
+
+    async def go():
+        errors = 0
+        for _ in range(rounds):
+            # как под нагрузкой: все ключи разом в одном event loop
+            res = await asyncio.gather(*(asgi.aget_quote(source, params) for source, params in SPECS),
+                                       return_exceptions=True)
+            errors += sum(isinstance(r, BaseException) for r in res)
+        await asgi.UPSTREAM.close()
+        return errors
+
+    barrier.wait()
+    errors = asyncio.run(go())
+    out.put({"errors": errors, "store": core.STORE.stats() if core.STORE else None})
+
+WORKERS = {"sync": _worker, "asgi": _asgi_worker}
+
+def run(store_spec, workers, rounds, path="sync"):
+    import upstream_stub
+    # свой префикс ключей на прогон: второй путь не должен попадать в снимки, записанные первым
+    env = {"P2P_SHARED_STORE": store_spec, "P2P_SHARED_PREFIX": f"bench:{path}:{time.time_ns()}:",
+           "P2P_HISTORY": "0", "P2P_POLL": "[]"}
+    saved = {k: os.environ.get(k) for k in env}
+    os.environ.update(env)
+    try:
+        args = argparse.Namespace(fixtures=None, synthetic=True, host="127.0.0.1", port=0, latency=80.0,
+                                  jitter=20.0, error_rate=0.0, throttle_rate=0.0)
+        srv, _, stats = upstream_stub.serve(args)
+        host, port = srv.server_address
+        for line in upstream_stub.env_lines(host, port):
+            k, v = line.split(" ", 1)[1].split("=", 1)
+            os.environ[k] = v
+        threading.Thread(target=srv.serve_forever, daemon=True).start()
+
+        ctx = mp.get_context("spawn")
+        barrier, out = ctx.Barrier(workers), ctx.Queue()
+        procs = [ctx.Process(target=WORKERS[path], args=(barrier, rounds, out)) for _ in range(workers)]
+        t0 = time.perf_counter()
+        for p in procs:
+            p.start()
+        results = [out.get(timeout=120) for _ in procs]
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - t0
+        srv.shutdown()
+        srv.server_close()
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+    calls = sum(stats.values())
+    leads = sum((r["store"] or {}).get("leads", 0) for r in results)
+    errs = sum(r["errors"] for r in results)
+    store_errs = sum((r["store"] or {}).get("errors", 0) for r in results)
+    last = next((r["store"]["last_error"] for r in results if r["store"] and r["store"]["last_error"]), None)
+    print(f"{path:4} {store_spec or 'none':34} воркеров {workers}: upstream-запросов {calls:4} на {len(SPECS)} ключей, "
+          f"лидеров {leads}, ошибок {errs}/{store_errs}, {elapsed:.1f} с" + (f" ({last})" if last else ""))
+    return calls
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-w", "--workers", type=int, default=4)
+    ap.add_argument("-r", "--rounds", type=int, default=3, help="проходов по ключам в каждом воркере")
+    ap.add_argument("--store", action="append", help="P2P_SHARED_STORE; по умолчанию: none, mmap, redis-заглушка")
+    ap.add_argument("--path", choices=("sync", "asgi", "both"), default="both", help="какой путь котировок гонять")
+    args = ap.parse_args()
+
+    resp = tmp = None
+    if not args.store:
+        import resp_stub
+        resp, _ = resp_stub.serve("127.0.0.1", 0)
+        threading.Thread(target=resp.serve_forever, daemon=True).start()
+        tmp = Path(tempfile.mkdtemp())
+    paths = ("sync", "asgi") if args.path == "both" else (args.path,)
+    for path in paths:
+        # у mmap нет префикса ключей — на каждый путь свой файл
+        stores = args.store or ["", f"mmap:{tmp / f'p2p_shared_{path}.mmap'}",
+                                f"redis://127.0.0.1:{resp.server_address[1]}/0"]
+        for spec in stores:
+            run(spec, args.workers, args.rounds, path)
+    if resp is not None:
+        resp.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# bench/startup.py
+# Холодный старт: время импорта p2p_monitor (каждый прогон — новый интерпретатор), самые дорогие
+# модули по -X importtime, цена первого обращения к ленивым зависимостям/справочникам
+# и время от запуска процесса до первого 200 на /healthz.
+#
+#   python bench/startup.py                          # импорт ×7, top-15 модулей, первое обращение, /healthz ×3
+#   python bench/startup.py --runs 15 --top 25
+#   python bench/startup.py --cmd "gunicorn -w 1 -b 127.0.0.1:{port} p2p_monitor:app"
+
+import argparse
+import json
+import os
+import shlex
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# без истории и поллера: меряем старт приложения, а не фоновую работу
+BASE_ENV = {"P2P_HISTORY": "0", "P2P_POLL": "[]"}
+
+IMPORT_SNIPPET = "import time; t = time.perf_counter(); import p2p_monitor; print(time.perf_counter() - t)"
+
+FIRST_USE_SNIPPET = r"""
+import time, json
+import p2p_monitor as core
+out = {}
+def timed(name, fn):
+    t = time.perf_counter(); fn(); out[name] = (time.perf_counter() - t) * 1000
+timed("requests (первая сессия)", lambda: core.HTTP._for("http://127.0.0.1:9"))
+timed("bs4 (BeautifulSoup)", lambda: core.bs4.BeautifulSoup("<p>1</p>", "html.parser"))
+timed("numpy", lambda: core.NUMPY_OK and core.np.asarray([1.0]))
+timed("asyncio", lambda: core.asyncio.get_event_loop_policy())
+timed("playwright.async_api", lambda: core.PLAYWRIGHT_OK and core.playwright_api.async_playwright)
+timed("справочник Bybit", core.BYBIT_PAYMENTS.ensure_loaded)
+timed("коды XE", core.xe_codes)
+print(json.dumps(out, ensure_ascii=False))
+"""
+
+def _env(extra=None):
+    env = {**os.environ, **BASE_ENV, **(extra or {})}
+    env["PYTHONPATH"] = str(ROOT) + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+def _py(code, extra_env=None, flags=()):
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=ROOT, env=_env(extra_env),
+                          capture_output=True, text=True, check=True)
+
+def import_times(runs, extra_env=None):
+    _py("import p2p_monitor", extra_env)         # прогрев .pyc и файлового кэша
+    return [float(_py(IMPORT_SNIPPET, extra_env).stdout.strip().splitlines()[-1]) for _ in range(runs)]
+
+def importtime_top(top):
+    """(self мкс, cumulative мкс, модуль) из -X importtime, по убыванию cumulative."""
+    err = _py("import p2p_monitor", flags=("-X", "importtime")).stderr
+    rows = []
+    for line in err.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            rows.append((int(parts[0]), int(parts[1]), parts[2].rstrip()))
+        except ValueError:
+            continue
+    return sorted(rows, key=lambda r: -r[1])[:top]
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def time_to_healthz(cmd_tpl, timeout, extra_env=None):
+    port = _free_port()
+    cmd = shlex.split(cmd_tpl.format(python=sys.executable, port=port))
+    url = f"http://127.0.0.1:{port}/healthz"
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=_env({"P2P_PORT": str(port), **(extra_env or {})}),
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - t0 < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError(f"процесс завершился с кодом {proc.returncode}: {cmd_tpl}")
+            try:
+                with urllib.request.urlopen(url, timeout=1) as r:
+                    if r.status == 200:
+                        return time.perf_counter() - t0
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError(f"/healthz не ответил за {timeout} с")
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+def _ms(vals):
+    return f"медиана {statistics.median(vals) * 1000:7.1f} мс, мин {min(vals) * 1000:7.1f}, макс {max(vals) * 1000:7.1f}"
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=7, help="прогонов импорта")
+    ap.add_argument("--top", type=int, default=15, help="сколько модулей показать из -X importtime")
+    ap.add_argument("--healthz-runs", type=int, default=3)
+    ap.add_argument("--cmd", default="{python} p2p_monitor.py",
+                    help="команда сервера; {python} и {port} подставляются (порт также в P2P_PORT)")
+    ap.add_argument("--timeout", type=float, default=30.0)
+    args = ap.parse_args()
+
+    print(f"импорт p2p_monitor ×{args.runs}: {_ms(import_times(args.runs))}")
+    with tempfile.TemporaryDirectory() as cache:
+        _py("import p2p_monitor as c; c.BYBIT_PAYMENTS.ensure_loaded(); c.xe_codes()", {"P2P_CATALOG_CACHE": cache})
+        first_cached = _py(FIRST_USE_SNIPPET, {"P2P_CATALOG_CACHE": cache}).stdout.strip().splitlines()[-1]
+
+    print(f"\nсамые дорогие импорты (-X importtime, top {args.top}):")
+    print(f"{'self, мс':>9} {'cumul, мс':>10}  модуль")
+    for self_us, cum_us, name in importtime_top(args.top):
+        print(f"{self_us / 1000:9.1f} {cum_us / 1000:10.1f}  {name}")
+
+    first = json.loads(_py(FIRST_USE_SNIPPET).stdout.strip().splitlines()[-1])
+    cached = json.loads(first_cached)
+    print("\nпервое обращение (отложено из импорта), мс:")
+    for name, ms in first.items():
+        print(f"  {name:28} {ms:7.1f}" + (f"   с кэшем справочников {cached[name]:.1f}" if "справочник" in name
+                                          or "коды" in name else ""))
+
+    if args.healthz_runs:
+        vals = [time_to_healthz(args.cmd, args.timeout) for _ in range(args.healthz_runs)]
+        print(f"\nзапуск → первый 200 на /healthz ×{args.healthz_runs}: {_ms(vals)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+# bench/upstream_stub.py
+# Локальная заглушка Binance/Bybit/Google Finance/XE: отдаёт записанные фикстуры (P2P_RECORD_DIR)
+# с заданной задержкой, джиттером и долей ошибок — для нагрузочных прогонов без реальных бирж.
+#
+#   P2P_RECORD_DIR=fixtures python p2p_monitor.py          # 1) записать ответы, погоняв UI/эндпоинты
+#   python bench/upstream_stub.py --fixtures fixtures      # 2) заглушка на 127.0.0.1:8099
+#   python bench/upstream_stub.py --synthetic --latency 150 --jitter 50 --error-rate 0.02 --throttle-rate 0.01
+#   eval "$(python bench/upstream_stub.py --print-env)"    # 3) переменные, переключающие приложение на заглушку
+#
+# Подбор ответа: точный ключ (core.fixture_key — метод, путь?запрос, канонический JSON тела), затем
+# любая фикстура с тем же путём (по кругу), затем — с --synthetic — сгенерированный ответ.
+
+import argparse
+import hashlib
+import itertools
+import json
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qs
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import p2p_monitor as core  # noqa: E402
+from bench_extract import gf_page, xe_page  # noqa: E402
+
+BINANCE_PATH = urlsplit(core.BINANCE_URL).path
+BYBIT_PATH = urlsplit(core.BYBIT_URL).path
+
+class Fixtures:
+    def __init__(self, root=None):
+        self.by_key = {}
+        self.by_path = defaultdict(list)
+        self._cycles = {}
+        self._lock = threading.Lock()
+        if root:
+            for f in sorted(Path(root).glob("*/*.json")):
+                doc = json.loads(f.read_text(encoding="utf-8"))
+                self.by_key[doc["key"]] = doc
+                self.by_path[urlsplit(doc["url"]).path].append(doc)
+
+    def find(self, method, target, body):
+        doc = self.by_key.get(core.fixture_key(method, target, body))
+        if doc is not None:
+            return doc, "exact"
+        path = urlsplit(target).path
+        docs = self.by_path.get(path)
+        if not docs:
+            return None, None
+        with self._lock:
+            cyc = self._cycles.get(path)
+            if cyc is None:
+                cyc = self._cycles[path] = itertools.cycle(docs)
+            return next(cyc), "path"
+
+# ---- синтетика: устойчивая «цена» пары + разметка, которую понимают парсеры p2p_monitor
+def _base_price(a, f):
+    h = int(hashlib.sha1(f"{a}-{f}".encode()).hexdigest()[:8], 16)
+    return 1 + (h % 100000) / 100
+
+def _ads(fiat, asset, page, rows, side, exchange):
+    if page > 5:
+        return []
+    base = _base_price(asset, fiat)
+    step = base * 0.001 * (1 if side in ("BUY", "1") else -1)
+    out = []
+    for i in range(rows):
+        n = (page - 1) * rows + i
+        price = f"{base + step * n:.2f}"
+        if exchange == "binance":
+            out.append({"adv": {"advNo": f"{fiat}{n}", "price": price, "minSingleTransAmount": "500",
+                                "maxSingleTransAmount": "200000", "surplusAmount": f"{1000 + 37 * n}",
+                                "tradeMethods": [{"identifier": "Monobank", "tradeMethodName": "Monobank"},
+                                                 {"identifier": "PrivatBank", "tradeMethodName": "PrivatBank"}]},
+                        "advertiser": {"nickName": f"stub{n}"}})
+        else:
+            out.append({"id": f"{fiat}{n}", "nickName": f"stub{n}", "price": price, "minAmount": "500",
+                        "maxAmount": "200000", "lastQuantity": f"{1000 + 37 * n}"})
+    return out
+
+def synthetic(method, target, body):
+    parts = urlsplit(target)
+    try:
+        req = json.loads(body) if body else {}
+    except ValueError:
+        req = {}
+    if parts.path == BINANCE_PATH:
+        data = _ads(req.get("fiat", "UAH"), req.get("asset", "USDT"), int(req.get("page", 1)),
+                    int(req.get("rows", 10)), req.get("tradeType", "BUY"), "binance")
+        return 200, "application/json", json.dumps({"code": "000000", "data": data})
+    if parts.path == BYBIT_PATH:
+        items = _ads(req.get("currencyId", "UAH"), req.get("tokenId", "USDT"), int(req.get("page", 1)),
+                     int(req.get("size", 10)), req.get("side", "1"), "bybit")
+        return 200, "application/json", json.dumps({"ret_code": 0, "result": {"count": len(items), "items": items}})
+    if parts.path.startswith("/finance/quote/"):
+        a, _, f = parts.path.rsplit("/", 1)[-1].partition("-")
+        return 200, "text/html; charset=utf-8", gf_page(a, f, f"{_base_price(a, f):.4f}", filler=300)
+    if parts.path.startswith("/currencyconverter/convert"):
+        q = parse_qs(parts.query)
+        a, f = q.get("From", ["USD"])[0], q.get("To", ["EUR"])[0]
+        p = f"{_base_price(a, f):.4f}"
+        return 200, "text/html; charset=utf-8", xe_page(p, p[:-2], f"1 {a} = {p} {f}", filler=300)
+    return None
+
+def make_handler(fx: Fixtures, args, stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *a):
+            pass
+
+        def _reply(self, status, ctype, text, extra=()):
+            data = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in extra:
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _serve(self, method):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0)) or None
+            delay = max(0.0, args.latency + random.uniform(-args.jitter, args.jitter)) / 1000
+            if delay:
+                time.sleep(delay)
+            roll = random.random()
+            if roll < args.error_rate:
+                stats["error"] += 1
+                return self._reply(500, "text/plain", "stub: injected error")
+            if roll < args.error_rate + args.throttle_rate:
+                stats["throttle"] += 1
+                return self._reply(429, "text/plain", "stub: throttled", [("Retry-After", "1")])
+            doc, how = fx.find(method, self.path, body)
+            if doc is not None:
+                stats[how] += 1
+                return self._reply(doc["status"], doc["content_type"] or "application/octet-stream", doc["body"])
+            gen = synthetic(method, self.path, body) if args.synthetic else None
+            if gen is not None:
+                stats["synthetic"] += 1
+                return self._reply(*gen)
+            stats["miss"] += 1
+            self._reply(404, "text/plain", f"stub: нет фикстуры для {method} {self.path}")
+
+        def do_GET(self):
+            self._serve("GET")
+
+        def do_POST(self):
+            self._serve("POST")
+
+    return Handler
+
+def env_lines(host, port):
+    base = f"http://{host}:{port}"
+    return [
+        f"export P2P_BINANCE_URL={base}{BINANCE_PATH}",
+        f"export P2P_BYBIT_URL={base}{BYBIT_PATH}",
+        f"export P2P_GF_BASE={base}",
+        f"export P2P_XE_BASE={base}",
+    ]
+
+class _StubServer(ThreadingHTTPServer):
+    # очередь accept() задаётся до listen() в конструкторе — иначе остаётся 5, и залп соединений рвётся
+    daemon_threads = True
+    request_queue_size = 1024
+
+def serve(args):
+    fx = Fixtures(args.fixtures)
+    stats = defaultdict(int)
+    srv = _StubServer((args.host, args.port), make_handler(fx, args, stats))
+    return srv, fx, stats
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--fixtures", help="каталог, записанный с P2P_RECORD_DIR")
+    ap.add_argument("--synthetic", action="store_true", help="генерировать ответы, если фикстуры нет")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8099)
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа, мс")
+    ap.add_argument("--jitter", type=float, default=0.0, help="± к задержке, мс")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 500")
+    ap.add_argument("--throttle-rate", type=float, default=0.0, help="доля ответов 429")
+    ap.add_argument("--print-env", action="store_true", help="только вывести переменные окружения")
+    args = ap.parse_args()
+
+    if args.print_env:
+        print("\n".join(env_lines(args.host, args.port)))
+        return
+    if not args.fixtures and not args.synthetic:
+        ap.error("нужен --fixtures и/или --synthetic")
+    srv, fx, stats = serve(args)
+    print(f"заглушка на http://{args.host}:{args.port}: фикстур {len(fx.by_key)}, synthetic={args.synthetic}")
+    print("\n".join(env_lines(args.host, args.port)))
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("ответы:", dict(stats))
+
+if __name__ == "__main__":
+    main()
@@ -3,22 +3,110 @@
 
 import os
 import re
+import sys
+import atexit
 import json
 import time
-from decimal import Decimal, InvalidOperation, getcontext
-from typing import Optional, Tuple, List, Dict
+import threading
+import heapq
+import random
+import sqlite3
+import bisect
+import hashlib
+import gzip
+import mmap
+import socket
+import struct
+import pickle
+import types
+import importlib.util
+from array import array
+from collections import OrderedDict, deque
+from collections.abc import Mapping, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait as futures_wait, TimeoutError as FuturesTimeout, FIRST_COMPLETED
+from functools import lru_cache
+from decimal import Decimal, InvalidOperation, Context, MAX_PREC, getcontext
+from typing import Optional, Tuple, List, Dict, Callable, TYPE_CHECKING
 from pathlib import Path
+from urllib.parse import urlsplit
+from html.parser import HTMLParser
 
-import requests
-from bs4 import BeautifulSoup
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
 
-# ---- Playwright (мягкий импорт; если нет — XE работает через requests-фоллбек)
+# ---- Ленивые импорты: тяжёлые зависимости грузятся при первом обращении к атрибуту модуля,
+# а не при импорте p2p_monitor — каждый воркер и каждый скрипт из bench/ стартует без
+# requests/bs4/Playwright/NumPy/asyncio, пока они не понадобились. Наличие проверяется по find_spec,
+# без исполнения модуля. importlib.util.LazyLoader не годится: в 3.11 он не потокобезопасен, и
+# потоки, одновременно впервые тронувшие модуль, видят его недоисполненным (AttributeError).
+_LAZY_LOCK = threading.Lock()
+
+class _LazyModule(types.ModuleType):
+    """Заместитель модуля: первый недостающий атрибут импортирует настоящий модуль под _LAZY_LOCK."""
+
+    def __getattr__(self, attr: str):
+        real = self.__dict__.get("_lazy_real")
+        if real is None:
+            with _LAZY_LOCK:
+                real = self.__dict__.get("_lazy_real")
+                if real is None:
+                    real = importlib.import_module(self.__name__)
+                    # дальше атрибуты находятся в __dict__ напрямую, без __getattr__ и блокировки
+                    self.__dict__.update({k: v for k, v in vars(real).items() if k not in ("__name__", "__spec__")})
+                    self.__dict__["_lazy_real"] = real
+        return getattr(real, attr)
+
+def _lazy_module(name: str):
+    """Модуль name с отложенным исполнением; уже импортированный — как есть; не установленный — None."""
+    mod = sys.modules.get(name)
+    if mod is not None:
+        return mod
+    try:
+        spec = importlib.util.find_spec(name)
+    except (ImportError, ValueError):
+        return None
+    if spec is None or spec.loader is None:
+        return None
+    return _LazyModule(name)
+
+if TYPE_CHECKING:
+    import asyncio
+    import requests
+    import bs4
+    from urllib3.util.retry import Retry
+else:
+    asyncio  = _lazy_module("asyncio")
+    requests = _lazy_module("requests")
+    bs4      = _lazy_module("bs4")
+
+# ---- Playwright (мягкий; если нет — XE работает через requests-фоллбек)
+playwright_api = _lazy_module("playwright.async_api")
+PLAYWRIGHT_OK = playwright_api is not None
+
+# ---- NumPy (мягкий; без него матрица спредов считается на чистом Python)
+np = _lazy_module("numpy")
+NUMPY_OK = np is not None
+
+# ---- fcntl (мягкий импорт; только POSIX — без него нет mmap-хранилища, см. MmapStore)
+try:
+    import fcntl
+    FCNTL_OK = True
+except Exception:
+    fcntl = None
+    FCNTL_OK = False
+
+# ---- orjson / brotli (мягкие импорты; без них — json из stdlib и только gzip)
+try:
+    import orjson
+    ORJSON_OK = True
+except Exception:
+    orjson = None
+    ORJSON_OK = False
 try:
-    from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError
-    PLAYWRIGHT_OK = True
+    import brotli
+    BROTLI_OK = True
 except Exception:
-    PLAYWRIGHT_OK = False
+    brotli = None
+    BROTLI_OK = False
 
 # Точность Decimal для длинных значений (BTC→KZT и т.п.)
 getcontext().prec = 28
@@ -47,8 +135,11 @@ def index():
 BINANCE_COOKIE = os.getenv("BINANCE_COOKIE", "bnc-uuid=24e155f9-acda-4066-940b-4885f4bb5d9b; BNC_FV_KEY=3352998e0fcbaf35a8c1adc76cbdf4f92046cec1; se_gd=xkBEAQR9QBKDwhbYQUwogZZUwUA0QBXVlsSJYV091NRWgCFNWV9V1; se_gsd=azM2GhpVJiklM1syJyUyGggnEAcODgVUVFVKWlFSVlNXElNT1; BNC-Location=UA; userPreferredCurrency=USD_USD; theme=dark; lang=ru-UA; language=ru-UA; se_sd=g0SBRB10SRACQoAQOAQQgZZChDldVEUWlcHVfVEZ1RTVwGVNWV4P1; currentAccount=; logined=y; fiat-prefer-currency=UAH; common_fiat=%7B%22fiat%22%3A%22UAH%22%7D; sensorsdata2015jssdkcross=%7B%22distinct_id%22%3A%22320158455%22%2C%22first_id%22%3A%221980ece448a22b-0e104b4a3c8a8-26011151-3686400-1980ece448b17c0%22%2C%22props%22%3A%7B%22%24latest_traffic_source_type%22%3A%22%E8%87%AA%E7%84%B6%E6%90%9C%E7%B4%A2%E6%B5%81%E9%87%8F%22%2C%22%24latest_search_keyword%22%3A%22%E6%9C%AA%E5%8F%96%E5%88%B0%E5%80%BC%22%2C%22%24latest_referrer%22%3A%22https%3A%2F%2Fwww.google.com%2F%22%7D%2C%22identities%22%3A%22eyIkaWRlbnRpdHlfY29va2llX2lkIjoiMTk4MGVjZTQ0OGEyMmItMGUxMDRiNGEzYzhhOC0yNjAxMTE1MS0zNjg2NDAwLTE5ODBlY2U0NDhiMTdjMCIsIiRpZGVudGl0eV9sb2dpbl9pZCI6IjMyMDE1ODQ1NSJ9%22%2C%22history_login_id%22%3A%7B%22name%22%3A%22%24identity_login_id%22%2C%22value%22%3A%22320158455%22%7D%2C%22%24device_id%22%3A%2219812922cb61f0-0f815e9aa74ba48-26011151-3686400-19812922cb7f7f%22%7D; BNC_FV_KEY_T=101-sS2hVro%2BJ06pjyDHAs2Mly9iBnbk3ZJm0T6S6YjrqirvBLie7NZ76QLvECXJhndsRcmqXOFh9DhKZacqw3pPvw%3D%3D-XlQEtbdEscN%2F0RJ5mAXFgw%3D%3D-dc; BNC_FV_KEY_EXPIRE=1756210181035; r20t=web.EA2CB6FEE8AF3CEDB25CA68DF1A247DF; r30t=1; cr00=CAD6E635218EE0E48BBDF0E4F23AFC48; d1og=web.320158455.0628CCE7479F3127A0EB040F14851A88; r2o1=web.320158455.8275488D5B5300738298D479051DBD1B; f30l=web.320158455.9F2467221E5683A27BA3F84BC256093E; p20t=web.320158455.3B345F06030FF8EF298A5D6F9F0EAF19; OptanonConsent=isGpcEnabled=0&datestamp=Tue+Aug+26+2025+09%3A21%3A24+GMT%2B0300+(%D0%92%D0%BE%D1%81%D1%82%D0%BE%D1%87%D0%BD%D0%B0%D1%8F+%D0%95%D0%B2%D1%80%D0%BE%D0%BF%D0%B0%2C+%D0%BB%D0%B5%D1%82%D0%BD%D0%B5%D0%B5+%D0%B2%D1%80%D0%B5%D0%BC%D1%8F)&version=202506.1.0&browserGpcFlag=0&isIABGlobal=false&hosts=&consentId=6d9ed745-85d2-457b-8d07-1040687ff23d&interactionCount=1&isAnonUser=1&landingPath=NotLandingPage&groups=C0001%3A1%2CC0003%3A1%2CC0004%3A0%2CC0002%3A1&AwaitingReconsent=false; _h_desk_key=539256391450436f9fa315059f988f68")
 BYBIT_COOKIE   = os.getenv("BYBIT_COOKIE", "")
 
-BINANCE_URL = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
-BYBIT_URL   = "https://www.bybit.com/x-api/fiat/otc/item/online"
+# базовые адреса upstream переопределяются для нагрузочных прогонов (bench/upstream_stub.py)
+BINANCE_URL = os.getenv("P2P_BINANCE_URL", "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search")
+BYBIT_URL   = os.getenv("P2P_BYBIT_URL", "https://www.bybit.com/x-api/fiat/otc/item/online")
+GF_BASE     = os.getenv("P2P_GF_BASE", "https://www.google.com").rstrip("/")
+XE_BASE     = os.getenv("P2P_XE_BASE", "https://www.xe.com").rstrip("/")
 
 BINANCE_HEADERS = {
     "accept": "*/*",
@@ -72,160 +163,1078 @@ BYBIT_HEADERS = {
 if BYBIT_COOKIE:
     BYBIT_HEADERS["cookie"] = BYBIT_COOKIE
 
+# ====================== Метрики (формат Prometheus) ===================
+# Свой маленький реестр вместо prometheus_client: Counter/Gauge/Histogram с метками и
+# коллекторы-функции для счётчиков, которые уже живут в QUOTES/GUARDS/XE_BROWSER_POOL.
+# Запись метрики — словарь под локом, без аллокаций на горячем пути кроме ключа-кортежа.
+# P2P_METRICS=0 выключает @timed_fn (функции остаются без обёртки), /metrics продолжает работать.
+METRICS_ENABLED = os.getenv("P2P_METRICS", "1") != "0"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+FAST_BUCKETS    = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5)
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34)).replace(chr(10), " ")}"'
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt_value(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...] = ()):
+        self.name, self.help, self.labels = name, help_, tuple(labels)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, self.labels, k, v, "") for k, v in self._values.items()]
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for name, names, values, v, extra in self._samples():
+            out.append(f"{name}{_fmt_labels(names, values, extra)} {_fmt_value(v)}")
+        return out
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels, n: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + n
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def inc(self, *labels, n: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + n
+
+    def dec(self, *labels, n: float = 1.0):
+        self.inc(*labels, n=-n)
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...] = (), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, List] = {}        # labels -> [counts по корзинам..., +Inf, sum]
+
+    def observe(self, value: float, *labels):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            s = self._series.get(labels)
+            if s is None:
+                s = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            s[i] += 1
+            s[-1] += value
+
+    def _samples(self):
+        out = []
+        with self._lock:
+            series = [(k, list(v)) for k, v in self._series.items()]
+        for labels, s in series:
+            acc = 0
+            for le, c in zip(self.buckets + (float("inf"),), s[:-1]):
+                acc += c
+                out.append((self.name + "_bucket", self.labels, labels, acc, f'le="{_fmt_value(le)}"'))
+            out.append((self.name + "_sum", self.labels, labels, s[-1], ""))
+            out.append((self.name + "_count", self.labels, labels, acc, ""))
+        return out
+
+class CallbackMetric(_Metric):
+    """Значения считаются при выдаче /metrics: fn() -> [(значения меток, число)]."""
+
+    def __init__(self, name: str, help_: str, labels: Tuple[str, ...], fn: Callable[[], List[Tuple[Tuple, float]]],
+                 kind: str = "gauge"):
+        super().__init__(name, help_, labels)
+        self.kind, self._fn = kind, fn
+
+    def _samples(self):
+        try:
+            rows = list(self._fn())
+        except Exception:
+            return []
+        return [(self.name, self.labels, tuple(k), v, "") for k, v in rows]
+
+METRICS: List[_Metric] = []
+
+def render_metrics() -> str:
+    lines: List[str] = []
+    for m in METRICS:
+        lines.extend(m.render())
+    return "\n".join(lines) + "\n"
+
+def timed_fn(hist: "Histogram", label: str):
+    """Декоратор: длительность вызова в hist{fn=label}. При P2P_METRICS=0 функция не оборачивается."""
+    def wrap(fn):
+        if not METRICS_ENABLED:
+            return fn
+        perf = time.perf_counter
+
+        def inner(*args, **kwargs):
+            t0 = perf()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                hist.observe(perf() - t0, label)
+        inner.__name__, inner.__doc__, inner.__wrapped__ = fn.__name__, fn.__doc__, fn
+        return inner
+    return wrap
+
+FETCH_SECONDS    = Histogram("p2p_fetch_seconds", "Полный upstream-вызов источника котировок", ("source",))
+FETCH_INFLIGHT   = Gauge("p2p_fetch_inflight", "Upstream-вызовы источника, выполняющиеся сейчас", ("source",))
+FETCH_ERRORS     = Counter("p2p_fetch_errors_total", "Ошибки upstream-вызовов по типу исключения", ("source", "type"))
+HTTP_SECONDS     = Histogram("p2p_upstream_http_seconds", "HTTP-запросы к upstream (с ретраями urllib3)",
+                             ("upstream", "status"))
+EXTRACT_SECONDS  = Histogram("p2p_extract_seconds", "Разбор HTML-страниц XE/GF", ("kind",), FAST_BUCKETS)
+FUNC_SECONDS     = Histogram("p2p_function_seconds", "Горячие функции разбора", ("fn",), FAST_BUCKETS)
+BROWSER_SECONDS  = Histogram("p2p_playwright_seconds", "Этапы Playwright: launch/navigate/hydrate/content",
+                             ("stage",))
+XE_HYDRATED      = Counter("p2p_xe_hydrated_total", "Дождались ли гидратации страницы XE", ("hydrated",))
+REQUEST_SECONDS  = Histogram("p2p_request_seconds", "Обработка входящих запросов", ("route", "status"))
+REQUEST_INFLIGHT = Gauge("p2p_requests_inflight", "Входящие запросы в обработке")
+
+def observe_fetch(source: str, seconds: float, error: Optional[BaseException] = None):
+    FETCH_SECONDS.observe(seconds, source)
+    if error is not None:
+        FETCH_ERRORS.inc(source, type(error).__name__)
+
 # ====================== Устойчивое извлечение чисел ===========================
 # Разделители тысяч: пробел, NBSP, узкий NBSP, запятая; десятичный: . или ,
 NUMBER_RE = re.compile(r"(?:\d{1,3}(?:[,   ]\d{3})+|\d+)(?:[.,]\d+)?")
 
+# Всё, что кроме цифр может попасть в совпадение NUMBER_RE (для подсчёта цифр без regex)
+_NUMBER_SEPARATORS = str.maketrans("", "", ",.\u00A0\u202F ")
+NUMBER_CACHE_SIZE  = int(os.getenv("P2P_NUMBER_CACHE", "4096"))
+
+def _is_canonical(s: str) -> bool:
+    """'41.25', '4795807', '0.0000123' — уже в виде, который Decimal принимает как есть."""
+    return s.isascii() and s.replace(".", "", 1).isdigit()
+
 def _normalize_number_string(s: str) -> str:
     """Нормализует строку числа к стандартному виду для Decimal."""
-    s = (s or "").strip()
-    # NBSP/узкий NBSP → обычный пробел → убрать все пробелы
-    s = s.replace("\u00A0", " ").replace("\u202F", " ")
-    s = re.sub(r"\s+", "", s)
+    if not s:
+        return ""
+    if _is_canonical(s):
+        return s
+    # любые пробелы, включая NBSP/узкий NBSP, — разделители тысяч: убираем за один проход
+    s = "".join(s.split())
 
-    has_comma = "," in s
-    has_dot   = "." in s
+    commas = s.count(",")
+    dots   = s.count(".")
 
-    if has_comma and has_dot:
+    if commas and dots:
         # Правый символ — десятичный
-        last_comma = s.rfind(",")
-        last_dot   = s.rfind(".")
-        if last_dot > last_comma:
+        if s.rfind(".") > s.rfind(","):
             # десятичная точка, запятые — тысячные
-            s = s.replace(",", "")
-        else:
-            # десятичная запятая, точки — тысячные
-            s = s.replace(".", "")
-            s = s.replace(",", ".")
-        return s
+            return s.replace(",", "")
+        # десятичная запятая, точки — тысячные
+        return s.replace(".", "").replace(",", ".")
 
-    if has_comma:
-        if s.count(",") > 1:
-            # Несколько запятых: попробуем последнюю как десятичную, остальные — тысячные
-            pos = s.rfind(",")
-            left = s[:pos].replace(",", "")
-            right = s[pos+1:]
-            s = left + "." + right
-        else:
-            # Одна запятая — считаем её десятичной
-            s = s.replace(",", ".")
-        return s
+    if commas:
+        if commas > 1:
+            # Несколько запятых: последняя — десятичная, остальные — тысячные
+            left, _, right = s.rpartition(",")
+            return left.replace(",", "") + "." + right
+        # Одна запятая — считаем её десятичной
+        return s.replace(",", ".")
 
-    if has_dot:
-        if s.count(".") > 1:
-            # Несколько точек:
-            parts = s.split(".")
-            # Проверим «чистые тысячные» (все группы по 3, первая ≤3)
-            if all(i == 0 or len(p) == 3 for i, p in enumerate(parts)) and len(parts[-1]) == 3:
-                # 1.234.567 → 1234567
-                s = "".join(parts)
-            else:
-                # Последняя — десятичная, остальные — тысячные
-                pos = s.rfind(".")
-                left = s[:pos].replace(".", "")
-                right = s[pos+1:]
-                s = left + "." + right
-        else:
-            # Одна точка — всегда десятичная
-            # (исправление: НЕ удаляем точку даже если после неё 3 цифры)
-            pass
-        return s
+    if dots > 1:
+        parts = s.split(".")
+        # «Чистые тысячные» (все группы после первой по 3): 1.234.567 → 1234567
+        if all(len(p) == 3 for p in parts[1:]):
+            return "".join(parts)
+        # Иначе последняя — десятичная, остальные — тысячные
+        left, _, right = s.rpartition(".")
+        return left.replace(".", "") + "." + right
 
-    # Нет разделителей — вернём как есть
+    # Одна точка — всегда десятичная (НЕ удаляем её даже если после неё 3 цифры); без разделителей — как есть
     return s
 
-def to_decimal(num_str: str) -> Decimal:
-    s = _normalize_number_string(num_str)
+@lru_cache(maxsize=NUMBER_CACHE_SIZE)
+def _parse_number(num_str: str) -> Decimal:
     try:
-        return Decimal(s)
+        return Decimal(_normalize_number_string(num_str))
     except InvalidOperation:
         return Decimal(0)
 
+def to_decimal(num_str: str) -> Decimal:
+    # Decimal неизменяем — один и тот же объект можно отдавать из кэша всем вызывающим
+    if not num_str:
+        return Decimal(0)
+    return _parse_number(num_str.strip())
+
+@timed_fn(FUNC_SECONDS, "best_decimal_from_text")
 def best_decimal_from_text(text: str) -> Optional[Decimal]:
     """
     Находит «лучшее» число в тексте:
-    - выбираем совпадение с максимальным количеством цифр (чтобы брать 4,795,807.00, а не «1»);
+    - выбираем совпадение с максимальным количеством цифр (чтобы брать 4,795,807.00, а не «1»),
+      при равенстве — более длинное, при полном равенстве — первое;
     - затем нормализуем и конвертируем в Decimal.
     """
-    matches = list(NUMBER_RE.finditer(text or ""))
-    if not matches:
-        return None
-    def size_key(m):
+    best, best_key = None, (-1, -1)
+    for m in NUMBER_RE.finditer(text or ""):
         raw = m.group(0)
-        digits_only = re.sub(r"[^\d]", "", raw)
-        return (len(digits_only), len(raw))  # сначала по числу цифр, потом по общей длине
-    m = max(matches, key=size_key)
-    return to_decimal(m.group(0))
+        key = (len(raw.translate(_NUMBER_SEPARATORS)), len(raw))
+        if key > best_key:
+            best, best_key = raw, key
+    return to_decimal(best) if best is not None else None
 
 # ====================== Вспомогалки ===========================
-def _avg_3_5(prices: List[Decimal]) -> Optional[Decimal]:
-    if len(prices) >= 5:
-        return (prices[2] + prices[3] + prices[4]) / Decimal(3)
-    return None
-
 def _d(x) -> Optional[Decimal]:
     try:
         if x is None:
             return None
         if isinstance(x, Decimal):
             return x
+        if isinstance(x, str) and _is_canonical(x):
+            # цены из JSON бирж ("41.25") — сразу в Decimal, мимо нормализации и кэша
+            return Decimal(x)
         return to_decimal(str(x))
     except Exception:
         return None
 
+# ====================== Котировки: фиксированная точка ===================
+# Цена из JSON биржи ("41.25") — точная десятичная дробь: один раз переводим её в целое
+# value × 10**scale (scale — наибольшее число знаков после запятой в колонке) и храним колонки
+# цена/мин./макс./объём подряд в одном array('q'). Вместо dict'а на объявление с Decimal/float/str и
+# отдельного списка prices — один объект на топ или стакан; float и строки для JSON получаются
+# из целых при сериализации, Decimal с prec=28 — только там, где с ценой считают.
+_FX_NONE  = -(1 << 63)                     # «значения нет» в int64-колонке
+_FX_EXACT = Context(prec=MAX_PREC)         # scaleb без округления
+
+def _fx_split(x) -> Optional[Tuple[int, int]]:
+    """'41.25' → (4125, 2) без Decimal; прочие формы — через _d; нет конечного числа — None."""
+    if isinstance(x, str) and x.isascii():
+        whole, _, frac = x.partition(".")
+        if whole.isdigit() and (frac.isdigit() or not frac):
+            return int(whole + frac), len(frac)
+    v = x if isinstance(x, Decimal) else _d(x)
+    if v is None or not v.is_finite():
+        return None
+    exp = v.as_tuple().exponent
+    return (int(v), 0) if exp >= 0 else (int(v.scaleb(-exp, _FX_EXACT)), -exp)
+
+def _fx_text(n: int, scale: int) -> Optional[str]:
+    if n == _FX_NONE:
+        return None
+    if not scale:
+        return str(n)
+    s = str(abs(n)).rjust(scale + 1, "0")
+    return ("-" if n < 0 else "") + s[:-scale] + "." + s[-scale:]
+
+class FixedRows(Sequence):
+    """
+    Таблица чисел фиксированной точки: колонки подряд в одном array('q'), у каждой колонки свой scale.
+    Элемент — строка таблицы списком float (так она и уходит в JSON). Значения за пределами int64
+    (экзотический scale) — list int вместо array: точность важнее компактности.
+    """
+    __slots__ = ("width", "scales", "cells")
+
+    def __init__(self, width: int, scales: Tuple[int, ...], cells):
+        self.width = width
+        self.scales = scales
+        self.cells = cells
+
+    @classmethod
+    def build(cls, rows, width: int) -> "FixedRows":
+        """rows — строки из width значений (строка из JSON, Decimal, число или None)."""
+        return cls.from_split([[_fx_split(r[j]) for r in rows] for j in range(width)])
+
+    @classmethod
+    def from_split(cls, cols: List[List[Optional[Tuple[int, int]]]]) -> "FixedRows":
+        """Колонки результатов _fx_split → общий scale на колонку и int64-ячейки."""
+        scales = tuple(max([c[1] for c in col if c is not None], default=0) for col in cols)
+        flat = [_FX_NONE if c is None else c[0] * 10 ** (s - c[1]) for col, s in zip(cols, scales) for c in col]
+        try:
+            cells = array("q", flat)
+        except OverflowError:
+            cells = flat
+        return cls(len(cols), scales, cells)
+
+    def __len__(self) -> int:
+        return len(self.cells) // self.width
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(len(self))[i]]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(i)
+        # деление int/int округляется корректно — тот же float, что float(Decimal)
+        return [None if c == _FX_NONE else c / 10 ** s for c, s in zip(self.cells[i::n], self.scales)]
+
+    def raw(self, i: int, j: int) -> int:
+        return self.cells[j * len(self) + i]
+
+    def as_decimal(self, i: int, j: int) -> Optional[Decimal]:
+        n = self.raw(i, j)
+        return None if n == _FX_NONE else Decimal(n).scaleb(-self.scales[j], _FX_EXACT)
+
+    def _col(self, j: int):
+        n = len(self)
+        return self.cells[j * n:(j + 1) * n]
+
+    def column(self, j: int) -> List[Optional[float]]:
+        d = 10 ** self.scales[j]
+        return [None if n == _FX_NONE else n / d for n in self._col(j)]
+
+    def texts(self, j: int) -> List[Optional[str]]:
+        s = self.scales[j]
+        if not s:
+            return [None if n == _FX_NONE else str(n) for n in self._col(j)]
+        d = 10 ** s
+        return [None if n == _FX_NONE else "%d.%0*d" % (n // d, s, n % d) if n >= 0 else _fx_text(n, s)
+                for n in self._col(j)]
+
+    def to_json(self) -> List[List[Optional[float]]]:
+        return [list(r) for r in zip(*(self.column(j) for j in range(self.width)))]
+
+class QuoteBook(Mapping):
+    """
+    Топ объявлений Binance/Bybit: имена продавцов + FixedRows [цена, мин. фиат, макс. фиат, объём].
+    Снаружи — неизменяемый Mapping с прежними ключами items/prices/avg: кэш, история, граф,
+    матрица и JSON-ответы работают с ним как с прежним dict'ом, а dict'ы объявлений собираются
+    только при обращении к "items" (сериализация ответа).
+    """
+    __slots__ = ("names", "rows", "avg")
+    KEYS = ("items", "prices", "avg")
+
+    def __init__(self, names: Tuple[str, ...], rows: FixedRows):
+        self.names = names
+        self.rows = rows
+        avg = self.avg_decimal()
+        self.avg = float(avg) if avg is not None else None
+
+    @classmethod
+    def from_ads(cls, ads) -> "QuoteBook":
+        """ads — (имя, цена, мин., макс., объём) в сыром виде из JSON; объявления без цены пропускаются."""
+        names, cols = [], ([], [], [], [])
+        for name, price, mn, mx, volume in ads:
+            price = _fx_split(price)
+            if price is None:
+                continue
+            names.append(name)
+            for col, v in zip(cols, (price, _fx_split(mn), _fx_split(mx), _fx_split(volume))):
+                col.append(v)
+        return cls(tuple(names), FixedRows.from_split(list(cols)))
+
+    def avg_decimal(self) -> Optional[Decimal]:
+        """Среднее цен #3–5 в Decimal (prec=28) — ровно то, что давало (p3 + p4 + p5) / 3 по исходным Decimal."""
+        if len(self.rows) < 5:
+            return None
+        total = self.rows.raw(2, 0) + self.rows.raw(3, 0) + self.rows.raw(4, 0)
+        return Decimal(total) / Decimal(3 * 10 ** self.rows.scales[0])
+
+    def _items(self, prices: List[float]) -> List[Dict]:
+        rows = self.rows
+        return [{"name": name, "price": p, "min": mn, "max": mx, "volume": v}
+                for name, p, mn, mx, v in zip(self.names, prices, rows.texts(1), rows.texts(2), rows.texts(3))]
+
+    def __getitem__(self, key):
+        if key == "avg":
+            return self.avg
+        if key == "prices":
+            return self.rows.column(0)
+        if key == "items":
+            return self._items(self.rows.column(0))
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self) -> int:
+        return len(self.KEYS)
+
+    def to_json(self) -> Dict:
+        prices = self.rows.column(0)
+        return {"items": self._items(prices), "prices": prices, "avg": self.avg}
+
+# ====================== HTTP-сессии (keep-alive, ретраи) ==================
+# Одна Session на upstream-хост: соединения переиспользуются (без TCP+TLS на каждый вызов),
+# 429/5xx повторяются с джиттер-бэкоффом и учётом Retry-After, число одновременных
+# запросов к хосту ограничено.
+HTTP_POOL_SIZE        = int(os.getenv("P2P_HTTP_POOL_SIZE", "10"))
+HTTP_HOST_CONCURRENCY = int(os.getenv("P2P_HTTP_HOST_CONCURRENCY", "8"))
+HTTP_RETRIES          = int(os.getenv("P2P_HTTP_RETRIES", "2"))
+HTTP_BACKOFF          = float(os.getenv("P2P_HTTP_BACKOFF", "0.3"))
+HTTP_RETRY_AFTER_MAX  = float(os.getenv("P2P_HTTP_RETRY_AFTER_MAX", "5"))
+
+@lru_cache(maxsize=None)
+def _capped_retry_cls():
+    # класс строится при первой сессии: базовый Retry из urllib3 грузится вместе с requests
+    from urllib3.util.retry import Retry
+
+    class _CappedRetry(Retry):
+        """Retry-After соблюдаем, но не дольше HTTP_RETRY_AFTER_MAX — иначе запрос браузера просто повиснет."""
+        def get_retry_after(self, response):
+            v = super().get_retry_after(response)
+            return None if v is None else min(v, HTTP_RETRY_AFTER_MAX)
+
+        def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+            # каждый 429 (и промежуточный, и последний, после которого ретраи кончились) проходит
+            # через increment — лимитеру сообщаем только отсюда, HostSessions.request его не трогает
+            if response is not None and response.status == 429 and _pool is not None:
+                GUARDS.get(GUARDS.name_for_host(_pool.host if not _pool.port or _pool.port in (80, 443)
+                                                else f"{_pool.host}:{_pool.port}")).limiter.on_throttle(
+                    _retry_after_seconds(response.headers.get("Retry-After")))
+            return super().increment(method, url, response, error, _pool, _stacktrace)
+
+    return _CappedRetry
+
+def _make_retry() -> "Retry":
+    return _capped_retry_cls()(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=0,                      # read-таймаут не повторяем: это ещё +15 с к ответу
+        status=HTTP_RETRIES,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=None,        # POST поиска объявлений идемпотентен
+        backoff_factor=HTTP_BACKOFF,
+        backoff_jitter=HTTP_BACKOFF,
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+
+# ====================== Предохранители и адаптивные лимиты ============
+# На каждый upstream (binance, bybit, gf, xe, xe:browser) — предохранитель и адаптивный лимитер.
+# Предохранитель считает ошибки (сеть, таймаут, 429, 5xx) в скользящем окне и при доле ошибок
+# ≥ BREAKER_ERROR_RATE размыкается: запросы сразу получают UpstreamUnavailable, а get_quote
+# отдаёт устаревшее значение из кэша. Через паузу пропускается одна пробная попытка
+# (half-open): удачная замыкает цепь, неудачная удваивает паузу. Лимитер — AIMD-ведро токенов:
+# 429 вдвое режет темп и ставит паузу по Retry-After, каждый успех понемногу его возвращает.
+BREAKER_WINDOW       = float(os.getenv("P2P_BREAKER_WINDOW", "30"))
+BREAKER_MIN_CALLS    = int(os.getenv("P2P_BREAKER_MIN_CALLS", "5"))
+BREAKER_ERROR_RATE   = float(os.getenv("P2P_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_COOLDOWN     = float(os.getenv("P2P_BREAKER_COOLDOWN", "10"))
+BREAKER_COOLDOWN_MAX = float(os.getenv("P2P_BREAKER_COOLDOWN_MAX", "120"))
+LIMIT_MAX_WAIT       = float(os.getenv("P2P_LIMIT_MAX_WAIT", "2"))     # дольше ждать токен не будем — отказ
+# потолок запросов в минуту на upstream; после 429 темп падает вплоть до четверти потолка
+LIMIT_RPM = {"binance": 240, "bybit": 240, "gf": 120, "xe": 60, "xe:browser": 30}
+LIMIT_RPM.update(json.loads(os.getenv("P2P_LIMIT_RPM", "{}")))
+STALE_MAX_AGE        = float(os.getenv("P2P_STALE_MAX_AGE", "3600"))
+
+class UpstreamUnavailable(RuntimeError):
+    """Предохранитель разомкнут или лимитер не дал токен вовремя — upstream не вызывался."""
+
+class TokenBucket:
+    def __init__(self, per_minute: float, burst: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst if burst is not None else max(1.0, per_minute / 6.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self) -> float:
+        """0.0 — токен взят; иначе сколько секунд ждать до следующего."""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return 0.0
+            return (1.0 - self.tokens) / self.rate if self.rate > 0 else 60.0
+
+class AdaptiveLimiter(TokenBucket):
+    def __init__(self, per_minute: float):
+        super().__init__(per_minute)
+        self.max_rate = self.rate
+        self.min_rate = self.rate / 4
+        self.paused_until = 0.0
+        self.throttles = self.rejected = 0
+
+    def try_take(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            if now < self.paused_until:
+                return self.paused_until - now
+        return super().try_take()
+
+    def acquire(self, max_wait: float = LIMIT_MAX_WAIT) -> bool:
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self.try_take()
+            if wait <= 0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def on_throttle(self, retry_after: Optional[float] = None):
+        with self._lock:
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            if retry_after:
+                self.paused_until = max(self.paused_until, time.monotonic() + min(retry_after, HTTP_RETRY_AFTER_MAX))
+
+    def on_success(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"
+        self._calls: deque = deque()        # (monotonic, ok)
+        self._lock = threading.Lock()
+        self._open_until = 0.0
+        self._cooldown = BREAKER_COOLDOWN
+        self._trial = False
+        self.opens = 0
+        self.last_error: Optional[str] = None
+
+    def _trim(self, now: float):
+        while self._calls and now - self._calls[0][0] > BREAKER_WINDOW:
+            self._calls.popleft()
+
+    def is_open(self) -> bool:
+        """Разомкнут и пробовать ещё рано — звать upstream бессмысленно."""
+        return self.state == "open" and time.monotonic() < self._open_until
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() >= self._open_until:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def cancel(self):
+        """Разрешённый вызов так и не состоялся (например, не дали токен)."""
+        with self._lock:
+            self._trial = False
+
+    def _open(self, now: float):
+        self.state = "open"
+        self._open_until = now + self._cooldown
+        self.opens += 1
+
+    def record(self, ok: bool, error: Optional[str] = None):
+        now = time.monotonic()
+        with self._lock:
+            if not ok:
+                self.last_error = error
+            if self.state == "half_open":
+                self._trial = False
+                if ok:
+                    self.state = "closed"
+                    self._calls.clear()
+                    self._cooldown = BREAKER_COOLDOWN
+                else:
+                    self._cooldown = min(self._cooldown * 2, BREAKER_COOLDOWN_MAX)
+                    self._open(now)
+                return
+            if self.state == "open":
+                return              # ответ запроса, начатого до размыкания
+            self._calls.append((now, ok))
+            self._trim(now)
+            errors = sum(1 for _, x in self._calls if not x)
+            if len(self._calls) >= BREAKER_MIN_CALLS and errors / len(self._calls) >= BREAKER_ERROR_RATE:
+                self._open(now)
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            n = len(self._calls)
+            errors = sum(1 for _, x in self._calls if not x)
+            return {
+                "state": self.state, "calls": n, "error_rate": round(errors / n, 3) if n else 0.0,
+                "retry_in": round(self._open_until - now, 1) if self.state == "open" and now < self._open_until else 0.0,
+                "opens": self.opens, "last_error": self.last_error,
+            }
+
+class UpstreamGuard:
+    def __init__(self, name: str):
+        self.name = name
+        self.breaker = CircuitBreaker(name)
+        self.limiter = AdaptiveLimiter(LIMIT_RPM.get(name, 240))
+
+    def _unavailable(self, why: str) -> UpstreamUnavailable:
+        return UpstreamUnavailable(f"{self.name}: {why}")
+
+    def check_open(self):
+        if self.breaker.is_open():
+            raise self._unavailable(f"предохранитель разомкнут, повтор через {self.breaker.stats()['retry_in']} с")
+
+    def admit(self):
+        if not self.breaker.allow():
+            raise self._unavailable("идёт пробный запрос после сбоя")
+
+    def reject(self) -> UpstreamUnavailable:
+        self.limiter.rejected += 1
+        return self._unavailable("превышен темп запросов")
+
+    def before(self):
+        """Перед вызовом upstream: быстрый отказ при разомкнутой цепи или пустом ведре."""
+        self.check_open()
+        if not self.limiter.acquire():
+            raise self.reject()
+        self.admit()
+
+    def after(self, ok: bool, error: Optional[str] = None):
+        self.breaker.record(ok, error)
+        if ok:
+            self.limiter.on_success()
+
+    def stats(self) -> Dict:
+        return {**self.breaker.stats(), "rate_per_min": round(self.limiter.rate * 60, 1),
+                "throttles": self.limiter.throttles, "rejected": self.limiter.rejected}
+
+class UpstreamGuards:
+    def __init__(self):
+        self._guards: Dict[str, UpstreamGuard] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> UpstreamGuard:
+        g = self._guards.get(name)
+        if g is None:
+            with self._lock:
+                g = self._guards.setdefault(name, UpstreamGuard(name))
+        return g
+
+    def name_for_host(self, host: str) -> str:
+        host = host.lower()
+        if host == urlsplit(BINANCE_URL).netloc.lower():
+            return "binance"
+        if host == urlsplit(BYBIT_URL).netloc.lower():
+            return "bybit"
+        if host == urlsplit(GF_BASE).netloc.lower():
+            return "gf"
+        if host == urlsplit(XE_BASE).netloc.lower():
+            return "xe"
+        return host
+
+    def for_url(self, url: str) -> UpstreamGuard:
+        # сначала по префиксу адреса: за одной заглушкой (bench/upstream_stub.py) все upstream на одном хосте
+        if url.startswith(BINANCE_URL):
+            return self.get("binance")
+        if url.startswith(BYBIT_URL):
+            return self.get("bybit")
+        if url.startswith(GF_BASE + "/finance/"):
+            return self.get("gf")
+        if url.startswith(XE_BASE + "/currencyconverter/"):
+            return self.get("xe")
+        return self.get(self.name_for_host(urlsplit(url).netloc))
+
+    def source_open(self, source: str) -> bool:
+        names = SOURCE_UPSTREAMS.get(source, ())
+        return bool(names) and all(self.get(n).breaker.is_open() for n in names)
+
+    def stats(self) -> Dict:
+        return {name: g.stats() for name, g in sorted(self._guards.items())}
+
+# от каких upstream зависит источник котировок; XE закрыт, только если лежат и браузер, и requests
+SOURCE_UPSTREAMS = {
+    "binance": ("binance",), "binance_depth": ("binance",),
+    "bybit": ("bybit",), "bybit_depth": ("bybit",),
+    "gf": ("gf",), "xe": ("xe:browser", "xe"),
+}
+
+GUARDS = UpstreamGuards()
+
+def _retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    if value and value.strip().isdigit():
+        return float(value)
+    return None
+
+# ---- запись upstream-ответов в фикстуры (P2P_RECORD_DIR) для bench/upstream_stub.py
+# Файл на запрос: <dir>/<upstream>/<fixture_key>.json. Ключ не зависит от хоста, поэтому
+# заглушка по тому же ключу находит ответ на запрос, пришедший уже на её адрес.
+RECORD_DIR = os.getenv("P2P_RECORD_DIR") or None
+_RECORD_LOCK = threading.Lock()
+RECORD_STATS = {"written": 0, "errors": 0, "last_error": None}
+
+def fixture_key(method: str, url: str, body=None) -> str:
+    """sha1(метод, путь?запрос, канонический JSON тела)[:16]; тело — dict/list, str или bytes."""
+    parts = urlsplit(url)
+    target = parts.path + ("?" + parts.query if parts.query else "")
+    if isinstance(body, (bytes, str)) and body:
+        try:
+            body = json.loads(body)
+        except ValueError:
+            body = body.decode("utf-8", "replace") if isinstance(body, bytes) else body
+    canon = json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False) if body else ""
+    return hashlib.sha1(f"{method.upper()} {target}\n{canon}".encode("utf-8")).hexdigest()[:16]
+
+def record_exchange(upstream: str, method: str, url: str, body, status: int, content_type: str, text: str):
+    if not RECORD_DIR:
+        return
+    key = fixture_key(method, url, body)
+    path = Path(RECORD_DIR) / upstream.replace(":", "_") / f"{key}.json"
+    doc = {"key": key, "upstream": upstream, "method": method.upper(), "url": url, "request": body,
+           "status": status, "content_type": content_type, "body": text, "recorded": int(time.time())}
+    try:
+        with _RECORD_LOCK:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(doc, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, path)
+            RECORD_STATS["written"] += 1
+    except OSError as e:
+        with _RECORD_LOCK:
+            RECORD_STATS["errors"] += 1
+            RECORD_STATS["last_error"] = f"{path}: {e}"
+
+def record_stats() -> Optional[Dict]:
+    if not RECORD_DIR:
+        return None
+    with _RECORD_LOCK:
+        return {"dir": RECORD_DIR, **RECORD_STATS}
+
+class HostSessions:
+    def __init__(self, pool_size: int = HTTP_POOL_SIZE, concurrency: int = HTTP_HOST_CONCURRENCY):
+        self.pool_size = pool_size
+        self.concurrency = concurrency
+        self._hosts: Dict[str, Tuple["requests.Session", "requests.adapters.HTTPAdapter", threading.BoundedSemaphore]] = {}
+        self._lock = threading.Lock()
+
+    def _for(self, url: str):
+        host = urlsplit(url).netloc.lower()
+        entry = self._hosts.get(host)
+        if entry is None:
+            with self._lock:
+                entry = self._hosts.get(host)
+                if entry is None:
+                    from http.cookiejar import DefaultCookiePolicy
+                    sess = requests.Session()
+                    # как и модульные requests.get/post — без накопления чужих cookie между вызовами
+                    sess.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+                    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=_make_retry())
+                    sess.mount("https://", adapter)
+                    sess.mount("http://", adapter)
+                    entry = self._hosts[host] = (sess, adapter, threading.BoundedSemaphore(self.concurrency))
+        return entry
+
+    def request(self, method: str, url: str, **kwargs) -> "requests.Response":
+        sess, _, sem = self._for(url)
+        guard = GUARDS.for_url(url)
+        guard.before()
+        ok, error, status = False, None, "error"
+        t0 = time.perf_counter()
+        try:
+            with sem:
+                resp = sess.request(method, url, **kwargs)
+            status = str(resp.status_code)
+            # о 429 лимитер уже знает: _CappedRetry.increment вызывается и на последний ответ
+            ok = resp.status_code != 429 and resp.status_code < 500
+            error = None if ok else f"HTTP {resp.status_code}"
+            if RECORD_DIR:
+                record_exchange(guard.name, method, url, kwargs.get("json", kwargs.get("data")),
+                                resp.status_code, resp.headers.get("Content-Type", ""), resp.text)
+            return resp
+        except requests.RequestException as e:
+            error = status = type(e).__name__
+            raise
+        finally:
+            guard.after(ok, error)
+            HTTP_SECONDS.observe(time.perf_counter() - t0, guard.name, status)
+
+    def get(self, url: str, **kwargs) -> "requests.Response":
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> "requests.Response":
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> Dict:
+        """Счётчики urllib3 по хостам: requests — HTTP-запросы (с ретраями), connections — новые TCP/TLS-соединения."""
+        out = {}
+        for host, (_, adapter, _) in list(self._hosts.items()):
+            pools = adapter.poolmanager.pools
+            reqs = conns = 0
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is not None:
+                    reqs += pool.num_requests
+                    conns += pool.num_connections
+            out[host] = {"requests": reqs, "connections": conns, "reused": max(reqs - conns, 0)}
+        return out
+
+HTTP = HostSessions()
+
+# ====================== Потоковое извлечение из HTML ===================
+# Вместо полного дерева BeautifulSoup — токенизатор html.parser со стеком открытых тегов:
+# нужные узлы (data-last-price, блок conversion, таблица chart-stats, og:description)
+# отслеживаются по мере разбора, и разбор обрывается, как только значение найдено.
+# P2P_HTML_EXTRACT=soup возвращает прежний путь через BeautifulSoup.
+HTML_EXTRACT = os.getenv("P2P_HTML_EXTRACT", "stream").lower()
+
+_VOID_TAGS = frozenset(("area", "base", "br", "col", "embed", "hr", "img", "input", "link",
+                        "meta", "param", "source", "track", "wbr"))
+
+class _StopParse(Exception):
+    pass
+
+class _Capture:
+    """Текст одного отслеживаемого элемента (как get_text(strip=True) по его потомкам)."""
+    __slots__ = ("kind", "depth", "parent", "parts")
+
+    def __init__(self, kind: str, depth: int, parent: int):
+        self.kind = kind
+        self.depth = depth
+        self.parent = parent
+        self.parts: List[str] = []
+
+    def text(self, sep: str) -> str:
+        return sep.join(p for p in (x.strip() for x in self.parts) if p)
+
+class _TargetExtractor(HTMLParser):
+    """Стек (tag, id) без узлов дерева; наследники решают, какие элементы захватывать."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._stack: List[Tuple[str, int]] = [("#root", 0)]
+        self._ids = 0
+        self._captures: List[_Capture] = []
+        self._raw_text = 0      # внутри <script>/<style>: их текст get_text не учитывает
+
+    def capture(self, kind: str):
+        self._captures.append(_Capture(kind, len(self._stack), self._stack[-1][1]))
+
+    def on_start(self, tag: str, attrs: Dict[str, str]):
+        pass
+
+    def on_end(self, cap: _Capture):
+        pass
+
+    def handle_starttag(self, tag, attrs):
+        self.on_start(tag, {k: (v or "") for k, v in attrs})
+        if tag in _VOID_TAGS:
+            return
+        self._ids += 1
+        self._stack.append((tag, self._ids))
+        if tag in ("script", "style"):
+            self._raw_text += 1
+
+    def handle_startendtag(self, tag, attrs):
+        self.on_start(tag, {k: (v or "") for k, v in attrs})
+
+    def handle_endtag(self, tag):
+        # как у html.parser-сборщика BeautifulSoup: закрываем до ближайшего открытого такого же тега
+        for i in range(len(self._stack) - 1, 0, -1):
+            if self._stack[i][0] == tag:
+                break
+        else:
+            return
+        for _ in range(len(self._stack) - i):
+            name, _ = self._stack.pop()
+            if name in ("script", "style"):
+                self._raw_text -= 1
+            depth = len(self._stack)
+            while self._captures and self._captures[-1].depth >= depth:
+                self.on_end(self._captures.pop())
+
+    def handle_data(self, data):
+        if self._raw_text:
+            return
+        for cap in self._captures:
+            cap.parts.append(data)
+
+    def run(self, html: str) -> "_TargetExtractor":
+        try:
+            self.feed(html)
+            self.close()
+        except _StopParse:
+            pass
+        return self
+
+class GfExtractor(_TargetExtractor):
+    def __init__(self, A: str, F: str):
+        super().__init__()
+        self.A, self.F = A, F
+        self.block_price: Optional[str] = None
+        self.fx_text: Optional[str] = None      # первый div.YMlKec.fxKbKc
+        self.plain_text: Optional[str] = None   # первый div.YMlKec
+
+    def on_start(self, tag, attrs):
+        if tag != "div":
+            return
+        if (attrs.get("jscontroller") == "NdbN0c" and attrs.get("jsname") == "AS5Pxb"
+                and attrs.get("data-source") == self.A and attrs.get("data-target") == self.F
+                and "data-last-price" in attrs):
+            self.block_price = attrs["data-last-price"]
+            raise _StopParse
+        classes = attrs.get("class", "").split()
+        if "YMlKec" in classes:
+            if "fxKbKc" in classes and self.fx_text is None:
+                self.capture("fx")
+            elif self.plain_text is None:
+                self.capture("plain")
+
+    def on_end(self, cap):
+        text = cap.text(" ")
+        if cap.kind == "fx" and self.fx_text is None:
+            self.fx_text = text
+        elif cap.kind == "plain" and self.plain_text is None:
+            self.plain_text = text
+
+class XeExtractor(_TargetExtractor):
+    def __init__(self):
+        super().__init__()
+        self.conv_val: Optional[Decimal] = None
+        self.chart_val: Optional[Decimal] = None
+        self.og: Optional[str] = None
+        self.description: Optional[str] = None
+        self._conv_done = False
+        self._conv_depth: Optional[int] = None      # глубина открытого div[data-testid=conversion]
+        self._header_parent: Optional[int] = None   # родитель <p>, оканчивающегося на «=»
+        self._chart_depth: Optional[int] = None
+
+    def on_start(self, tag, attrs):
+        if tag == "meta":
+            if attrs.get("property") == "og:description" and self.og is None:
+                self.og = attrs.get("content", "")
+            elif attrs.get("name") == "description" and self.description is None:
+                self.description = attrs.get("content", "")
+            return
+        testid = attrs.get("data-testid")
+        if tag == "div" and testid == "conversion" and not self._conv_done and self._conv_depth is None:
+            self._conv_depth = len(self._stack)
+            self._header_parent = None
+            self.capture("conv_box")
+        elif tag == "section" and testid == "currency-conversion-chart-stats-table" and self.chart_val is None:
+            self._chart_depth = len(self._stack)
+            self.capture("chart_box")
+        elif tag == "p":
+            if self._conv_depth is not None and not self._conv_done:
+                parent = self._stack[-1][1]
+                self.capture("conv_value" if self._header_parent == parent else "conv_p")
+            if self._chart_depth is not None and self.chart_val is None:
+                self.capture("chart_p")
+
+    def on_end(self, cap):
+        if cap.kind == "conv_p":
+            if self._header_parent is None and cap.text(" ").endswith("="):
+                self._header_parent = cap.parent
+        elif cap.kind == "conv_value" and not self._conv_done:
+            self.conv_val = best_decimal_from_text(cap.text(""))
+            self._conv_done = True
+        elif cap.kind == "chart_p" and self.chart_val is None:
+            val = best_decimal_from_text(cap.text(" "))
+            if val:
+                self.chart_val = val
+        elif cap.kind == "conv_box":
+            self._conv_depth = None
+        elif cap.kind == "chart_box":
+            self._chart_depth = None
+        if self._conv_done and self.chart_val is not None:
+            raise _StopParse
+
+    def meta_val(self) -> Optional[Decimal]:
+        content = self.og if self.og is not None else self.description
+        return best_decimal_from_text(content) if content is not None else None
+
+# ---- учёт времени разбора по видам страниц
+_EXTRACT_LOCK = threading.Lock()
+EXTRACT_STATS: Dict[str, Dict] = {}
+
+def _timed_extract(kind: str, fn: Callable[[], object], size: int) -> Tuple[object, float]:
+    t0 = time.perf_counter()
+    result = fn()
+    ms = (time.perf_counter() - t0) * 1000
+    EXTRACT_SECONDS.observe(ms / 1000, kind)
+    with _EXTRACT_LOCK:
+        st = EXTRACT_STATS.setdefault(kind, {"pages": 0, "bytes": 0, "total_ms": 0.0, "max_ms": 0.0})
+        st["pages"] += 1
+        st["bytes"] += size
+        st["total_ms"] += ms
+        st["max_ms"] = max(st["max_ms"], ms)
+    return result, round(ms, 3)
+
+def extract_stats() -> Dict:
+    with _EXTRACT_LOCK:
+        return {
+            "engine": HTML_EXTRACT,
+            **{kind: {**st, "total_ms": round(st["total_ms"], 1), "max_ms": round(st["max_ms"], 3),
+                      "avg_ms": round(st["total_ms"] / st["pages"], 3) if st["pages"] else None}
+               for kind, st in EXTRACT_STATS.items()},
+        }
+
 # ====================== Google Finance ==========================
 GF_HEADERS = {
     "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/139.0.0.0 Safari/537.36",
     "accept-language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7",
 }
 
-def _gf_price_direct(asset: str, fiat: str) -> Tuple[Decimal, str]:
-    A, F = asset.upper(), fiat.upper()
-    url  = f"https://www.google.com/finance/quote/{A}-{F}"
-    r = requests.get(url, headers=GF_HEADERS, timeout=12)
-    r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
+def _gf_url(asset: str, fiat: str) -> str:
+    return f"{GF_BASE}/finance/quote/{asset.upper()}-{fiat.upper()}"
+
+def _gf_parse(html: str, A: str, F: str) -> Decimal:
+    if HTML_EXTRACT == "soup":
+        return _gf_parse_soup(html, A, F)
+    ex = GfExtractor(A, F).run(html)
+    if ex.block_price is not None:
+        return to_decimal(ex.block_price)
+    text = ex.fx_text if ex.fx_text is not None else ex.plain_text
+    if text:
+        val = best_decimal_from_text(text)
+        if val is not None:
+            return val
+    m = re.findall(r'data-last-price="([^"]+)"', html)
+    if m:
+        return to_decimal(m[-1])
+    raise RuntimeError("GF: не удалось извлечь цену")
+
+def _gf_parse_soup(html: str, A: str, F: str) -> Decimal:
+    soup = bs4.BeautifulSoup(html, "html.parser")
 
     blk = soup.select_one(f'div[jscontroller="NdbN0c"][jsname="AS5Pxb"][data-source="{A}"][data-target="{F}"]')
     if blk and blk.has_attr("data-last-price"):
-        return (to_decimal(blk["data-last-price"]), url)
+        return to_decimal(blk["data-last-price"])
 
     node = soup.select_one("div.YMlKec.fxKbKc") or soup.select_one("div.YMlKec")
     if node and node.text:
         val = best_decimal_from_text(node.get_text(" ", strip=True))
         if val is not None:
-            return (val, url)
+            return val
 
-    m = re.findall(r'data-last-price="([^"]+)"', r.text)
+    m = re.findall(r'data-last-price="([^"]+)"', html)
     if m:
-        return (to_decimal(m[-1]), url)
+        return to_decimal(m[-1])
 
     raise RuntimeError("GF: не удалось извлечь цену")
 
+def _gf_price_direct(asset: str, fiat: str) -> Tuple[Decimal, str]:
+    A, F = asset.upper(), fiat.upper()
+    url  = _gf_url(A, F)
+    r = HTTP.get(url, headers=GF_HEADERS, timeout=12)
+    r.raise_for_status()
+    html = r.text
+    price, _ = _timed_extract("gf", lambda: _gf_parse(html, A, F), len(html))
+    return price, url
+
 def fetch_gf(asset: str, fiat: str) -> Dict:
+    # время разбора — только в EXTRACT_STATS: в котировке оно меняло бы тело/ETag при той же цене
     p, url = _gf_price_direct(asset, fiat)
     return {"pair": f"{asset.upper()}-{fiat.upper()}", "price": float(p), "url": url, "ts": int(time.time())}
 
 # ====================== Binance ================================
-def fetch_binance(
-    asset="USDT",
-    fiat="UAH",
-    side="SELL",
-    pay_types=None,
-    amount="20000",
-    rows=10,
-    merchant=True,
-    page=1,
-):
-    """
-    merchant=True  -> отбираем только верифицированных продавцов/мерчантов:
-                      - publisherType: "merchant"
-                      - merchantCheck: True
-    """
+def _binance_payload(asset, fiat, side, pay_types, amount, rows, merchant, page) -> Dict:
     # важный флаг: вместе с merchantCheck даём и publisherType
     publisher_type = "merchant" if merchant else None
-
-    payload = {
+    return {
         "asset": asset,
         "fiat": fiat,
         "tradeType": side,
@@ -249,35 +1258,84 @@ def fetch_binance(
         "filterType": "all",
     }
 
-    r = requests.post(BINANCE_URL, headers=BINANCE_HEADERS, json=payload, timeout=15)
-    r.raise_for_status()
-    js = r.json()
+def _binance_parse(js: Dict) -> "QuoteBook":
     if js.get("code") != "000000" or "data" not in js:
         raise RuntimeError(f"Binance API error: {js}")
 
-    data = js["data"] or []
-    items, prices = [], []
-    for ad in data[:5]:
+    ads = []
+    for ad in (js["data"] or [])[:5]:
         adv = ad.get("adv") or {}
         seller = (ad.get("advertiser") or {}).get("nickName") or "-"
-        price = _d(adv.get("price"))
-        if price is None:
-            continue
-        items.append({
-            "name": seller,
-            "price": float(price),
-            "min": adv.get("minSingleTransAmount"),
-            "max": adv.get("maxSingleTransAmount"),
-            "volume": adv.get("surplusAmount"),
-        })
-        prices.append(price)
-
-    avg = _avg_3_5(prices)
-    return {
-        "items": items,
-        "prices": [float(x) for x in prices],
-        "avg": (float(avg) if avg is not None else None),
-    }
+        ads.append((seller, adv.get("price"), adv.get("minSingleTransAmount"),
+                    adv.get("maxSingleTransAmount"), adv.get("surplusAmount")))
+    return QuoteBook.from_ads(ads)
+
+def fetch_binance(
+    asset="USDT",
+    fiat="UAH",
+    side="SELL",
+    pay_types=None,
+    amount="20000",
+    rows=10,
+    merchant=True,
+    page=1,
+):
+    """
+    merchant=True  -> отбираем только верифицированных продавцов/мерчантов:
+                      - publisherType: "merchant"
+                      - merchantCheck: True
+    """
+    payload = _binance_payload(asset, fiat, side, pay_types, amount, rows, merchant, page)
+    r = HTTP.post(BINANCE_URL, headers=BINANCE_HEADERS, json=payload, timeout=15)
+    r.raise_for_status()
+    return _binance_parse(r.json())
+
+def _binance_paytypes_page(asset, fiat, side, amount, merchant, rows, page) -> Optional[Dict[str, str]]:
+    """Методы оплаты из одной страницы объявлений; None — страница пустая или ошибка (дальше не идём)."""
+    payload = _binance_payload(asset, fiat, side, [], amount, rows, merchant, page)
+    r = HTTP.post(BINANCE_URL, headers=BINANCE_HEADERS, json=payload, timeout=15)
+    if r.status_code != 200:
+        return None
+    js = r.json()
+    if js.get("code") != "000000":
+        return None
+    data = js.get("data", []) or []
+    if not data:
+        return None
+
+    seen: Dict[str, str] = {}
+    for ad in data:
+        adv = ad.get("adv", {}) or {}
+
+        # методы внутри объявления (tradeMethods)
+        for tm in adv.get("tradeMethods", []) or []:
+            ident = (tm.get("identifier") or tm.get("payType") or "").strip()
+            name = (tm.get("tradeMethodName") or tm.get("name") or ident).strip()
+            if ident:
+                seen[ident] = name
+
+        # иногда бинанс дублирует отдельным массивом payTypes
+        for ident in ad.get("payTypes", []) or []:
+            ident = (ident or "").strip()
+            if ident and ident not in seen:
+                seen[ident] = ident
+    return seen
+
+def discover_binance_paytypes_map(asset="USDT", fiat="UAH", side="SELL", amount="20000",
+                                  merchant=True, pages=2, rows=20) -> Dict[str, str]:
+    """id → имя по первым pages страницам; страницы запрашиваются одновременно."""
+    futs = [_DEPTH_POOL.submit(_binance_paytypes_page, asset, fiat, side, amount, merchant, rows, p)
+            for p in range(1, pages + 1)]
+    seen: Dict[str, str] = {}
+    for fut in futs:
+        # как и раньше: после первой пустой/ошибочной страницы остальные не учитываем
+        page = fut.result()
+        if page is None:
+            break
+        for ident, name in page.items():
+            if ident not in seen or seen[ident] == ident:
+                seen[ident] = name
+    return seen
 
 def discover_binance_paytypes(
     asset="USDT",
@@ -291,92 +1349,321 @@ def discover_binance_paytypes(
     """
     Собираем список методов оплаты с тем же фильтром мерчантов.
     """
-    seen = {}
-    publisher_type = "merchant" if merchant else None
+    seen = discover_binance_paytypes_map(asset, fiat, side, amount, merchant, pages, rows)
+    items = [{"id": k, "name": v} for k, v in seen.items()]
+    items.sort(key=lambda x: (x["name"].lower(), x["id"]))
+    return items
 
-    for p in range(1, pages + 1):
-        payload = {
-            "asset": asset,
-            "fiat": fiat,
-            "tradeType": side,
-            "transAmount": str(amount),
-            "page": p,
-            "rows": int(rows),
+# ---- Каталог методов оплаты: ответ сразу из памяти/файла, обновление — в фоне.
+# Ключ — (fiat, side, merchant): набор методов от актива и суммы почти не зависит, поэтому
+# смена asset/amount в интерфейсе больше не стоит новых запросов к бирже. Каждое обновление
+# сливается с тем, что уже известно; метод, не встречавшийся PAYTYPES_EXPIRE, выбывает.
+# Обход объявлений всегда идёт по PAYTYPES_ASSET (а не по активу запроса, запустившего обновление):
+# иначе содержимое общего ключа зависело бы от того, кто пришёл первым. transAmount пустой —
+# иначе биржа оставит только объявления, принимающие конкретную сумму, и часть методов потеряется.
+PAYTYPES_FILE   = Path(os.getenv("P2P_PAYTYPES_FILE", str(BASE_DIR / "binance_paytypes.json")))
+PAYTYPES_TTL    = float(os.getenv("P2P_PAYTYPES_TTL", "21600"))      # 6 ч — потом обновляем в фоне
+PAYTYPES_EXPIRE = float(os.getenv("P2P_PAYTYPES_EXPIRE", str(30 * 86400)))
+PAYTYPES_PAGES  = int(os.getenv("P2P_PAYTYPES_PAGES", "5"))
+PAYTYPES_WAIT   = float(os.getenv("P2P_PAYTYPES_WAIT", "10"))        # первое заполнение ключа ждём синхронно
+PAYTYPES_ASSET  = os.getenv("P2P_PAYTYPES_ASSET", "USDT")            # самый ликвидный стакан — больше всего методов
 
-            "payTypes": [],
-            "countries": [],
+class BinancePaytypeCatalog:
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = {}         # key -> {"methods": {id: [name, last_seen]}, "updated", "error"}
+        self._refreshing: Dict[str, threading.Event] = {}
+        self._items: Dict[str, Tuple[Tuple, List[Dict]]] = {}   # key -> (версия записи, отсортированный список)
+        self._load()
 
-            "merchantCheck": bool(merchant),
-            "publisherType": publisher_type,
+    @staticmethod
+    def key(fiat: str, side: str, merchant: bool) -> str:
+        return f"{fiat.upper()}:{side.upper()}:{'merchant' if merchant else 'all'}"
 
-            "proMerchantAds": False,
-            "shieldMerchantAds": False,
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
 
-            "filterType": "all",
-        }
+    def _save(self):
+        tmp = self.path.with_suffix(self.path.suffix + ".tmp")
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
 
-        r = requests.post(BINANCE_URL, headers=BINANCE_HEADERS, json=payload, timeout=15)
-        if r.status_code != 200:
-            break
-        js = r.json()
-        if js.get("code") != "000000":
-            break
-        data = js.get("data", []) or []
-        if not data:
-            break
+    def _refresh(self, key: str, fiat: str, side: str, merchant: bool):
+        now = time.time()
+        try:
+            # несколько процессов: страницы объявлений обходит один из них, остальные берут его результат
+            found, _ = shared_call("paytypes:" + key, PAYTYPES_TTL,
+                                   lambda: discover_binance_paytypes_map(PAYTYPES_ASSET, fiat, side, "", merchant,
+                                                                              PAYTYPES_PAGES))
+            error = None
+        except Exception as e:
+            found, error = {}, str(e)
+        with self._lock:
+            entry = self._entries.setdefault(key, {"methods": {}, "updated": None, "error": None})
+            methods = entry["methods"]
+            for ident, name in found.items():
+                methods[ident] = [name, now]
+            for ident in [i for i, (_, seen_at) in methods.items() if now - seen_at > PAYTYPES_EXPIRE]:
+                del methods[ident]
+            if error is None:
+                entry["updated"] = now
+            entry["error"] = error
+            done = self._refreshing.pop(key, None)
+            if error is None:
+                self._save()
+        if done is not None:
+            done.set()
 
-        for ad in data:
-            adv = ad.get("adv", {}) or {}
+    def _schedule(self, key: str, fiat: str, side: str, merchant: bool) -> threading.Event:
+        with self._lock:
+            ev = self._refreshing.get(key)
+            if ev is None:
+                ev = self._refreshing[key] = threading.Event()
+                _RATES_POOL.submit(self._refresh, key, fiat, side, merchant)
+            return ev
 
-            # методы внутри объявления (tradeMethods)
-            for tm in adv.get("tradeMethods", []) or []:
-                ident = (tm.get("identifier") or tm.get("payType") or "").strip()
-                name = (tm.get("tradeMethodName") or tm.get("name") or ident).strip()
-                if ident:
-                    seen[ident] = name
+    def get(self, fiat: str, side: str, merchant: bool) -> Dict:
+        key = self.key(fiat, side, merchant)
+        with self._lock:
+            entry = self._entries.get(key)
+            updated = entry and entry.get("updated")
+        if not updated or time.time() - updated > PAYTYPES_TTL:
+            ev = self._schedule(key, fiat, side, merchant)
+            if not updated:
+                # ключ ещё ни разу не заполнялся — отдавать пустой список бессмысленно
+                ev.wait(PAYTYPES_WAIT)
+        with self._lock:
+            entry = self._entries.get(key) or {"methods": {}, "updated": None, "error": None}
+            updated = entry.get("updated")
+            refreshing = key in self._refreshing
+            error = entry.get("error")
+            # тот же список, пока запись не менялась: ответ API сериализует его один раз (BODIES)
+            version = (updated, len(entry["methods"]))
+            memo = self._items.get(key)
+            if memo is None or memo[0] != version:
+                items = sorted(({"id": k, "name": v[0]} for k, v in entry["methods"].items()),
+                               key=lambda x: (x["name"].lower(), x["id"]))
+                self._items[key] = (version, items)
+            else:
+                items = memo[1]
+        return {
+            "items": items, "updated": updated,
+            "age": round(time.time() - updated, 1) if updated else None,
+            "stale": not updated or time.time() - updated > PAYTYPES_TTL,
+            "refreshing": refreshing, "error": error,
+        }
 
-            # иногда бинанс дублирует отдельным массивом payTypes
-            for ident in ad.get("payTypes", []) or []:
-                ident = (ident or "").strip()
-                if ident and ident not in seen:
-                    seen[ident] = ident
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"keys": len(self._entries), "refreshing": len(self._refreshing), "file": str(self.path)}
 
-    items = [{"id": k, "name": v} for k, v in seen.items()]
-    items.sort(key=lambda x: (x["name"].lower(), x["id"]))
-    return items
+BINANCE_PAYTYPES = BinancePaytypeCatalog(PAYTYPES_FILE)
 
 # ====================== Bybit ================================
-def fetch_bybit(token="USDT", fiat="UAH", side="SELL", payments=None, amount="20000", rows=10, verified=False):
+def _bybit_payload(token, fiat, side, payments, amount, rows, verified, page=1) -> Dict:
     side_map = {"SELL": "0", "BUY": "1"}
-    payload = {
+    return {
         "tokenId": token, "currencyId": fiat, "payment": payments or [],
         "side": side_map.get(side.upper(), "1"),
-        "size": str(rows), "page": "1",
+        "size": str(rows), "page": str(page),
         "amount": str(amount), "authMaker": bool(verified),
         "canTrade": False, "shieldMerchant": False, "reputation": False, "country": ""
     }
-    r = requests.post(BYBIT_URL, headers=BYBIT_HEADERS, json=payload, timeout=15)
-    r.raise_for_status()
-    js = r.json()
+
+def _bybit_parse(js) -> "QuoteBook":
     result = js.get("result", {}) if isinstance(js, dict) else {}
     data = (result.get("items") or [])[:5]
+    return QuoteBook.from_ads((ad.get("nickName") or "-", ad.get("price"), ad.get("minAmount"),
+                               ad.get("maxAmount"), ad.get("lastQuantity")) for ad in data)
 
-    items, prices = [], []
-    for ad in data:
-        name  = ad.get("nickName") or "-"
-        price = _d(ad.get("price"))
-        if price is None:
+def fetch_bybit(token="USDT", fiat="UAH", side="SELL", payments=None, amount="20000", rows=10, verified=False):
+    payload = _bybit_payload(token, fiat, side, payments, amount, rows, verified)
+    r = HTTP.post(BYBIT_URL, headers=BYBIT_HEADERS, json=payload, timeout=15)
+    r.raise_for_status()
+    return _bybit_parse(r.json())
+
+# ====================== Глубина стакана (Binance/Bybit) =================
+# Страницы объявлений запрашиваются волнами параллельно: первая волна — DEPTH_WAVE страниц,
+# дальше размер волны оценивается по объёму уже полученных страниц, чтобы добрать цель
+# (наибольшую сумму из amounts или объём volume) за одну волну. Бюджет — DEPTH_MAX_PAGES
+# запросов на стакан и общий дедлайн; стакан кончился — короткая страница.
+DEPTH_ROWS      = 20                                               # максимум строк на страницу у обеих бирж
+DEPTH_MAX_PAGES = int(os.getenv("P2P_DEPTH_MAX_PAGES", "10"))
+DEPTH_WAVE      = int(os.getenv("P2P_DEPTH_WAVE", "2"))
+DEPTH_DEADLINE  = float(os.getenv("P2P_DEPTH_DEADLINE", "20"))
+DEPTH_WORKERS   = int(os.getenv("P2P_DEPTH_WORKERS", "8"))
+
+# отдельный пул: глубину зовут и из потоков _RATES_POOL (get_quote), вложенная отправка туда же могла бы встать
+_DEPTH_POOL = ThreadPoolExecutor(max_workers=DEPTH_WORKERS, thread_name_prefix="depth")
+
+# уровень стакана: (id объявления, цена, мин. фиат, макс. фиат, доступный объём актива);
+# id = None, если биржа его не прислала — такие уровни не дедуплицируются
+_Level = Tuple[Optional[str], Decimal, Decimal, Decimal, Decimal]
+
+def _level(ident, price, mn, mx, volume) -> Optional[_Level]:
+    price = _d(price)
+    if price is None or price <= 0:
+        return None
+    ident = str(ident) if ident not in (None, "") else None
+    return (ident, price, _d(mn) or Decimal(0), _d(mx) or Decimal(0), _d(volume) or Decimal(0))
+
+def _binance_depth_page(asset, fiat, side, pay_types, merchant, page) -> List[_Level]:
+    # transAmount пустой: нужен весь стакан, а не только объявления, принимающие одну сумму
+    payload = _binance_payload(asset, fiat, side, pay_types, "", DEPTH_ROWS, merchant, page)
+    r = HTTP.post(BINANCE_URL, headers=BINANCE_HEADERS, json=payload, timeout=15)
+    r.raise_for_status()
+    js = r.json()
+    if js.get("code") != "000000":
+        raise RuntimeError(f"Binance API error: {js}")
+    out = []
+    for ad in js.get("data") or []:
+        adv = ad.get("adv") or {}
+        lv = _level(adv.get("advNo"), adv.get("price"), adv.get("minSingleTransAmount"),
+                    adv.get("maxSingleTransAmount"), adv.get("surplusAmount"))
+        if lv is not None:
+            out.append(lv)
+    return out
+
+def _bybit_depth_page(token, fiat, side, payments, verified, page) -> List[_Level]:
+    payload = _bybit_payload(token, fiat, side, payments, "", DEPTH_ROWS, verified, page)
+    r = HTTP.post(BYBIT_URL, headers=BYBIT_HEADERS, json=payload, timeout=15)
+    r.raise_for_status()
+    js = r.json()
+    out = []
+    for ad in ((js.get("result") or {}).get("items") or []) if isinstance(js, dict) else []:
+        lv = _level(ad.get("id"), ad.get("price"), ad.get("minAmount"), ad.get("maxAmount"), ad.get("lastQuantity"))
+        if lv is not None:
+            out.append(lv)
+    return out
+
+def _level_capacity(lv: _Level) -> Decimal:
+    """Сколько фиата реально можно провести через объявление: min(макс. лимит, остаток × цена)."""
+    _, price, _, mx, volume = lv
+    cap = volume * price
+    return min(cap, mx) if mx > 0 else cap
+
+def _depth_walk(fetch_page: Callable[[int], List[_Level]], target_fiat: Decimal, target_volume: Decimal,
+                max_pages: int, deadline: float) -> Dict:
+    started = time.monotonic()
+    pages: Dict[int, List[_Level]] = {}
+    next_page, wave, exhausted, error = 1, max(1, DEPTH_WAVE), False, None
+    cum_fiat = cum_volume = Decimal(0)
+    while next_page <= max_pages and not exhausted:
+        batch = list(range(next_page, min(next_page + wave, max_pages + 1)))
+        futs = [(p, _DEPTH_POOL.submit(fetch_page, p)) for p in batch]
+        next_page = batch[-1] + 1
+        for p, fut in futs:
+            left = deadline - (time.monotonic() - started)
+            try:
+                rows = fut.result(timeout=max(left, 0.01))
+            except Exception as e:
+                if not pages and p == 1:
+                    raise
+                error = "timeout" if not str(e) else str(e)
+                exhausted = True
+                break
+            pages[p] = rows
+            if len(rows) < DEPTH_ROWS:
+                exhausted = True        # дальше объявлений нет; более поздние страницы волны пустые
+                break
+        if error is not None:
+            break
+        # объём по полученному префиксу страниц
+        cum_fiat = sum((_level_capacity(lv) for rows in pages.values() for lv in rows), Decimal(0))
+        cum_volume = sum((lv[4] for rows in pages.values() for lv in rows), Decimal(0))
+        if (target_fiat and cum_fiat >= target_fiat) or (target_volume and cum_volume >= target_volume):
+            break
+        # сколько страниц ещё нужно при среднем объёме страницы — столько и берём следующей волной
+        per_page = cum_fiat / len(pages) if pages else Decimal(0)
+        if target_fiat and per_page > 0:
+            need = int(((target_fiat - cum_fiat) / per_page).to_integral_value(rounding="ROUND_CEILING"))
+        else:
+            need = DEPTH_WAVE
+        wave = max(1, min(need, max_pages - next_page + 1, DEPTH_WORKERS))
+
+    seen, ladder = set(), []
+    for p in sorted(pages):
+        for lv in pages[p]:
+            # объявления сдвигаются между страницами, пока волна в полёте — дубли убираем
+            if lv[0] is not None:
+                if lv[0] in seen:
+                    continue
+                seen.add(lv[0])
+            ladder.append(lv)
+    return {"ladder": ladder, "pages_fetched": len(pages), "exhausted": exhausted and error is None,
+            "error": error, "elapsed": round(time.monotonic() - started, 3)}
+
+def depth_fill(ladder: List[_Level], amount: Decimal) -> Dict:
+    """
+    Исполнение суммы amount (фиат) по уровням в порядке выдачи биржи: на каждом берём
+    не больше ёмкости объявления и не меньше его минимального лимита. VWAP = фиат / актив.
+    """
+    remaining, filled, asset, used, worst = amount, Decimal(0), Decimal(0), 0, None
+    for lv in ladder:
+        if remaining <= 0:
+            break
+        price, mn = lv[1], lv[2]
+        take = min(remaining, _level_capacity(lv))
+        if take <= 0 or take < mn:
             continue
-        items.append({
-            "name": name,
-            "price": float(price),
-            "min": ad.get("minAmount"),
-            "max": ad.get("maxAmount"),
-            "volume": ad.get("lastQuantity"),
-        })
-        prices.append(price)
-    avg = _avg_3_5(prices)
-    return {"items": items, "prices": [float(x) for x in prices], "avg": (float(avg) if avg is not None else None)}
+        filled += take
+        asset += take / price
+        remaining -= take
+        used += 1
+        worst = price
+    best = ladder[0][1] if ladder else None
+    vwap = filled / asset if asset > 0 else None
+    return {
+        "amount": float(amount), "filled": float(filled), "complete": remaining <= 0,
+        "vwap": float(vwap) if vwap is not None else None,
+        "asset": float(asset), "levels_used": used,
+        "worst_price": float(worst) if worst is not None else None,
+        "slippage_pct": float(round((vwap / best - 1) * 100, 4)) if vwap is not None and best else None,
+    }
+
+def _depth_result(exchange: str, walk: Dict, amounts: List[Decimal]) -> Dict:
+    ladder = walk["ladder"]
+    return {
+        "exchange": exchange,
+        # компактно: [цена, мин. фиат, макс. фиат, объём актива] в фиксированной точке, float — при сериализации
+        "ladder": FixedRows.build([lv[1:] for lv in ladder], 4),
+        "levels": len(ladder),
+        "best": float(ladder[0][1]) if ladder else None,
+        "cum_volume": float(sum((lv[4] for lv in ladder), Decimal(0))),
+        "cum_fiat": float(sum((_level_capacity(lv) for lv in ladder), Decimal(0))),
+        "effective": [depth_fill(ladder, a) for a in amounts],
+        "pages_fetched": walk["pages_fetched"], "pages_budget": DEPTH_MAX_PAGES,
+        "book_exhausted": walk["exhausted"], "partial_error": walk["error"],
+        "elapsed": walk["elapsed"], "ts": int(time.time()),
+    }
+
+def _depth_targets(amounts: List[str], volume: Optional[str]) -> Tuple[List[Decimal], Decimal, Decimal]:
+    amts = [a for a in (_d(x) for x in amounts) if a is not None and a > 0]
+    vol = _d(volume) if volume else None
+    return amts, (max(amts) if amts else Decimal(0)), (vol if vol is not None and vol > 0 else Decimal(0))
+
+def fetch_binance_depth(asset="USDT", fiat="UAH", side="SELL", pay_types=None, merchant=True,
+                        amounts=("20000",), volume=None, max_pages=DEPTH_MAX_PAGES) -> Dict:
+    amts, target_fiat, target_volume = _depth_targets(list(amounts), volume)
+    walk = _depth_walk(lambda p: _binance_depth_page(asset, fiat, side, pay_types, merchant, p),
+                       target_fiat, target_volume, max_pages, DEPTH_DEADLINE)
+    return _depth_result("binance", walk, amts)
+
+def fetch_bybit_depth(token="USDT", fiat="UAH", side="SELL", payments=None, verified=False,
+                      amounts=("20000",), volume=None, max_pages=DEPTH_MAX_PAGES) -> Dict:
+    amts, target_fiat, target_volume = _depth_targets(list(amounts), volume)
+    walk = _depth_walk(lambda p: _bybit_depth_page(token, fiat, side, payments, verified, p),
+                       target_fiat, target_volume, max_pages, DEPTH_DEADLINE)
+    return _depth_result("bybit", walk, amts)
 
 # ====================== XE (универсальный) =====================
 XE_UA = (
@@ -389,7 +1676,8 @@ SEL_TIMEOUT = 6000
 
 XE_STABLES = {"USDT", "USDC", "DAI", "TUSD", "EURC", "USDP"}
 
-def xe_extract_both(soup: BeautifulSoup, frm: str, to: str) -> Tuple[Optional[Decimal], Optional[Decimal]]:
+@timed_fn(FUNC_SECONDS, "xe_extract_both")
+def xe_extract_both(soup: "bs4.BeautifulSoup", frm: str, to: str) -> Tuple[Optional[Decimal], Optional[Decimal]]:
     conv_val = None
     chart_val = None
     # conversion box
@@ -412,298 +1700,2769 @@ def xe_extract_both(soup: BeautifulSoup, frm: str, to: str) -> Tuple[Optional[De
             break
     return conv_val, chart_val
 
-def xe_extract_meta(soup: BeautifulSoup) -> Optional[Decimal]:
+def xe_extract_meta(soup: "bs4.BeautifulSoup") -> Optional[Decimal]:
     meta = soup.find("meta", attrs={"property": "og:description"}) or soup.find("meta", attrs={"name": "description"})
     if not meta:
         return None
     return best_decimal_from_text(meta.get("content") or "")
 
-def fetch_xe_via_browser(frm: str, to: str, amount: Decimal = Decimal(1)) -> Tuple[Optional[Decimal], str, Dict]:
-    url = f"https://www.xe.com/currencyconverter/convert/?Amount={amount}&From={frm}&To={to}"
-    if not PLAYWRIGHT_OK:
-        return None, url, {"note": "playwright_not_installed"}
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True, args=["--no-sandbox"])
-        context = browser.new_context(
+# ---- Пул браузера: один долгоживущий Chromium + прогретые контексты/страницы.
+# Playwright-объекты привязаны к своему event loop, поэтому весь пул живёт в отдельном
+# потоке с asyncio-циклом, а Flask-потоки отдают ему задачи через run_coroutine_threadsafe.
+XE_POOL_SIZE     = int(os.getenv("P2P_XE_POOL_SIZE", "2"))
+XE_POOL_MAX_USES = int(os.getenv("P2P_XE_POOL_MAX_USES", "50"))   # переработать страницу после N навигаций
+XE_POOL_WAIT     = float(os.getenv("P2P_XE_POOL_WAIT", "10"))      # сколько ждать свободную страницу сверх таймаутов навигации
+
+class _PageSlot:
+    __slots__ = ("context", "page", "uses", "generation", "broken")
+
+    def __init__(self):
+        self.context = None
+        self.page = None
+        self.uses = 0
+        self.generation = -1
+        self.broken = False
+
+class XeBrowserPool:
+    def __init__(self, size: int = XE_POOL_SIZE, max_uses: int = XE_POOL_MAX_USES):
+        self.size = max(1, size)
+        self.max_uses = max(1, max_uses)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        self._pw = None
+        self._browser = None
+        self._generation = 0          # растёт при каждом перезапуске браузера
+        self._relaunch_lock: Optional[asyncio.Lock] = None
+        self._slots: Optional[asyncio.Queue] = None
+        self.launches = self.recycles = self.crashes = self.navigations = 0
+
+    # ---- жизненный цикл
+    def _ensure_started(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever, name="xe-browser-pool", daemon=True)
+            thread.start()
+            try:
+                asyncio.run_coroutine_threadsafe(self._startup(), loop).result(timeout=60)
+            except BaseException:
+                loop.call_soon_threadsafe(loop.stop)
+                raise
+            self._loop, self._thread = loop, thread
+
+    async def _startup(self):
+        self._pw = await playwright_api.async_playwright().start()
+        self._relaunch_lock = asyncio.Lock()
+        self._slots = asyncio.Queue()
+        for _ in range(self.size):
+            self._slots.put_nowait(_PageSlot())
+        try:
+            await self._launch()
+        except BaseException:
+            await self._pw.stop()
+            raise
+
+    async def _launch(self):
+        t0 = time.perf_counter()
+        self._browser = await self._pw.chromium.launch(headless=True, args=["--no-sandbox"])
+        BROWSER_SECONDS.observe(time.perf_counter() - t0, "launch")
+        self._generation += 1
+        self.launches += 1
+
+    async def _ensure_browser(self):
+        """Health-check браузера: упал/отключился — перезапускаем, все страницы станут устаревшими."""
+        if self._browser is not None and self._browser.is_connected():
+            return
+        async with self._relaunch_lock:
+            if self._browser is not None and self._browser.is_connected():
+                return
+            self.crashes += 1
+            try:
+                await self._browser.close()
+            except Exception:
+                pass
+            await self._launch()
+
+    async def _close_slot(self, slot: _PageSlot):
+        if slot.context is not None:
+            try:
+                await slot.context.close()
+            except Exception:
+                pass
+        slot.context = slot.page = None
+        slot.uses = 0
+        slot.broken = False
+
+    async def _prepare(self, slot: _PageSlot):
+        await self._ensure_browser()
+        stale = (
+            slot.page is None or slot.broken or slot.page.is_closed()
+            or slot.generation != self._generation or slot.uses >= self.max_uses
+        )
+        if not stale:
+            return
+        if slot.context is not None:
+            self.recycles += 1
+        await self._close_slot(slot)
+        slot.context = await self._browser.new_context(
             locale="ru-RU",
             user_agent=XE_UA,
             viewport={"width": 1280, "height": 900},
             extra_http_headers={"Accept-Language": "ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7"},
         )
-        page = context.new_page()
-        hydrated = False
+        slot.page = await slot.context.new_page()
+        slot.generation = self._generation
+
+    async def _with_page(self, job):
+        slot = await self._slots.get()
+        try:
+            await self._prepare(slot)
+            slot.uses += 1
+            self.navigations += 1
+            return await job(slot.page)
+        except BaseException:
+            # страница в неизвестном состоянии (таймаут, краш вкладки, отмена) — пересоздадим при следующей выдаче
+            slot.broken = True
+            raise
+        finally:
+            self._slots.put_nowait(slot)
+
+    # ---- API для потоков Flask
+    def submit(self, job):
+        """job: async (page) -> result. Возвращает concurrent.futures.Future."""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._with_page(job), self._loop)
+
+    def run(self, job, timeout: float):
+        fut = self.submit(job)
         try:
-            page.goto(url, wait_until="domcontentloaded", timeout=NAV_TIMEOUT)
+            return fut.result(timeout=timeout)
+        except BaseException:
+            fut.cancel()
+            raise
+
+    def close(self):
+        if self._loop is None:
+            return
+        async def _shutdown():
+            while self._slots is not None and not self._slots.empty():
+                await self._close_slot(self._slots.get_nowait())
             try:
-                page.wait_for_selector(
-                    "div[data-testid='conversion'] p, section[data-testid='currency-conversion-chart-stats-table'] p, meta[property='og:description']",
-                    timeout=SEL_TIMEOUT
-                )
-                hydrated = True
-            except PWTimeoutError:
+                await self._browser.close()
+            except Exception:
                 pass
-            html = page.content()
-            soup = BeautifulSoup(html, "html.parser")
-            conv_val, chart_val = xe_extract_both(soup, frm, to)
-            chosen = None
-            source = None
-            if conv_val and conv_val > 0:
-                chosen = conv_val; source = "xe:conversion"
-            if chart_val and chart_val > 0:
-                if not chosen:
-                    chosen = chart_val; source = "xe:chart"
-                else:
-                    rel = abs(chart_val - conv_val) / max((chart_val + conv_val) / 2, Decimal("1e-9"))
-                    if rel <= Decimal("0.03"):
-                        chosen = (chart_val + conv_val) / Decimal(2); source = "xe:avg(chart,conv)"
-                    # иначе оставляем conversion
-            if not chosen:
-                meta_val = xe_extract_meta(soup)
-                if meta_val and meta_val > 0:
-                    chosen = meta_val; source = "xe:meta"
-            return chosen, url, {"source": source, "hydrated": hydrated}
-        finally:
-            try: page.close()
-            except: pass
-            try: context.close()
-            except: pass
-            try: browser.close()
-            except: pass
+            try:
+                await self._pw.stop()
+            except Exception:
+                pass
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), self._loop).result(timeout=10)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._loop = self._thread = None
+
+    def stats(self) -> Dict:
+        return {
+            "started": self._loop is not None, "size": self.size, "max_uses": self.max_uses,
+            "connected": bool(self._browser is not None and self._browser.is_connected()),
+            "idle": (self._slots.qsize() if self._slots is not None else None),
+            "launches": self.launches, "recycles": self.recycles,
+            "crashes": self.crashes, "navigations": self.navigations,
+        }
+
+XE_BROWSER_POOL = XeBrowserPool()
+atexit.register(XE_BROWSER_POOL.close)
+
+def _xe_pick_from_soup(soup: "bs4.BeautifulSoup", frm: str, to: str) -> Tuple[Optional[Decimal], Optional[str]]:
+    conv_val, chart_val = xe_extract_both(soup, frm, to)
+    return _xe_pick(conv_val, chart_val, lambda: xe_extract_meta(soup))
+
+def _xe_extract(html: str, frm: str, to: str) -> Tuple[Optional[Decimal], Optional[Decimal], Callable[[], Optional[Decimal]]]:
+    """(conversion, chart, ленивый meta) — потоковым экстрактором или, при P2P_HTML_EXTRACT=soup, через дерево."""
+    if HTML_EXTRACT == "soup":
+        soup = bs4.BeautifulSoup(html, "html.parser")
+        conv_val, chart_val = xe_extract_both(soup, frm, to)
+        return conv_val, chart_val, lambda: xe_extract_meta(soup)
+    ex = XeExtractor().run(html)
+    return ex.conv_val, ex.chart_val, ex.meta_val
+
+def _xe_pick(conv_val: Optional[Decimal], chart_val: Optional[Decimal],
+             meta: Callable[[], Optional[Decimal]]) -> Tuple[Optional[Decimal], Optional[str]]:
+    chosen = None
+    source = None
+    if conv_val and conv_val > 0:
+        chosen = conv_val; source = "xe:conversion"
+    if chart_val and chart_val > 0:
+        if not chosen:
+            chosen = chart_val; source = "xe:chart"
+        else:
+            rel = abs(chart_val - conv_val) / max((chart_val + conv_val) / 2, Decimal("1e-9"))
+            if rel <= Decimal("0.03"):
+                chosen = (chart_val + conv_val) / Decimal(2); source = "xe:avg(chart,conv)"
+            # иначе оставляем conversion
+    if not chosen:
+        meta_val = meta()
+        if meta_val and meta_val > 0:
+            chosen = meta_val; source = "xe:meta"
+    return chosen, source
+
+def _xe_url(frm: str, to: str, amount=1) -> str:
+    return f"{XE_BASE}/currencyconverter/convert/?Amount={amount}&From={frm}&To={to}"
+
+async def _xe_load_page(page, url: str) -> Tuple[str, bool]:
+    hydrated = False
+    t0 = time.perf_counter()
+    await page.goto(url, wait_until="domcontentloaded", timeout=NAV_TIMEOUT)
+    t1 = time.perf_counter()
+    BROWSER_SECONDS.observe(t1 - t0, "navigate")
+    try:
+        await page.wait_for_selector(
+            "div[data-testid='conversion'] p, section[data-testid='currency-conversion-chart-stats-table'] p, meta[property='og:description']",
+            timeout=SEL_TIMEOUT
+        )
+        hydrated = True
+    except playwright_api.TimeoutError:
+        pass
+    t2 = time.perf_counter()
+    BROWSER_SECONDS.observe(t2 - t1, "hydrate")
+    XE_HYDRATED.inc("true" if hydrated else "false")
+    html = await page.content()
+    BROWSER_SECONDS.observe(time.perf_counter() - t2, "content")
+    return html, hydrated
+
+class _XeBrowserFetch:
+    """
+    Браузерная попытка как отменяемая задача: страница заказывается в пуле сразу, разбор — когда готова.
+    Предохранитель xe:browser учитывает исход в колбэке future; отмена проигравшего сбоем не считается.
+    """
+
+    def __init__(self, frm: str, to: str, amount: Decimal):
+        self.frm, self.to = frm, to
+        self.url = _xe_url(frm, to, amount)
+        self.future = None
+        self.note: Optional[str] = None
+        if not PLAYWRIGHT_OK:
+            self.note = "playwright_not_installed"
+            return
+        self.guard = GUARDS.get("xe:browser")
+        try:
+            self.guard.before()
+        except UpstreamUnavailable as e:
+            self.note = f"circuit_open: {e}"
+            return
+        self.future = XE_BROWSER_POOL.submit(lambda page: _xe_load_page(page, self.url))
+        self.future.add_done_callback(self._account)
+
+    def _account(self, fut):
+        if fut.cancelled():
+            return
+        exc = fut.exception()
+        self.guard.after(exc is None, type(exc).__name__ if exc is not None else None)
+
+    def cancel(self, failed: bool = False):
+        """failed=True — не уложились в дедлайн (это сбой браузера), иначе просто проиграли гонку."""
+        if self.future is not None and self.future.cancel():
+            if failed:
+                self.guard.after(False, "Timeout")
+            else:
+                self.guard.breaker.cancel()
+
+    def result(self) -> Tuple[Optional[Decimal], str, Dict]:
+        html, hydrated = self.future.result()
+        if RECORD_DIR and hydrated:
+            record_exchange("xe", "GET", self.url, None, 200, "text/html; charset=utf-8", html)
+        (conv_val, chart_val, meta), _ = _timed_extract(
+            "xe:browser", lambda: _xe_extract(html, self.frm, self.to), len(html))
+        chosen, source = _xe_pick(conv_val, chart_val, meta)
+        return chosen, self.url, {"source": source, "hydrated": hydrated}
+
+def fetch_xe_via_browser(frm: str, to: str, amount: Decimal = Decimal(1)) -> Tuple[Optional[Decimal], str, Dict]:
+    job = _XeBrowserFetch(frm, to, amount)
+    if job.future is None:
+        return None, job.url, {"note": job.note}
+    try:
+        job.future.result(timeout=XE_BROWSER_TIMEOUT)
+    except FuturesTimeout:
+        job.cancel(failed=True)
+        raise
+    return job.result()
 
 def fetch_xe_via_requests(frm: str, to: str, amount: Decimal = Decimal(1)) -> Tuple[Optional[Decimal], str, Dict]:
-    url = f"https://www.xe.com/currencyconverter/convert/?Amount={amount}&From={frm}&To={to}"
+    url = _xe_url(frm, to, amount)
     hdrs = {"User-Agent": XE_UA, "Accept-Language": "ru-RU,ru;q=0.9"}
-    r = requests.get(url, headers=hdrs, timeout=15)
+    r = HTTP.get(url, headers=hdrs, timeout=15)
     r.raise_for_status()
-    soup = BeautifulSoup(r.text, "html.parser")
-    conv_val, chart_val = xe_extract_both(soup, frm, to)
-    chosen = conv_val or chart_val or xe_extract_meta(soup)
-    return chosen, url, {"source": "xe:requests", "hydrated": False}
+    html = r.text
+    (conv_val, chart_val, meta), _ = _timed_extract("xe:requests", lambda: _xe_extract(html, frm, to), len(html))
+    chosen, pick = _xe_pick(conv_val, chart_val, meta)
+    return chosen, url, {"source": "xe:requests", "pick": pick, "hydrated": False}
+
+# ---- Хеджирование XE: дешёвый requests-путь стартует сразу, браузер — через задержку хеджа
+# или сразу, если статический HTML не дал полноценного курса (только округлённый meta-тег).
+# Первый валидный курс выигрывает, проигравший отменяется. По каждой паре копится история:
+# задержка хеджа ≈ XE_HEDGE_FACTOR × EWMA времени requests-пути, а пары, где статика стабильно
+# пустая, идут сразу в браузер (каждый XE_ROUTE_PROBE-й вызов — снова проба requests).
+XE_BROWSER_TIMEOUT = (NAV_TIMEOUT + SEL_TIMEOUT) / 1000 + XE_POOL_WAIT
+XE_HEDGE_DELAY     = float(os.getenv("P2P_XE_HEDGE_DELAY", "1.5"))     # пока по паре нет истории
+XE_HEDGE_MIN       = float(os.getenv("P2P_XE_HEDGE_MIN", "0.3"))
+XE_HEDGE_FACTOR    = 2.0
+XE_ROUTE_WINDOW    = 20
+XE_ROUTE_MIN       = 3             # столько подряд неудач статики → пара «браузерная»
+XE_ROUTE_PROBE     = 10
+XE_ROUTE_PAIRS     = 2000
+
+_XE_HEDGE_POOL = ThreadPoolExecutor(max_workers=int(os.getenv("P2P_XE_HEDGE_WORKERS", "8")), thread_name_prefix="xe-hedge")
+
+class XeRouteStats:
+    def __init__(self):
+        self._pairs: "OrderedDict[str, Dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, pair: str) -> Dict:
+        e = self._pairs.get(pair)
+        if e is None:
+            e = self._pairs[pair] = {"wins": {"requests": 0, "browser": 0, "meta": 0}, "static": deque(maxlen=XE_ROUTE_WINDOW),
+                                     "ewma": None, "calls": 0}
+            while len(self._pairs) > XE_ROUTE_PAIRS:
+                self._pairs.popitem(last=False)
+        self._pairs.move_to_end(pair)
+        return e
+
+    def plan(self, pair: str) -> Tuple[bool, float]:
+        """(сразу браузер?, задержка хеджа)."""
+        with self._lock:
+            e = self._entry(pair)
+            e["calls"] += 1
+            recent = list(e["static"])[-XE_ROUTE_MIN:]
+            browser_first = (PLAYWRIGHT_OK and len(recent) == XE_ROUTE_MIN and not any(recent)
+                             and e["calls"] % XE_ROUTE_PROBE != 0)
+            delay = XE_HEDGE_DELAY if e["ewma"] is None else min(max(e["ewma"] * XE_HEDGE_FACTOR, XE_HEDGE_MIN), XE_HEDGE_DELAY)
+            return browser_first, delay
+
+    def static_result(self, pair: str, ok: bool, seconds: float):
+        """Исход requests-пути: ok — полноценный курс из статического HTML."""
+        with self._lock:
+            e = self._entry(pair)
+            e["static"].append(ok)
+            e["ewma"] = seconds if e["ewma"] is None else 0.8 * e["ewma"] + 0.2 * seconds
+
+    def win(self, pair: str, path: str):
+        with self._lock:
+            self._entry(pair)["wins"][path] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pairs = {p: {"wins": dict(e["wins"]), "static_ok": sum(e["static"]), "static_n": len(e["static"]),
+                         "ewma_ms": round(e["ewma"] * 1000, 1) if e["ewma"] is not None else None}
+                     for p, e in list(self._pairs.items())[-50:]}
+        return {"pairs": len(self._pairs), "recent": pairs}
+
+XE_ROUTES = XeRouteStats()
+
+def _xe_strong(meta: Dict) -> bool:
+    return meta.get("pick") not in (None, "xe:meta")
+
+def fetch_xe_hedged(frm: str, to: str, amount: Decimal = Decimal(1)) -> Tuple[Optional[Decimal], str, Dict]:
+    pair = f"{frm}-{to}"
+    browser_first, delay = XE_ROUTES.plan(pair)
+    started = time.perf_counter()
+    deadline = started + XE_BROWSER_TIMEOUT
+    pending: Dict = {}            # future -> "requests" | "browser"
+    browser: Optional[_XeBrowserFetch] = None
+    req_started = False
+    hedge_at = started if browser_first else started + delay
+    weak, errors = None, []
+
+    def start_requests():
+        nonlocal req_started
+        req_started = True
+        pending[_XE_HEDGE_POOL.submit(fetch_xe_via_requests, frm, to, amount)] = "requests"
+
+    if not browser_first:
+        start_requests()
+    try:
+        while True:
+            now = time.perf_counter()
+            if browser is None and now >= hedge_at:
+                browser = _XeBrowserFetch(frm, to, amount)
+                if browser.future is not None:
+                    pending[browser.future] = "browser"
+                else:
+                    errors.append(f"browser: {browser.note}")
+                    if not req_started:
+                        start_requests()
+            if not pending:
+                if browser is None:
+                    hedge_at = now          # requests-путь кончился без полноценного курса — браузер сейчас
+                    continue
+                break
+            if now >= deadline:
+                break
+            until = hedge_at if browser is None else deadline
+            done, _ = futures_wait(list(pending), timeout=max(0.0, until - now), return_when=FIRST_COMPLETED)
+            for fut in done:
+                path = pending.pop(fut)
+                try:
+                    price, url, meta = fut.result() if path == "requests" else browser.result()
+                except Exception as e:
+                    errors.append(f"{path}: {type(e).__name__}: {e}")
+                    price, url, meta = None, None, {}
+                valid = bool(price and price > 0)
+                if path == "requests":
+                    XE_ROUTES.static_result(pair, valid and _xe_strong(meta), time.perf_counter() - started)
+                    if valid and not _xe_strong(meta):
+                        weak = weak or (price, url, {**meta, "source": "xe:meta"})
+                        valid = False
+                    if not valid:
+                        hedge_at = min(hedge_at, time.perf_counter())
+                elif not valid and not req_started:
+                    start_requests()        # «браузерная» пара, но браузер не справился — пробуем статику
+                if valid:
+                    XE_ROUTES.win(pair, path)
+                    return price, url, {**meta, "path": path, "hedge_ms": round((time.perf_counter() - started) * 1000, 1)}
+    finally:
+        for fut, path in pending.items():
+            if path == "browser":
+                browser.cancel(failed=time.perf_counter() >= deadline)
+            else:
+                fut.cancel()
+    if weak is not None:
+        XE_ROUTES.win(pair, "meta")
+        return weak[0], weak[1], {**weak[2], "path": "requests"}
+    raise RuntimeError("XE direct: не удалось получить курс" + (f" ({'; '.join(errors)})" if errors else ""))
 
 def fetch_xe_direct(frm: str, to: str) -> Dict:
     frm, to = frm.upper(), to.upper()
     if frm == to:
-        return {"pair": f"{frm}-{to}", "price": 1.0, "url": f"https://www.xe.com/currencyconverter/convert/?Amount=1&From={frm}&To={to}", "ts": int(time.time()), "source": "xe:identity"}
-    amount = Decimal(1)
-    price, url, meta = fetch_xe_via_browser(frm, to, amount)
-    if not price:
-        price, url, meta = fetch_xe_via_requests(frm, to, amount)
-    if not price or price <= 0:
-        raise RuntimeError("XE direct: не удалось получить курс")
-    return {"pair": f"{frm}-{to}", "price": float(price), "url": url, "ts": int(time.time()), "source": meta.get("source") or "xe"}
+        return {"pair": f"{frm}-{to}", "price": 1.0, "url": _xe_url(frm, to), "ts": int(time.time()), "source": "xe:identity"}
+    price, url, meta = fetch_xe_hedged(frm, to)
+    out = {"pair": f"{frm}-{to}", "price": float(price), "url": url, "ts": int(time.time()),
+           "source": meta.get("source") or "xe", "path": meta["path"]}
+    return out
 
 def fetch_xe_universal(frm: str, to: str) -> Dict:
-    A, F = frm.upper(), to.upper()
-    try:
-        return fetch_xe_direct(A, F)
-    except Exception:
-        pass
-    # гибрид
-    if A in XE_STABLES:
-        from_usd = Decimal(1)
-        src_left = "stable≈USD"
-    else:
-        from_usd = None; src_left = None
+    """
+    Курс frm→to по графу кросс-курсов (см. RateGraph): свежие рёбра берутся из кэша,
+    недостающие — докачиваются (XE, при неудаче GF). Прямой XE-курс по-прежнему первый
+    выбор, если готового короткого пути из свежих рёбер нет.
+    """
+    return RATE_GRAPH.convert(frm.upper(), to.upper())
+
+# ====================== Граф кросс-курсов ===========================
+# Вершины — коды валют, рёбра — наблюдённые курсы с возрастом: XE/GF (в т.ч. ноги прежних
+# конвертаций), стейблы ≈ USD, P2P-середина (BUY+SELL)/2 без фильтров оплат. Каждое ребро
+# даёт и обратное 1/r. Путь ищется Дейкстрой: цена ребра = 1 (переход) + возраст/TTL + штраф
+# качества; ребро, которого нет в кэше, тоже кандидат, но его цена — GRAPH_FETCH_COST
+# (поход в XE/GF) плюс тот же штраф качества. Поэтому KZT→GEL через USD, чьи ноги получены секунду назад, считается
+# без единого запуска браузера, а при пустом кэше первым идёт прямой XE-курс, как и раньше.
+GRAPH_TTL = {
+    "xe":     float(os.getenv("P2P_GRAPH_TTL_XE", "120")),
+    "gf":     float(os.getenv("P2P_GRAPH_TTL_GF", "120")),
+    "p2p":    float(os.getenv("P2P_GRAPH_TTL_P2P", "120")),
+    "stable": float("inf"),
+}
+# GF и P2P дороже похода в XE: дэшборд сравнивает P2P с XE и GF как с независимыми
+# ориентирами, поэтому XE-курс не должен молча превращаться в GF или в ту же P2P-середину —
+# они только запасной путь, когда XE по нужным ногам не отвечает
+GRAPH_QUALITY    = {"xe": 0.0, "gf": 3.5, "p2p": 6.0, "stable": 0.2}
+GRAPH_INVERSE    = 0.1                                  # обратное ребро чуть хуже прямого
+GRAPH_FETCH_COST = {"xe": 4.0, "gf": 5.0}               # GF — только если XE по ноге не ответил
+GRAPH_FAIL_TTL   = float(os.getenv("P2P_GRAPH_FAIL_TTL", "120"))
+GRAPH_HUBS       = [c.strip().upper() for c in os.getenv("P2P_GRAPH_HUBS", "USD").split(",") if c.strip()]
+GRAPH_MAX_ROUNDS = 4
+
+_GRAPH_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="graph")
+
+class RateGraph:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._edges: Dict[Tuple[str, str], Tuple[Decimal, float, str, str, bool]] = {}   # (u, v) -> (rate, at, kind, detail, inverse)
+        self._failed: Dict[Tuple[str, str, str], float] = {}                            # (kind, u, v) -> когда не удалось
+        self._p2p: Dict[Tuple[str, str, str], Dict[str, Tuple[Decimal, float]]] = {}
+        self.solved = self.fetched_edges = self.cached_paths = 0
+        # стейблы ≈ USD: постоянные рёбра; реальный курс XE/GF по такой паре их заменит
+        for code in XE_STABLES:
+            self.add(code, "USD", 1, "stable", "stable≈USD", at=0.0)
+
+    # ---- наполнение
+    def add(self, u: str, v: str, rate, kind: str, detail: str, at: Optional[float] = None):
+        rate = _d(rate)
+        if u == v or rate is None or rate <= 0:
+            return
+        at = at if at is not None else time.time()
+        with self._lock:
+            self._edges[(u, v)] = (rate, at, kind, detail, False)
+            inv = self._edges.get((v, u))
+            # прямое наблюдение обратной пары не перетираем выведенным 1/r
+            if inv is None or inv[4] or inv[1] < at:
+                self._edges[(v, u)] = (Decimal(1) / rate, at, kind, detail, True)
+
+    def observe(self, source: str, norm: Dict, data: Dict):
+        """Курс из любого успешного фетча (fetch_quote / asgi) — в граф."""
         try:
-            d = fetch_xe_direct(A, "USD")
-            from_usd = _d(d["price"]); src_left = "xe(A→USD)"
-        except Exception:
-            try:
-                g = fetch_gf(A, "USD")
-                from_usd = _d(g["price"]); src_left = "gf(A→USD)"
-            except Exception:
-                pass
-    usd_to = None; src_right = None
-    try:
-        d2 = fetch_xe_direct("USD", F)
-        usd_to = _d(d2["price"]); src_right = "xe(USD→F)"
-    except Exception:
+            if source == "xe":
+                src = str(data.get("source") or "")
+                # собранные графом/гибридом курсы не наблюдения, а следствия — их не кладём. Ответ из одного
+                # кэшированного ребра несёт source этого ребра ("xe:requests"), поэтому смотрим на graph: иначе
+                # ребро пере-штамповалось бы «сейчас» на каждом запросе и никогда не устаревало
+                if src.startswith("xe:") and src != "xe:identity" and not data.get("graph"):
+                    self.add(norm["from"], norm["to"], data.get("price"), "xe", src)
+            elif source == "gf":
+                self.add(norm["asset"], norm["fiat"], data.get("price"), "gf", "gf")
+            elif source in ("binance", "bybit"):
+                if norm.get("pay_types") or norm.get("payments") or data.get("avg") is None:
+                    return
+                now = time.time()
+                with self._lock:
+                    sides = self._p2p.setdefault((source, norm["asset"], norm["fiat"]), {})
+                    avg = data.avg_decimal() if isinstance(data, QuoteBook) else _d(data["avg"])
+                    sides[norm["side"]] = (avg, now)
+                    buy, sell = sides.get("BUY"), sides.get("SELL")
+                if buy and sell and now - min(buy[1], sell[1]) <= GRAPH_TTL["p2p"]:
+                    self.add(norm["asset"], norm["fiat"], (buy[0] + sell[0]) / 2, "p2p", f"p2p:{source}",
+                             at=min(buy[1], sell[1]))
+        except (KeyError, TypeError, ArithmeticError):
+            pass
+
+    # ---- поиск пути
+    def _edge_cost(self, edge, now: float) -> Optional[float]:
+        rate, at, kind, _, inverse = edge
+        ttl = GRAPH_TTL[kind]
+        age = now - at
+        if age > ttl:
+            return None
+        return 1.0 + (0.0 if ttl == float("inf") else age / ttl) + GRAPH_QUALITY[kind] + (GRAPH_INVERSE if inverse else 0.0)
+
+    def _solve(self, A: str, F: str) -> Optional[List[Tuple[str, str, Optional[str]]]]:
+        """Путь [(u, v, None | вид докачки)] минимальной цены или None."""
+        now = time.time()
+        adj: Dict[str, List[Tuple[str, float, Optional[str]]]] = {}
+        with self._lock:
+            for (u, v), edge in self._edges.items():
+                cost = self._edge_cost(edge, now)
+                if cost is not None:
+                    adj.setdefault(u, []).append((v, cost, None))
+            failed = {k for k, at in self._failed.items() if now - at <= GRAPH_FAIL_TTL}
+        # рёбра-кандидаты на докачку — только между концами пути и хабами; если такое ребро
+        # уже есть в кэше, Дейкстра сама выберет, что дешевле: свежий кэш или новый запрос
+        ends = [A, F] + [h for h in GRAPH_HUBS if h not in (A, F)]
+        for u in ends:
+            for v in ends:
+                if u == v:
+                    continue
+                for kind, cost in GRAPH_FETCH_COST.items():
+                    if (kind, u, v) not in failed:
+                        adj.setdefault(u, []).append((v, cost + GRAPH_QUALITY[kind], kind))
+
+        dist = {A: 0.0}
+        prev: Dict[str, Tuple[str, Optional[str]]] = {}
+        heap = [(0.0, A)]
+        while heap:
+            d, u = heapq.heappop(heap)
+            if u == F:
+                break
+            if d > dist.get(u, float("inf")):
+                continue
+            for v, cost, fetch in adj.get(u, ()):
+                nd = d + cost
+                if nd < dist.get(v, float("inf")):
+                    dist[v] = nd
+                    prev[v] = (u, fetch)
+                    heapq.heappush(heap, (nd, v))
+        if F not in dist:
+            return None
+        path, node = [], F
+        while node != A:
+            u, fetch = prev[node]
+            path.append((u, node, fetch))
+            node = u
+        return path[::-1]
+
+    # ---- докачка ребра
+    def _fetch_edge(self, kind: str, u: str, v: str):
+        key = f"edge:{kind}:{u}-{v}"
         try:
-            d3 = fetch_xe_direct(F, "USD")
-            v = _d(d3["price"])
-            if v and v > 0:
-                usd_to = Decimal(1) / v; src_right = "xe(inv F→USD)"
+            if kind == "xe":
+                data, _ = QUOTES.get_or_fetch(key, CACHE_TTL["xe"], lambda: shared_call(
+                    "q:" + key, CACHE_TTL["xe"], lambda: fetch_xe_direct(u, v)), with_time=True)
+                self.add(u, v, data["price"], "xe", data.get("source") or "xe")
+            else:
+                data, _ = QUOTES.get_or_fetch(key, CACHE_TTL["gf"], lambda: shared_call(
+                    "q:" + key, CACHE_TTL["gf"], lambda: fetch_gf(u, v)), with_time=True)
+                self.add(u, v, data["price"], "gf", "gf")
+            self.fetched_edges += 1
+            return True
         except Exception:
-            pass
-    if not from_usd or from_usd <= 0 or not usd_to or usd_to <= 0:
+            with self._lock:
+                self._failed[(kind, u, v)] = time.time()
+            return False
+
+    def convert(self, A: str, F: str) -> Dict:
+        url = _xe_url(A, F)
+        if A == F:
+            return {"pair": f"{A}-{F}", "price": 1.0, "url": url, "ts": int(time.time()), "source": "xe:identity"}
+        for _ in range(GRAPH_MAX_ROUNDS):
+            path = self._solve(A, F)
+            if path is None:
+                break
+            missing = [(kind, u, v) for u, v, kind in path if kind is not None]
+            if missing:
+                # недостающие ноги — одновременно; неудачные помечаются и путь пересчитывается
+                oks = list(_GRAPH_POOL.map(lambda m: self._fetch_edge(*m), missing))
+                if not all(oks):
+                    continue
+                path = [(u, v, None) for u, v, _ in path]
+            else:
+                self.cached_paths += 1
+            legs, price = [], Decimal(1)
+            with self._lock:
+                edges = [self._edges.get((u, v)) for u, v, _ in path]
+            if any(e is None for e in edges):
+                continue
+            for (u, v, _), (rate, at, kind, detail, inverse) in zip(path, edges):
+                price *= rate
+                # время ребра, а не его возраст: пока рёбра те же, и ответ байт-в-байт тот же (ETag, поток)
+                legs.append({"from": u, "to": v, "rate": float(rate), "source": detail,
+                             "inverse": inverse, "at": int(at)})
+            self.solved += 1
+            single = len(legs) == 1 and not legs[0]["inverse"]
+            return {
+                "pair": f"{A}-{F}", "price": float(price), "url": url, "ts": int(time.time()),
+                "source": legs[0]["source"] if single else
+                          "graph:" + "×".join(f"{l['source']}({l['from']}→{l['to']})" for l in legs),
+                "path": legs, "graph": True,
+            }
         raise RuntimeError("XE hybrid: не удалось собрать кросс-курс")
-    price = from_usd * usd_to
-    return {"pair": f"{A}-{F}", "price": float(price), "url": f"https://www.xe.com/currencyconverter/convert/?Amount=1&From={A}&To={F}", "ts": int(time.time()), "source": f"hybrid:{src_left}×{src_right}"}
+
+    def stats(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            fresh = sum(1 for e in self._edges.values() if self._edge_cost(e, now) is not None and not e[4])
+            failed = sum(1 for at in self._failed.values() if now - at <= GRAPH_FAIL_TTL)
+            return {"edges": fresh, "failed_recent": failed, "solved": self.solved,
+                    "fetched_edges": self.fetched_edges, "from_cache": self.cached_paths}
+
+RATE_GRAPH = RateGraph()
+
+# ====================== Справочники: ленивая сборка и кэш ==========
+# Справочники (методы оплаты Bybit, коды XE) собираются при первом обращении, а не при импорте.
+# P2P_CATALOG_CACHE=<каталог> вдобавок сохраняет собранный снимок в pickle с ключом
+# (путь, mtime_ns, размер исходника, версия формата) — следующий процесс читает готовое вместо
+# разбора. Кэш пишет само приложение; каталог должен быть доступен на запись только ему.
+CATALOG_CACHE_DIR     = os.getenv("P2P_CATALOG_CACHE", "").strip()
+CATALOG_CACHE_VERSION = 1
+_CATALOG_LOCK         = threading.Lock()
+CATALOG_CACHE_STATS   = {"hits": 0, "builds": 0, "errors": 0, "last_error": None}
+
+def _catalog_event(counter: str, error: Optional[str] = None):
+    with _CATALOG_LOCK:
+        CATALOG_CACHE_STATS[counter] += 1
+        if error is not None:
+            CATALOG_CACHE_STATS["last_error"] = error
+
+def catalog_cache_stats() -> Optional[Dict]:
+    if not CATALOG_CACHE_DIR:
+        return None
+    with _CATALOG_LOCK:
+        return {"dir": CATALOG_CACHE_DIR, **CATALOG_CACHE_STATS}
+
+def load_catalog(name: str, path: Optional[str], build: Callable[[Optional[str]], object]):
+    """build(path) через кэш P2P_CATALOG_CACHE; без кэша или без исходного файла — просто build(path)."""
+    if not CATALOG_CACHE_DIR or not path:
+        return build(path)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return build(path)
+    key = (os.path.abspath(path), st.st_mtime_ns, st.st_size, CATALOG_CACHE_VERSION)
+    cache = Path(CATALOG_CACHE_DIR) / f"{name}.pickle"
+    try:
+        with open(cache, "rb") as f:
+            cached_key, value = pickle.load(f)
+        if cached_key == key:
+            _catalog_event("hits")
+            return value
+    except FileNotFoundError:
+        pass
+    except Exception as e:                      # битый/чужой формат — пересобираем и перезаписываем
+        _catalog_event("errors", f"{cache}: {type(e).__name__}: {e}")
+    value = build(path)
+    _catalog_event("builds")
+    try:
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        tmp = cache.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump((key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache)
+    except OSError as e:
+        _catalog_event("errors", f"{cache}: {e}")
+    return value
 
 # ====================== Bybit payments (из TXT) =================
-BYBIT_PAYMENTS_MAP: Dict[str, List[Dict[str,str]]] = {}
-def _load_bybit_payments_from_txt():
+# Файл компилируется один раз в снимок: списки по фиату уже отсортированы, есть id → имя,
+# индексы для поиска по началу названия и по началу слова (bisect), готовое тело ответа и ETag.
+# Изменился mtime — новый снимок собирается в фоне и подменяется целиком; запросы всё это
+# время обслуживает старый.
+BYBIT_PAYMENTS_CHECK_EVERY = float(os.getenv("P2P_BYBIT_PAYMENTS_CHECK", "5"))
+BYBIT_SEARCH_LIMIT         = 50
+
+def _bybit_payments_path() -> Optional[str]:
     path_local = os.path.join(os.path.dirname(__file__), "bybit_payment_methods.txt")
     path_alt   = "/mnt/data/bybit_payment_methods.txt"
-    path = path_local if os.path.exists(path_local) else (path_alt if os.path.exists(path_alt) else None)
-    if not path:
-        return
+    return path_local if os.path.exists(path_local) else (path_alt if os.path.exists(path_alt) else None)
+
+def _parse_bybit_payments(f) -> Dict[str, List[Dict[str, str]]]:
+    """Формат «=== UAH ===» и строки «id название» — разбор строковыми методами, без regex на строку."""
+    out: Dict[str, List[Dict[str, str]]] = {}
     current = None
-    with open(path, "r", encoding="utf-8") as f:
-        for line in f:
-            line = line.rstrip("\n")
-            head = re.match(r"^===\s*([A-Z]{3})\s*===", line)
-            if head:
-                current = head.group(1).upper()
-                BYBIT_PAYMENTS_MAP[current] = []
+    for line in f:
+        if line.startswith("==="):
+            body = line[3:].lstrip()
+            code = body[:3]
+            if code.isascii() and code.isalpha() and code.isupper() and body[3:].lstrip().startswith("==="):
+                current = code
+                out[current] = []
                 continue
-            if not line.strip() or current is None:
-                continue
-            m = re.match(r"^\s*([0-9]+)\s+(.+?)\s*$", line)
-            if m:
-                BYBIT_PAYMENTS_MAP[current].append({"id": m.group(1), "name": m.group(2)})
-_load_bybit_payments_from_txt()
+        if current is None:
+            continue
+        parts = line.split(None, 1)
+        if len(parts) == 2 and parts[0].isascii() and parts[0].isdigit():
+            out[current].append({"id": parts[0], "name": parts[1].strip()})
+    return out
+
+class _FiatPayments:
+    __slots__ = ("items", "by_id", "prefix", "words", "body", "etag")
+
+    def __init__(self, fiat: str, items: List[Dict[str, str]]):
+        self.items = sorted(items, key=lambda x: (x["name"].lower(), int(x["id"])))
+        self.by_id = {x["id"]: x["name"] for x in self.items}
+        # (ключ, позиция в items): по названию целиком и по каждому слову
+        self.prefix = [(x["name"].lower(), n) for n, x in enumerate(self.items)]
+        self.words = sorted(
+            (w, n) for n, x in enumerate(self.items) for w in set(re.split(r"[\s\-_/().,]+", x["name"].lower())) if w
+        )
+        self.body = json.dumps({"ok": True, "fiat": fiat, "items": self.items}, ensure_ascii=False,
+                               separators=(",", ":")).encode("utf-8")
+        self.etag = '"' + hashlib.blake2b(self.body, digest_size=12).hexdigest() + '"'
+
+    @staticmethod
+    def _range(index: List[Tuple[str, int]], q: str) -> List[int]:
+        lo = bisect.bisect_left(index, (q, -1))
+        hi = bisect.bisect_left(index, (q + "\uffff", -1))
+        return [n for _, n in index[lo:hi]]
+
+    def search(self, q: str, limit: int) -> List[Dict[str, str]]:
+        """Сначала совпадения с начала названия, затем с начала любого слова — в порядке каталога."""
+        q = q.strip().lower()
+        if not q:
+            return self.items[:limit]
+        first = sorted(self._range(self.prefix, q))
+        seen = set(first)
+        rest = sorted(n for n in set(self._range(self.words, q)) if n not in seen)
+        return [self.items[n] for n in (first + rest)[:limit]]
+
+def _build_bybit_payments(path: str) -> Tuple[Dict[str, List[Dict[str, str]]], Dict[str, _FiatPayments]]:
+    with open(path, "r", encoding="utf-8") as f:
+        raw = _parse_bybit_payments(f)
+    return raw, {fiat: _FiatPayments(fiat, items) for fiat, items in raw.items()}
+
+class BybitPaymentCatalog:
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.mtime: Optional[float] = None
+        self.raw: Dict[str, List[Dict[str, str]]] = {}
+        self.fiats: Dict[str, _FiatPayments] = {}
+        self.loaded_at: Optional[float] = None
+        self.reloads = 0
+        self.last_error: Optional[str] = None
+        self._checked = 0.0
+        self._reloading = threading.Lock()
+        self._ready = False
+        self._init_lock = threading.Lock()
+
+    def _compile(self):
+        path = _bybit_payments_path()
+        if not path:
+            return
+        mtime = os.path.getmtime(path)
+        raw, fiats = load_catalog("bybit_payments", path, _build_bybit_payments)
+        # подмена ссылками — читатели видят либо старый снимок, либо новый целиком
+        self.path, self.raw, self.fiats, self.mtime = path, raw, fiats, mtime
+        self.loaded_at = time.time()
+        global BYBIT_PAYMENTS_MAP
+        BYBIT_PAYMENTS_MAP = raw
+
+    def load(self):
+        try:
+            self._compile()
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)
+
+    def ensure_loaded(self):
+        """Первая сборка — при первом обращении (get/name), а не при импорте модуля."""
+        if self._ready:
+            return
+        with self._init_lock:
+            if not self._ready:
+                self.load()
+                self._checked = time.monotonic()
+                self._ready = True
+
+    def _reload_bg(self):
+        try:
+            self._compile()
+            self.reloads += 1
+            self.last_error = None
+        except (OSError, ValueError) as e:
+            self.last_error = str(e)
+        finally:
+            self._reloading.release()
+
+    def maybe_reload(self):
+        """Дёшево: stat не чаще раза в BYBIT_PAYMENTS_CHECK_EVERY, пересборка — в отдельном потоке."""
+        now = time.monotonic()
+        if now - self._checked < BYBIT_PAYMENTS_CHECK_EVERY:
+            return
+        self._checked = now
+        path = _bybit_payments_path()
+        try:
+            mtime = os.path.getmtime(path) if path else None
+        except OSError:
+            return
+        if mtime is None or (mtime == self.mtime and path == self.path):
+            return
+        if self._reloading.acquire(blocking=False):
+            threading.Thread(target=self._reload_bg, name="bybit-payments-reload", daemon=True).start()
+
+    def get(self, fiat: str) -> _FiatPayments:
+        self.ensure_loaded()
+        self.maybe_reload()
+        entry = self.fiats.get(fiat)
+        return entry if entry is not None else _FiatPayments(fiat, [])
+
+    def name(self, fiat: str, ident: str) -> Optional[str]:
+        self.ensure_loaded()
+        entry = self.fiats.get(fiat)
+        return entry.by_id.get(str(ident)) if entry is not None else None
+
+    def stats(self) -> Dict:
+        return {"loaded": self._ready, "path": self.path, "fiats": len(self.fiats), "methods": sum(len(x.items) for x in self.fiats.values()),
+                "loaded_at": self.loaded_at, "reloads": self.reloads, "last_error": self.last_error}
+
+BYBIT_PAYMENTS = BybitPaymentCatalog()
 
 # ====================== XE codes ===============================
-XE_CODES: List[str] = []
-def _load_xe_codes():
-    global XE_CODES
-    fname_local = os.path.join(os.path.dirname(__file__), "xe_rates.json")
-    fname_alt   = "/mnt/data/xe_rates.json"
-    path = fname_local if os.path.exists(fname_local) else (fname_alt if os.path.exists(fname_alt) else None)
+def _load_xe_codes(path: Optional[str]) -> List[str]:
+    codes: List[str] = []
     if path:
         try:
             with open(path, "r", encoding="utf-8") as f:
                 js = json.load(f)
                 rates = js.get("rates", {})
                 if isinstance(rates, dict):
-                    XE_CODES = sorted({k.upper().strip() for k in rates.keys() if isinstance(k, str)})
+                    codes = sorted({k.upper().strip() for k in rates.keys() if isinstance(k, str)})
         except Exception:
-            XE_CODES = []
-    if not XE_CODES:
-        XE_CODES = sorted(list({
+            codes = []
+    if not codes:
+        codes = sorted(list({
             "USD","EUR","UAH","RUB","KZT","BYN","KGS","TJS","GEL","TRY","PLN","GBP","CZK","RON","MDL","HUF","AED","CNY","JPY","KRW","INR",
             "XAU","XAG","XPT","XPD","XDR",
             "BTC","ETH","BNB","SOL","ADA","XRP","LTC","DOGE","DOT","LINK",
             "USDT","USDC","DAI","TUSD","EURC","USDP"
         }))
-_load_xe_codes()
+    return codes
+
+@lru_cache(maxsize=None)
+def xe_codes() -> List[str]:
+    fname_local = os.path.join(os.path.dirname(__file__), "xe_rates.json")
+    fname_alt   = "/mnt/data/xe_rates.json"
+    path = fname_local if os.path.exists(fname_local) else (fname_alt if os.path.exists(fname_alt) else None)
+    return load_catalog("xe_codes", path, _load_xe_codes)
+
+def __getattr__(name: str):
+    # прежние модульные имена справочников: теперь собираются по первому обращению
+    if name == "XE_CODES":
+        return xe_codes()
+    if name == "BYBIT_PAYMENTS_MAP":
+        BYBIT_PAYMENTS.ensure_loaded()
+        return globals().get("BYBIT_PAYMENTS_MAP", {})
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# ====================== Кэш котировок (TTL + LRU + single-flight) ======
+# Ключ — нормализованные параметры запроса; одинаковые запросы из разных вкладок
+# получают один и тот же ответ, а одновременные промахи делят один upstream-вызов.
+CACHE_MAX_ENTRIES = int(os.getenv("P2P_CACHE_SIZE", "512"))
+CACHE_TTL = {
+    "binance": float(os.getenv("P2P_TTL_BINANCE", "10")),
+    "bybit":   float(os.getenv("P2P_TTL_BYBIT", "10")),
+    "gf":      float(os.getenv("P2P_TTL_GF", "30")),
+    "xe":      float(os.getenv("P2P_TTL_XE", "60")),
+    "binance_depth": float(os.getenv("P2P_TTL_DEPTH", "15")),
+    "bybit_depth":   float(os.getenv("P2P_TTL_DEPTH", "15")),
+}
+
+class _Flight:
+    """Один идущий upstream-вызов, на результат которого ждут остальные."""
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+class QuoteCache:
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._inflight: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.coalesced = self.evictions = self.stale = 0
+
+    def get(self, key: str, ttl: float) -> Optional[Tuple[Dict, float]]:
+        """(value, age) если запись свежее ttl, иначе None."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            age = time.time() - stored_at
+            if age > ttl:
+                return None
+            self._data.move_to_end(key)
+            return value, age
+
+    def put(self, key: str, value: Dict, stored_at: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (stored_at if stored_at is not None else time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def count(self, counter: str, n: int = 1):
+        """Учёт попаданий для внешних путей (асинхронный single-flight в asgi.py)."""
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + n)
+
+    def get_or_fetch(self, key: str, ttl: float, fn: Callable[[], Dict], with_time: bool = False) -> Tuple[Dict, Dict]:
+        """
+        Отдаёт свежую запись из кэша либо выполняет fn() — но только в одном потоке на ключ:
+        остальные ждут его результата (или его исключения).
+        with_time=True: fn() возвращает (value, stored_at) — значение могло быть получено раньше
+        (общее хранилище), и возраст считается от stored_at.
+        Возвращает (value, {"cached": bool, "age": сек}).
+        """
+        hit = self.get(key, ttl)
+        if hit is not None:
+            with self._lock:
+                self.hits += 1
+            return hit[0], {"cached": True, "age": round(hit[1], 3)}
+
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value, {"cached": True, "age": 0.0}
+
+        try:
+            if with_time:
+                started = time.time()
+                flight.value, stored_at = fn()
+                self.put(key, flight.value, stored_at)
+                if stored_at < started:
+                    return flight.value, {"cached": True, "age": round(time.time() - stored_at, 3), "shared": True}
+                return flight.value, {"cached": False, "age": 0.0}
+            flight.value = fn()
+            self.put(key, flight.value)
+            return flight.value, {"cached": False, "age": 0.0}
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses + self.coalesced
+            return {
+                "entries": len(self._data), "max_entries": self.max_entries,
+                "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                "evictions": self.evictions, "stale": self.stale, "inflight": len(self._inflight),
+                "hit_ratio": round((self.hits + self.coalesced) / total, 4) if total else None,
+            }
+
+QUOTES = QuoteCache()
+
+# ---- Реестр источников: нормализация параметров + вызов фетчера
+def _flag(v, default: bool = False) -> bool:
+    if v is None:
+        return default
+    if isinstance(v, bool):
+        return v
+    return str(v).strip().lower() == "true"
+
+def _csv_list(v) -> List[str]:
+    """'a,b' | ['a','b'] → отсортированный список без дублей и пустых."""
+    if not v:
+        return []
+    parts = v.split(",") if isinstance(v, str) else list(v)
+    return sorted({str(x).strip() for x in parts if str(x).strip()})
+
+def _amount_str(v) -> str:
+    """'20000' / '20000.00' / 20000 → '20000' (один ключ кэша на одну сумму)."""
+    raw = str(v if v is not None else "20000").strip()
+    try:
+        d = Decimal(raw)
+    except InvalidOperation:
+        return raw
+    return format(d.normalize(), "f") if d == d.to_integral_value() else format(d, "f")
+
+def _amounts_list(v) -> List[str]:
+    """'100000,5000,5000.00' → ['5000', '100000']: по возрастанию, без дублей."""
+    vals = {_amount_str(x) for x in _csv_list(v)} if v else {_amount_str(None)}
+    return sorted((x for x in vals if _d(x) is not None), key=lambda x: _d(x))
+
+def _depth_pages(v) -> int:
+    try:
+        return max(1, min(int(v), DEPTH_MAX_PAGES))
+    except (TypeError, ValueError):
+        return DEPTH_MAX_PAGES
+
+QUOTE_SOURCES: Dict[str, Tuple[Callable[[Dict], Dict], Callable[[Dict], Dict]]] = {
+    "binance": (
+        lambda p: {
+            "asset": str(p.get("asset") or "USDT").upper(), "fiat": str(p.get("fiat") or "UAH").upper(),
+            "side": str(p.get("side") or "SELL").upper(), "amount": _amount_str(p.get("amount")),
+            "pay_types": _csv_list(p.get("pay_types")), "merchant": _flag(p.get("merchant"), True),
+        },
+        lambda p: fetch_binance(p["asset"], p["fiat"], p["side"], p["pay_types"], p["amount"], rows=10, merchant=p["merchant"]),
+    ),
+    "bybit": (
+        lambda p: {
+            "asset": str(p.get("asset") or "USDT").upper(), "fiat": str(p.get("fiat") or "UAH").upper(),
+            "side": str(p.get("side") or "SELL").upper(), "amount": _amount_str(p.get("amount")),
+            "payments": _csv_list(p.get("payments")), "verified": _flag(p.get("verified"), False),
+        },
+        lambda p: fetch_bybit(p["asset"], p["fiat"], p["side"], p["payments"], p["amount"], rows=10, verified=p["verified"]),
+    ),
+    "binance_depth": (
+        lambda p: {
+            "asset": str(p.get("asset") or "USDT").upper(), "fiat": str(p.get("fiat") or "UAH").upper(),
+            "side": str(p.get("side") or "SELL").upper(), "amounts": _amounts_list(p.get("amounts")),
+            "volume": _amount_str(p["volume"]) if p.get("volume") else "", "pages": _depth_pages(p.get("pages")),
+            "pay_types": _csv_list(p.get("pay_types")), "merchant": _flag(p.get("merchant"), True),
+        },
+        lambda p: fetch_binance_depth(p["asset"], p["fiat"], p["side"], p["pay_types"], p["merchant"],
+                                      p["amounts"], p["volume"], p["pages"]),
+    ),
+    "bybit_depth": (
+        lambda p: {
+            "asset": str(p.get("asset") or "USDT").upper(), "fiat": str(p.get("fiat") or "UAH").upper(),
+            "side": str(p.get("side") or "SELL").upper(), "amounts": _amounts_list(p.get("amounts")),
+            "volume": _amount_str(p["volume"]) if p.get("volume") else "", "pages": _depth_pages(p.get("pages")),
+            "payments": _csv_list(p.get("payments")), "verified": _flag(p.get("verified"), False),
+        },
+        lambda p: fetch_bybit_depth(p["asset"], p["fiat"], p["side"], p["payments"], p["verified"],
+                                    p["amounts"], p["volume"], p["pages"]),
+    ),
+    "gf": (
+        lambda p: {"asset": str(p.get("asset") or "USD").upper(), "fiat": str(p.get("fiat") or "UAH").upper()},
+        lambda p: fetch_gf(p["asset"], p["fiat"]),
+    ),
+    "xe": (
+        lambda p: {"from": str(p.get("from") or "USD").upper(), "to": str(p.get("to") or "UAH").upper()},
+        lambda p: fetch_xe_universal(p["from"], p["to"]),
+    ),
+}
+
+def normalize_quote_params(source: str, params: Dict) -> Dict:
+    if source not in QUOTE_SOURCES:
+        raise ValueError(f"unknown source: {source}")
+    return QUOTE_SOURCES[source][0](params or {})
+
+def quote_key(source: str, params: Dict) -> str:
+    """Ключ по уже нормализованным параметрам."""
+    return source + ":" + json.dumps(params, sort_keys=True, separators=(",", ":"))
+
+def observe_quote(key: str, source: str, norm: Dict, data: Dict):
+    """Всё, что узнаём из свежего upstream-ответа: история и граф кросс-курсов."""
+    HISTORY.record(key, source, norm, data)
+    RATE_GRAPH.observe(source, norm, data)
+
+def fetch_quote(source: str, norm: Dict, key: Optional[str] = None) -> Dict:
+    """Прямой upstream-вызов источника; успешный результат уходит в историю (без ожидания записи)."""
+    FETCH_INFLIGHT.inc(source)
+    t0 = time.perf_counter()
+    try:
+        data = QUOTE_SOURCES[source][1](norm)
+    except Exception as e:
+        observe_fetch(source, time.perf_counter() - t0, e)
+        raise
+    finally:
+        FETCH_INFLIGHT.dec(source)
+    observe_fetch(source, time.perf_counter() - t0)
+    observe_quote(key or quote_key(source, norm), source, norm, data)
+    return data
+
+def get_quote(source: str, params: Dict) -> Tuple[Dict, Dict]:
+    """Котировка источника через общий кэш. Возвращает (data, {"cached", "age"})."""
+    norm = normalize_quote_params(source, params)
+    return get_quote_normalized(source, norm, quote_key(source, norm))
+
+def cached_quote(source: str, key: str) -> Optional[Tuple[Dict, Dict]]:
+    """Снимок поллера или свежая запись кэша — без upstream-вызова; None, если нет."""
+    snap = POLLER.lookup(key)
+    if snap is not None:
+        return snap
+    hit = QUOTES.get(key, CACHE_TTL[source])
+    if hit is None:
+        return None
+    QUOTES.count("hits")
+    return hit[0], {"cached": True, "age": round(hit[1], 3)}
+
+def get_quote_normalized(source: str, norm: Dict, key: str) -> Tuple[Dict, Dict]:
+    snap = POLLER.lookup(key)
+    if snap is not None:
+        return snap
+    if GUARDS.source_open(source):
+        return _stale_or_raise(source, key)
+    try:
+        ttl = CACHE_TTL[source]
+        return QUOTES.get_or_fetch(key, ttl, lambda: shared_call("q:" + key, ttl, lambda: fetch_quote(source, norm, key)),
+                                   with_time=True)
+    except Exception:
+        # этот сбой мог как раз разомкнуть цепь — тогда лучше старое значение, чем ошибка
+        if GUARDS.source_open(source) and QUOTES.get(key, STALE_MAX_AGE) is not None:
+            return _stale_or_raise(source, key)
+        raise
+
+def _stale_or_raise(source: str, key: str) -> Tuple[Dict, Dict]:
+    hit = QUOTES.get(key, STALE_MAX_AGE)
+    if hit is None:
+        raise UpstreamUnavailable(f"{source}: upstream недоступен, в кэше ничего нет")
+    value, age = hit
+    if age <= CACHE_TTL[source]:
+        QUOTES.count("hits")
+        return value, {"cached": True, "age": round(age, 3)}
+    QUOTES.count("stale")
+    return value, {"cached": True, "age": round(age, 3), "stale": True}
+
+# ====================== Общее хранилище (несколько процессов) ===========
+# Под несколькими воркерами (gunicorn -w N, uvicorn --workers N) у каждого процесса свой QUOTES,
+# и каждый сам ходит в Binance/Bybit/XE. P2P_SHARED_STORE подключает общее хранилище:
+#   mmap:[путь]                 — файл с хеш-таблицей в разделяемой памяти, один хост (нужен fcntl, POSIX)
+#   redis://host:port/db        — любой сервер с протоколом Redis (в т.ч. bench/resp_stub.py)
+# В нём лежат снимки котировок (q:<ключ>) и межпроцессные блокировки single-flight: на ключ за TTL
+# в upstream идёт один процесс, остальные ждут его запись. Хранилище недоступно — работаем
+# как раньше, локально (ошибка учитывается в stats, запрос не падает).
+# Справочники из локальных файлов (коды XE, методы оплаты Bybit) в upstream не ходят и остаются в процессе.
+SHARED_STORE_SPEC = os.getenv("P2P_SHARED_STORE", "").strip()
+SHARED_PREFIX     = os.getenv("P2P_SHARED_PREFIX", "p2p:")
+SHARED_LOCK_TTL   = float(os.getenv("P2P_SHARED_LOCK_TTL", "30"))     # дольше этого лидер не держит ключ
+SHARED_WAIT       = float(os.getenv("P2P_SHARED_WAIT", "20"))         # столько ждём чужой результат
+SHARED_POLL       = 0.05
+MMAP_SLOTS        = int(os.getenv("P2P_MMAP_SLOTS", "4096"))
+MMAP_SLOT_SIZE    = int(os.getenv("P2P_MMAP_SLOT_SIZE", "32768"))
+MMAP_PROBE        = 8
+REDIS_TIMEOUT     = float(os.getenv("P2P_REDIS_TIMEOUT", "0.5"))
+REDIS_POOL        = 8
+
+class MmapStore:
+    """
+    Открытая адресация по MMAP_SLOTS слотам фиксированного размера; слот — заголовок
+    (blake2b-хеш ключа, срок жизни, срок блокировки, токен, длина) + значение.
+    Межпроцессная взаимоисключение — fcntl.lockf на первом байте файла, внутри процесса — Lock.
+    Значения больше слота не хранятся (такие ключи остаются локальными).
+    """
+    _HDR = struct.Struct("<16sdd8sI")
+    HDR_SIZE = 64
+
+    def __init__(self, path: Path, slots: int = MMAP_SLOTS, slot_size: int = MMAP_SLOT_SIZE):
+        if not FCNTL_OK:
+            raise RuntimeError("mmap-хранилище требует fcntl (POSIX)")
+        self.path, self.slots, self.slot_size = path, slots, slot_size
+        size = slots * slot_size
+        self._fd = os.open(str(path), os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)          # разреженный файл: память занимают только записанные слоты
+        self._mm = mmap.mmap(self._fd, size)
+        self._tlock = threading.Lock()
+        self.too_big = 0
+
+    def _locked(self):
+        store = self
+
+        class _Guard:
+            def __enter__(self):
+                store._tlock.acquire()
+                fcntl.lockf(store._fd, fcntl.LOCK_EX, 1, 0)
+
+            def __exit__(self, *exc):
+                fcntl.lockf(store._fd, fcntl.LOCK_UN, 1, 0)
+                store._tlock.release()
+        return _Guard()
+
+    def _slot(self, key: str, now: float, create: bool) -> Optional[Tuple[int, Tuple]]:
+        kh = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        home = int.from_bytes(kh[:8], "little") % self.slots
+        free = None
+        for i in range(MMAP_PROBE):
+            off = ((home + i) % self.slots) * self.slot_size
+            hdr = self._HDR.unpack_from(self._mm, off)
+            if hdr[0] == kh:
+                return off, hdr
+            if free is None and (hdr[1] < now and hdr[2] < now):
+                free = off
+        if not create:
+            return None
+        off = free if free is not None else home * self.slot_size      # цепочка полна — вытесняем «домашний» слот
+        hdr = (kh, 0.0, 0.0, b"\0" * 8, 0)
+        self._HDR.pack_into(self._mm, off, *hdr)
+        return off, hdr
+
+    def get(self, key: str) -> Optional[bytes]:
+        now = time.time()
+        with self._locked():
+            found = self._slot(key, now, False)
+            if found is None:
+                return None
+            off, (_, expires, _, _, length) = found
+            if expires < now:
+                return None
+            start = off + self.HDR_SIZE
+            return bytes(self._mm[start:start + length])
+
+    def set(self, key: str, data: bytes, ttl: float):
+        if len(data) > self.slot_size - self.HDR_SIZE:
+            self.too_big += 1
+            return
+        now = time.time()
+        with self._locked():
+            off, (kh, _, lock_until, token, _) = self._slot(key, now, True)
+            start = off + self.HDR_SIZE
+            self._mm[start:start + len(data)] = data
+            self._HDR.pack_into(self._mm, off, kh, now + ttl, lock_until, token, len(data))
+
+    def lock(self, name: str, ttl: float) -> Optional[str]:
+        now = time.time()
+        with self._locked():
+            off, (kh, expires, lock_until, _, length) = self._slot("lock:" + name, now, True)
+            if lock_until >= now:
+                return None
+            token = os.urandom(8)
+            self._HDR.pack_into(self._mm, off, kh, expires, now + ttl, token, length)
+            return token.hex()
+
+    def unlock(self, name: str, token: str):
+        with self._locked():
+            found = self._slot("lock:" + name, time.time(), False)
+            if found is not None and found[1][3].hex() == token:
+                off, (kh, expires, _, _, length) = found
+                self._HDR.pack_into(self._mm, off, kh, expires, 0.0, b"\0" * 8, length)
+
+    def stats(self) -> Dict:
+        return {"backend": "mmap", "file": str(self.path), "slots": self.slots, "slot_size": self.slot_size,
+                "too_big": self.too_big}
+
+class RespError(RuntimeError):
+    pass
+
+class RespStore:
+    """Минимальный клиент протокола Redis (RESP2): GET / SET PX [NX] / DEL, пул соединений."""
+
+    def __init__(self, url: str):
+        u = urlsplit(url)
+        self.host, self.port = u.hostname or "127.0.0.1", u.port or 6379
+        self.password = u.password
+        self.db = int(u.path.strip("/") or 0)
+        self._pool: deque = deque()
+        self._lock = threading.Lock()
+        self.connects = 0
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=REDIS_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile("rb"))
+        self.connects += 1
+        if self.password:
+            self._roundtrip(conn, "AUTH", self.password)
+        if self.db:
+            self._roundtrip(conn, "SELECT", str(self.db))
+        return conn
+
+    @staticmethod
+    def _read(f):
+        line = f.readline()
+        if not line:
+            raise ConnectionError("RESP: соединение закрыто")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RespError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            if n < 0:
+                return None
+            data = f.read(n + 2)
+            return data[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [RespStore._read(f) for _ in range(n)]
+        raise RespError(f"RESP: неизвестный ответ {line!r}")
+
+    @staticmethod
+    def _roundtrip(conn, *args):
+        parts = [b"*%d\r\n" % len(args)]
+        for a in args:
+            b = a if isinstance(a, bytes) else str(a).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(b), b))
+        conn[0].sendall(b"".join(parts))
+        return RespStore._read(conn[1])
+
+    def call(self, *args):
+        with self._lock:
+            conn = self._pool.pop() if self._pool else None
+        try:
+            if conn is None:
+                conn = self._connect()
+            reply = self._roundtrip(conn, *args)
+        except RespError:
+            self._release(conn)
+            raise
+        except Exception:
+            if conn is not None:
+                conn[0].close()
+            raise
+        self._release(conn)
+        return reply
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._pool) < REDIS_POOL:
+                self._pool.append(conn)
+                return
+        conn[0].close()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self.call("GET", SHARED_PREFIX + key)
+
+    def set(self, key: str, data: bytes, ttl: float):
+        self.call("SET", SHARED_PREFIX + key, data, "PX", max(1, int(ttl * 1000)))
+
+    def lock(self, name: str, ttl: float) -> Optional[str]:
+        token = os.urandom(8).hex()
+        ok = self.call("SET", SHARED_PREFIX + "lock:" + name, token, "NX", "PX", max(1, int(ttl * 1000)))
+        return token if ok == "OK" else None
+
+    def unlock(self, name: str, token: str):
+        # GET + DEL без скрипта: если блокировка истекла ровно между ними, снимем чужую —
+        # худшее последствие: ещё один процесс сходит в upstream за тем же ключом
+        lk = SHARED_PREFIX + "lock:" + name
+        if self.call("GET", lk) == token.encode():
+            self.call("DEL", lk)
+
+    def stats(self) -> Dict:
+        return {"backend": "redis", "host": f"{self.host}:{self.port}", "db": self.db,
+                "pool": len(self._pool), "connects": self.connects}
+
+class SharedStore:
+    """Снимки (stored_at + JSON) и single-flight поверх бэкенда; сбои бэкенда не роняют запрос."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = self.misses = self.leads = self.waits = self.errors = 0
+        self.last_error: Optional[str] = None
+
+    def _fail(self, e: Exception):
+        self.errors += 1
+        self.last_error = f"{type(e).__name__}: {e}"
+
+    def get(self, name: str, ttl: float) -> Optional[Tuple[object, float]]:
+        try:
+            raw = self.backend.get(name)
+        except Exception as e:
+            self._fail(e)
+            return None
+        if not raw:
+            return None
+        stored_at = struct.unpack_from("<d", raw)[0]
+        if time.time() - stored_at > ttl:
+            return None
+        return json.loads(raw[8:]), stored_at
+
+    def put(self, name: str, value, stored_at: float, ttl: float):
+        try:
+            self.backend.set(name, struct.pack("<d", stored_at) + dumps_bytes(value), ttl)
+        except Exception as e:
+            self._fail(e)
+
+    def lock(self, name: str) -> Tuple[bool, Optional[str]]:
+        """(получили?, токен). Бэкенд недоступен — считаем, что получили (работаем локально)."""
+        try:
+            token = self.backend.lock(name, SHARED_LOCK_TTL)
+        except Exception as e:
+            self._fail(e)
+            return True, None
+        return token is not None, token
+
+    def unlock(self, name: str, token: Optional[str]):
+        if token is None:
+            return
+        try:
+            self.backend.unlock(name, token)
+        except Exception as e:
+            self._fail(e)
+
+    def stats(self) -> Dict:
+        return {**self.backend.stats(), "hits": self.hits, "misses": self.misses, "leads": self.leads,
+                "waits": self.waits, "errors": self.errors, "last_error": self.last_error}
+
+def open_shared_store(spec: str) -> Optional[SharedStore]:
+    if not spec:
+        return None
+    if spec.startswith("mmap:"):
+        rest = spec[len("mmap:"):]
+        rest = rest[2:] if rest.startswith("//") else rest
+        return SharedStore(MmapStore(Path(rest) if rest else BASE_DIR / "p2p_shared.mmap"))
+    if spec.startswith(("redis://", "resp://")):
+        return SharedStore(RespStore(spec))
+    raise ValueError(f"P2P_SHARED_STORE: неизвестное хранилище {spec!r} (mmap:путь | redis://host:port/db)")
+
+STORE = open_shared_store(SHARED_STORE_SPEC)
+
+def shared_call(name: str, ttl: float, fn: Callable[[], object]) -> Tuple[object, float]:
+    """
+    (значение, stored_at): свежее значение name из общего хранилища, иначе fn() — но во всех
+    процессах только один вызов на ключ: кто взял блокировку, тот и идёт, остальные ждут его запись.
+    Без хранилища — просто (fn(), сейчас).
+    """
+    if STORE is None:
+        return fn(), time.time()
+    deadline = time.monotonic() + SHARED_WAIT
+    while True:
+        hit = STORE.get(name, ttl)
+        if hit is not None:
+            STORE.hits += 1
+            return hit
+        got, token = STORE.lock(name)
+        if got:
+            try:
+                hit = STORE.get(name, ttl)          # лидер мог записать между get и lock
+                if hit is not None:
+                    STORE.hits += 1
+                    return hit
+                STORE.misses += 1
+                STORE.leads += 1
+                value = fn()
+                now = time.time()
+                STORE.put(name, value, now, ttl)
+                return value, now
+            finally:
+                STORE.unlock(name, token)
+        if time.monotonic() >= deadline:
+            STORE.misses += 1
+            return fn(), time.time()                # лидер завис — не ждём дольше SHARED_WAIT
+        STORE.waits += 1
+        time.sleep(SHARED_POLL)
+
+# ====================== История котировок (SQLite WAL) ================
+# Каждый upstream-результат ставится в очередь, отдельный поток пишет пачками —
+# запрос не ждёт диска. Формат компактный: словарь рядов (series) + таблица точек
+# WITHOUT ROWID с ключом (series, ts), т.е. диапазон по ряду — это один проход по B-дереву.
+# Сырые точки живут HISTORY_RAW_DAYS, дальше сворачиваются в 5-минутные OHLC-бакеты.
+HISTORY_ENABLED    = os.getenv("P2P_HISTORY", "1") != "0"
+HISTORY_DB         = Path(os.getenv("P2P_HISTORY_DB", str(BASE_DIR / "p2p_history.sqlite3")))
+HISTORY_FLUSH      = float(os.getenv("P2P_HISTORY_FLUSH", "1"))        # сек между пачками
+HISTORY_QUEUE_MAX  = 10000                                              # сверх — точки отбрасываются
+HISTORY_RAW_DAYS   = float(os.getenv("P2P_HISTORY_RAW_DAYS", "7"))
+HISTORY_AGG_DAYS   = float(os.getenv("P2P_HISTORY_AGG_DAYS", "365"))
+HISTORY_AGG_STEP   = 300
+HISTORY_MAINT_EVERY = 600
+HISTORY_MAX_POINTS = 5000
+
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS series (
+    id     INTEGER PRIMARY KEY,
+    key    TEXT NOT NULL UNIQUE,
+    source TEXT NOT NULL,
+    pair   TEXT NOT NULL,
+    side   TEXT NOT NULL DEFAULT ''
+);
+CREATE INDEX IF NOT EXISTS series_lookup ON series(source, pair, side);
+CREATE TABLE IF NOT EXISTS points (
+    series INTEGER NOT NULL,
+    ts     INTEGER NOT NULL,            -- мс
+    price  REAL NOT NULL,               -- P2P: avg по 3-5 объявлениям; GF/XE: курс
+    best   REAL,                        -- P2P: лучшая цена стакана
+    PRIMARY KEY (series, ts)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS points_agg (
+    series INTEGER NOT NULL,
+    bucket INTEGER NOT NULL,            -- мс, кратно HISTORY_AGG_STEP
+    open REAL, high REAL, low REAL, close REAL,
+    total REAL NOT NULL,                -- сумма цен: среднее по бакетам остаётся точным
+    n    INTEGER NOT NULL,
+    PRIMARY KEY (series, bucket)
+) WITHOUT ROWID;
+"""
+
+def _history_point(source: str, norm: Dict, data: Dict) -> Optional[Tuple[str, str, float, Optional[float]]]:
+    """(pair, side, price, best) из ответа фетчера; None, если цены нет."""
+    if source in ("binance", "bybit"):
+        prices = data.get("prices") or []
+        price = data.get("avg")
+        if price is None:
+            return None
+        return f"{norm['asset']}-{norm['fiat']}", norm["side"], float(price), (float(prices[0]) if prices else None)
+    price = data.get("price")
+    if price is None:
+        return None
+    pair = f"{norm['from']}-{norm['to']}" if source == "xe" else f"{norm['asset']}-{norm['fiat']}"
+    return pair, "", float(price), None
+
+class HistoryStore:
+    def __init__(self, path: Path, enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self._queue: deque = deque()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._series: Dict[str, int] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._last_maint = 0.0
+        self.written = self.dropped = self.batches = 0
+        self.last_error: Optional[str] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(str(self.path), timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    # ---- запись (вызывается из запросов — только очередь)
+    def record(self, key: str, source: str, norm: Dict, data: Dict):
+        if not self.enabled:
+            return
+        point = _history_point(source, norm, data)
+        if point is None:
+            return
+        if len(self._queue) >= HISTORY_QUEUE_MAX:
+            self.dropped += 1
+            return
+        self._queue.append((key, source, *point, int(time.time() * 1000)))
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+                    self._thread.start()
+
+    def _series_id(self, conn: sqlite3.Connection, key: str, source: str, pair: str, side: str) -> int:
+        sid = self._series.get(key)
+        if sid is None:
+            conn.execute("INSERT OR IGNORE INTO series(key, source, pair, side) VALUES (?, ?, ?, ?)",
+                         (key, source, pair, side))
+            sid = conn.execute("SELECT id FROM series WHERE key = ?", (key,)).fetchone()[0]
+            self._series[key] = sid
+        return sid
+
+    def _flush(self, conn: sqlite3.Connection):
+        batch = []
+        while self._queue:
+            batch.append(self._queue.popleft())
+        if not batch:
+            return
+        with conn:
+            rows = [(self._series_id(conn, key, source, pair, side), ts, price, best)
+                    for key, source, pair, side, price, best, ts in batch]
+            conn.executemany("INSERT OR REPLACE INTO points(series, ts, price, best) VALUES (?, ?, ?, ?)", rows)
+        self.written += len(rows)
+        self.batches += 1
+
+    def _maintain(self, conn: sqlite3.Connection):
+        """Сворачивает сырые точки старше HISTORY_RAW_DAYS в бакеты и чистит то, что старше HISTORY_AGG_DAYS."""
+        now_ms = int(time.time() * 1000)
+        raw_cut = now_ms - int(HISTORY_RAW_DAYS * 86400_000)
+        agg_cut = now_ms - int(HISTORY_AGG_DAYS * 86400_000)
+        step = HISTORY_AGG_STEP * 1000
+        cut = raw_cut - raw_cut % step
+        buckets: "OrderedDict[Tuple[int, int], List]" = OrderedDict()
+        for sid, ts, price in conn.execute(
+            "SELECT series, ts, price FROM points WHERE ts < ? ORDER BY series, ts", (cut,)
+        ):
+            b = buckets.get((sid, ts - ts % step))
+            if b is None:
+                buckets[(sid, ts - ts % step)] = [price, price, price, price, price, 1]
+            else:
+                b[1] = max(b[1], price); b[2] = min(b[2], price); b[3] = price; b[4] += price; b[5] += 1
+        with conn:
+            conn.executemany("""
+                INSERT INTO points_agg(series, bucket, open, high, low, close, total, n) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(series, bucket) DO UPDATE SET
+                    high = max(high, excluded.high), low = min(low, excluded.low),
+                    close = excluded.close, total = total + excluded.total, n = n + excluded.n
+            """, [(sid, bucket, *b) for (sid, bucket), b in buckets.items()])
+            conn.execute("DELETE FROM points WHERE ts < ?", (cut,))
+            conn.execute("DELETE FROM points_agg WHERE bucket < ?", (agg_cut,))
+
+    def _run(self):
+        try:
+            conn = self._connect()
+            conn.executescript(_HISTORY_SCHEMA)
+        except sqlite3.Error as e:
+            self.last_error = str(e)
+            self.enabled = False
+            return
+        while True:
+            self._stop.wait(HISTORY_FLUSH)
+            try:
+                self._flush(conn)
+                if time.monotonic() - self._last_maint >= HISTORY_MAINT_EVERY:
+                    self._last_maint = time.monotonic()
+                    self._maintain(conn)
+            except sqlite3.Error as e:
+                self.last_error = str(e)
+            if self._stop.is_set():
+                break
+        conn.close()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    # ---- чтение
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+            conn.executescript(_HISTORY_SCHEMA)
+        return conn
+
+    def query(self, source: str, pair: str, side: str = "", ts_from: Optional[float] = None,
+              ts_to: Optional[float] = None, step: Optional[float] = None) -> Dict:
+        """
+        Ряды source/pair/side за [ts_from, ts_to] (сек), усреднённые по step секунд.
+        Точка: [ts, avg, min, max, n]; за пределами HISTORY_RAW_DAYS берутся 5-минутные бакеты.
+        """
+        ts_to = ts_to if ts_to is not None else time.time()
+        ts_from = ts_from if ts_from is not None else ts_to - 86400
+        span = max(1.0, ts_to - ts_from)
+        step = max(step or 0.0, span / HISTORY_MAX_POINTS, 1.0)
+        lo, hi, step_ms = int(ts_from * 1000), int(ts_to * 1000), int(step * 1000)
+        raw_cut = int((time.time() - HISTORY_RAW_DAYS * 86400) * 1000)
+
+        conn = self._reader()
+        series = conn.execute(
+            "SELECT id, key FROM series WHERE source = ? AND pair = ? AND side = ?",
+            (source, pair.upper(), side.upper()),
+        ).fetchall()
+        out = []
+        for sid, key in series:
+            rows = []
+            if lo < raw_cut:
+                rows += conn.execute("""
+                    SELECT bucket / :step * :step AS b, sum(total) / sum(n), min(low), max(high), sum(n)
+                    FROM points_agg WHERE series = :sid AND bucket >= :lo AND bucket < :hi
+                    GROUP BY b ORDER BY b
+                """, {"step": step_ms, "sid": sid, "lo": lo, "hi": min(hi, raw_cut)}).fetchall()
+            rows += conn.execute("""
+                SELECT ts / :step * :step AS b, avg(price), min(price), max(price), count(*)
+                FROM points WHERE series = :sid AND ts >= :lo AND ts <= :hi
+                GROUP BY b ORDER BY b
+            """, {"step": step_ms, "sid": sid, "lo": lo, "hi": hi}).fetchall()
+            if rows:
+                out.append({
+                    "key": key, "params": json.loads(key.split(":", 1)[1]),
+                    "points": [[b / 1000, price, mn, mx, n] for b, price, mn, mx, n in rows],
+                })
+        return {"source": source, "pair": pair.upper(), "side": side.upper(),
+                "from": ts_from, "to": ts_to, "step": step, "series": out}
+
+    def stats(self) -> Dict:
+        try:
+            size = self.path.stat().st_size
+        except OSError:
+            size = None
+        return {"enabled": self.enabled, "db": str(self.path), "db_bytes": size, "queued": len(self._queue),
+                "written": self.written, "batches": self.batches, "dropped": self.dropped,
+                "last_error": self.last_error}
+
+HISTORY = HistoryStore(HISTORY_DB, HISTORY_ENABLED)
+atexit.register(HISTORY.close)
+
+# ====================== Параллельный запуск источников ===============
+# Ограниченный пул: источники агрегата опрашиваются одновременно,
+# поэтому задержка /api/rates ≈ самый медленный источник, а не сумма таймаутов.
+RATES_WORKERS      = int(os.getenv("P2P_RATES_WORKERS", "16"))
+RATES_DEADLINE     = float(os.getenv("P2P_RATES_DEADLINE", "16"))
+RATES_DEADLINE_MAX = 60.0
+
+_RATES_POOL = ThreadPoolExecutor(max_workers=RATES_WORKERS, thread_name_prefix="rates")
+
+def run_parallel(tasks: Dict[str, Callable[[], Dict]], deadline: float,
+                 pool: Optional[ThreadPoolExecutor] = None) -> Tuple[Dict[str, Dict], Dict[str, Dict]]:
+    """
+    Запускает задачи одновременно (в pool, по умолчанию _RATES_POOL) и ждёт не дольше deadline секунд.
+    Возвращает (results, statuses): results — только успевшие задачи,
+    statuses[name] = {"status": "ok"|"error"|"timeout", "elapsed": сек[, "error": текст]}.
+    Незавершённые задачи не прерываются (потоки нельзя убить), их результат просто отбрасывается.
+    """
+    started = time.perf_counter()
+    finished_at: Dict[str, float] = {}
+
+    def _timed(name, fn):
+        def run():
+            try:
+                return fn()
+            finally:
+                finished_at[name] = time.perf_counter()
+        return run
+
+    pool = pool or _RATES_POOL
+    futures = {pool.submit(_timed(name, fn)): name for name, fn in tasks.items()}
+    futures_wait(futures, timeout=deadline)
+
+    results, statuses = {}, {}
+    for fut, name in futures.items():
+        if not fut.done():
+            fut.cancel()
+            statuses[name] = {"status": "timeout", "elapsed": round(time.perf_counter() - started, 3)}
+            continue
+        elapsed = round(finished_at.get(name, time.perf_counter()) - started, 3)
+        exc = fut.exception()
+        if exc is not None:
+            statuses[name] = {"status": "error", "elapsed": elapsed, "error": str(exc)}
+        else:
+            results[name] = fut.result()
+            statuses[name] = {"status": "ok", "elapsed": elapsed}
+    return results, statuses
+
+# ====================== Фоновый опрос «горячих» пар ===================
+# Подписки из P2P_POLL (JSON) или файла P2P_POLL_FILE (по умолчанию poll_subscriptions.json):
+#   [{"source": "binance", "params": {"asset": "USDT", "fiat": "UAH", "side": "BUY"}, "interval": 15}, ...]
+# Свежий снимок отдаётся из памяти без похода в upstream; неподписанные ключи — как раньше, по запросу.
+POLL_FILE   = Path(os.getenv("P2P_POLL_FILE", str(BASE_DIR / "poll_subscriptions.json")))
+POLL_JITTER = float(os.getenv("P2P_POLL_JITTER", "0.2"))       # ±20% к интервалу
+POLL_STALE  = float(os.getenv("P2P_POLL_STALE", "3"))          # снимок годен, пока моложе interval × POLL_STALE
+# бюджет запросов в минуту на биржу — чтобы опрос не выглядел как бот и не ловил бан
+POLL_BUDGET = {"binance": 30, "bybit": 30, "gf": 20, "xe": 6}
+POLL_BUDGET.update(json.loads(os.getenv("P2P_POLL_BUDGET", "{}")))
+
+class QuotePoller:
+    def __init__(self):
+        self.subs: List[Dict] = []
+        self.budgets: Dict[str, TokenBucket] = {}
+        self._snapshots: Dict[str, Tuple[float, Dict, float]] = {}   # key -> (stored_at, data, interval)
+        self._heap: List[Tuple[float, int]] = []
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.fetches = self.errors = self.deferred = 0
+
+    def load(self, subs: List[Dict]):
+        self.subs = []
+        for raw in subs:
+            source = raw.get("source")
+            norm = normalize_quote_params(source, raw.get("params") or {})
+            self.subs.append({
+                "source": source, "params": norm, "key": quote_key(source, norm),
+                "interval": max(1.0, float(raw.get("interval", CACHE_TTL[source]))),
+                "last_ok": None, "last_error": None,
+            })
+        self.budgets = {src: TokenBucket(rate) for src, rate in POLL_BUDGET.items()}
+
+    def lookup(self, key: str) -> Optional[Tuple[Dict, Dict]]:
+        snap = self._snapshots.get(key)
+        if snap is None:
+            return None
+        stored_at, data, interval = snap
+        age = time.time() - stored_at
+        if age > interval * POLL_STALE:
+            return None
+        return data, {"cached": True, "age": round(age, 3), "polled": True}
+
+    def _jittered(self, interval: float) -> float:
+        return interval * (1.0 + random.uniform(-POLL_JITTER, POLL_JITTER))
+
+    def _poll(self, sub: Dict):
+        try:
+            data = fetch_quote(sub["source"], sub["params"], sub["key"])
+        except Exception as e:
+            self.errors += 1
+            sub["last_error"] = str(e)
+            return
+        now = time.time()
+        self.fetches += 1
+        sub["last_ok"] = now
+        sub["last_error"] = None
+        self._snapshots[sub["key"]] = (now, data, sub["interval"])
+        QUOTES.put(sub["key"], data, stored_at=now)
+
+    def _run(self):
+        now = time.monotonic()
+        # разносим старт подписок по первому интервалу, чтобы не стрелять пачкой
+        self._heap = [(now + random.uniform(0, sub["interval"]), i) for i, sub in enumerate(self.subs)]
+        heapq.heapify(self._heap)
+        while self._heap and not self._stop.is_set():
+            due, i = self._heap[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._stop.wait(min(delay, 1.0))
+                continue
+            heapq.heappop(self._heap)
+            sub = self.subs[i]
+            bucket = self.budgets.get(sub["source"])
+            wait_for = bucket.try_take() if bucket is not None else 0.0
+            if wait_for > 0:
+                self.deferred += 1
+                heapq.heappush(self._heap, (time.monotonic() + wait_for + random.uniform(0, 1), i))
+                continue
+            _RATES_POOL.submit(self._poll, sub)
+            heapq.heappush(self._heap, (time.monotonic() + self._jittered(sub["interval"]), i))
+
+    def start(self):
+        if not self.subs or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="quote-poller", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict:
+        return {
+            "running": bool(self._thread is not None and self._thread.is_alive()),
+            "fetches": self.fetches, "errors": self.errors, "deferred": self.deferred,
+            "subscriptions": [
+                {"source": sub["source"], "params": sub["params"], "interval": sub["interval"],
+                 "last_ok": sub["last_ok"], "last_error": sub["last_error"]}
+                for sub in self.subs
+            ],
+        }
+
+def _load_poll_subscriptions() -> List[Dict]:
+    raw = os.getenv("P2P_POLL")
+    if raw:
+        return json.loads(raw)
+    if POLL_FILE.exists():
+        with open(POLL_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return []
+
+POLLER = QuotePoller()
+POLLER.load(_load_poll_subscriptions())
+POLLER.start()
+atexit.register(POLLER.stop)
+
+# ====================== Поток обновлений (SSE) =======================
+# Один хаб на процесс: держит набор ключей, на которые подписан хоть один клиент,
+# обновляет их через get_quote (кэш/опрос → один upstream-вызов на всех) и рассылает
+# только изменившиеся котировки. Последние события лежат в кольцевом буфере —
+# по Last-Event-ID клиент дочитывает пропущенное после переподключения.
+STREAM_TICK      = float(os.getenv("P2P_STREAM_TICK", "1"))
+STREAM_HEARTBEAT = float(os.getenv("P2P_STREAM_HEARTBEAT", "15"))
+STREAM_BACKLOG   = int(os.getenv("P2P_STREAM_BACKLOG", "1000"))
+STREAM_MAX_SUBS  = 32
+
+class StreamHub:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._events: deque = deque(maxlen=STREAM_BACKLOG)      # (id, key, payload)
+        self._refs: Dict[str, int] = {}
+        self._specs: Dict[str, Tuple[str, Dict]] = {}
+        self._current: Dict[str, Tuple[int, str]] = {}          # key -> (id, payload) последнего события
+        self._digest: Dict[str, str] = {}
+        self._checked: Dict[str, float] = {}
+        self._pending: set = set()
+        self._thread: Optional[threading.Thread] = None
+
+    # ---- подписки
+    def subscribe(self, specs: List[Tuple[str, Dict]]) -> List[str]:
+        keys = []
+        with self._cond:
+            for source, params in specs:
+                norm = normalize_quote_params(source, params)
+                key = quote_key(source, norm)
+                self._specs[key] = (source, norm)
+                self._refs[key] = self._refs.get(key, 0) + 1
+                keys.append(key)
+        self._ensure_thread()
+        return keys
+
+    def unsubscribe(self, keys: List[str]):
+        with self._cond:
+            for key in keys:
+                n = self._refs.get(key, 0) - 1
+                if n > 0:
+                    self._refs[key] = n
+                    continue
+                for d in (self._refs, self._specs, self._checked, self._current, self._digest):
+                    d.pop(key, None)
+
+    # ---- публикация
+    def _publish(self, key: str, payload: Dict, digest: str):
+        if self._digest.get(key) == digest:
+            return                                  # быстрый путь без сериализации; окончательно — ниже
+        body = json.dumps(payload, ensure_ascii=False, default=_json_default)
+        with self._cond:
+            # последний подписчик ушёл, пока шло обновление, — результат никому не нужен (и не должен
+            # оживлять удалённые unsubscribe записи); сравнение с прошлым digest — под той же блокировкой
+            if key not in self._specs or self._digest.get(key) == digest:
+                return
+            self._digest[key] = digest
+            self._seq += 1
+            self._events.append((self._seq, key, body))
+            self._current[key] = (self._seq, body)
+            self._cond.notify_all()
+
+    def _refresh(self, key: str, source: str, norm: Dict):
+        try:
+            try:
+                data, meta = get_quote(source, norm)
+                payload = {"key": key, "source": source, "params": norm, "ok": True, "data": data, **meta}
+                digest = json.dumps({k: v for k, v in data.items() if k != "ts"}, sort_keys=True, default=_json_default)
+            except Exception as e:
+                payload = {"key": key, "source": source, "params": norm, "ok": False, "error": str(e)}
+                digest = "error:" + str(e)
+            self._publish(key, payload, digest)
+        finally:
+            with self._cond:
+                self._pending.discard(key)
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            with self._cond:
+                due = [
+                    (key, spec) for key, spec in self._specs.items()
+                    if key not in self._pending and now - self._checked.get(key, 0.0) >= CACHE_TTL[spec[0]]
+                ]
+                for key, _ in due:
+                    self._pending.add(key)
+                    self._checked[key] = now
+            for key, (source, norm) in due:
+                _RATES_POOL.submit(self._refresh, key, source, norm)
+            time.sleep(STREAM_TICK)
+
+    def _ensure_thread(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="stream-hub", daemon=True)
+                self._thread.start()
+
+    # ---- чтение
+    def initial(self, keys: List[str], last_id: Optional[int]) -> Tuple[List[Tuple[int, str, str]], int]:
+        """
+        События, которые надо отдать сразу после подключения, и id, с которого ждать дальше.
+        Если last_id ещё в буфере — дочитываем хвост, иначе отдаём текущий снимок по ключам.
+        """
+        wanted = set(keys)
+        with self._cond:
+            oldest = self._events[0][0] if self._events else self._seq + 1
+            if last_id is not None and last_id + 1 >= oldest:
+                return [ev for ev in self._events if ev[0] > last_id and ev[1] in wanted], self._seq
+            snap = sorted((self._current[k][0], k, self._current[k][1]) for k in wanted if k in self._current)
+            return snap, self._seq
+
+    def wait(self, keys: List[str], after: int, timeout: float) -> Tuple[List[Tuple[int, str, str]], int]:
+        wanted = set(keys)
+        with self._cond:
+            if self._seq <= after:
+                self._cond.wait(timeout)
+            if self._events and self._events[0][0] > after + 1:
+                # клиент отстал больше, чем на буфер — догоняем текущим снимком
+                evs = sorted((self._current[k][0], k, self._current[k][1]) for k in wanted if k in self._current)
+            else:
+                evs = [ev for ev in self._events if ev[0] > after and ev[1] in wanted]
+            return evs, self._seq
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {"keys": len(self._specs), "clients_refs": sum(self._refs.values()),
+                    "last_event_id": self._seq, "backlog": len(self._events)}
+
+STREAM_HUB = StreamHub()
+
+def _sse(event_id: Optional[int], event: str, data: str) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {data}\n\n"
+
+# ---- Разбор query-параметров (общий для Flask-маршрутов и ASGI-режима, см. asgi.py)
+def _csv_arg(args, name: str) -> List[str]:
+    raw = (args.get(name) or "").strip()
+    return [p for p in (raw.split(",") if raw else []) if p]
+
+def binance_params_from_args(args) -> Dict:
+    return {
+        "asset": args.get("asset", "USDT").upper(), "fiat": args.get("fiat", "UAH").upper(),
+        "side": args.get("side", "SELL").upper(), "amount": args.get("amount", "20000"),
+        "pay_types": _csv_arg(args, "paytypes"),
+        "merchant": args.get("merchant", "true").lower() == "true",
+    }
+
+def bybit_params_from_args(args) -> Dict:
+    return {
+        "asset": args.get("asset", "USDT").upper(), "fiat": args.get("fiat", "UAH").upper(),
+        "side": args.get("side", "SELL").upper(), "amount": args.get("amount", "20000"),
+        "payments": _csv_arg(args, "payments"),
+        "verified": args.get("verified", "false").lower() == "true",
+    }
+
+def gf_params_from_args(args) -> Dict:
+    return {"asset": args.get("asset", "USD").upper(), "fiat": args.get("fiat", "UAH").upper()}
+
+def xe_params_from_args(args) -> Dict:
+    return {"from": args.get("from", "USD").upper(), "to": args.get("to", "UAH").upper()}
+
+def depth_params_from_args(args) -> Tuple[str, Dict]:
+    """?exchange=binance|bybit&asset&fiat&side&amounts=5000,20000&volume=&pages=&paytypes|payments&merchant|verified"""
+    exchange = (args.get("exchange") or "binance").lower()
+    if exchange not in ("binance", "bybit"):
+        raise ValueError("exchange: binance или bybit")
+    params = {
+        "asset": args.get("asset", "USDT").upper(), "fiat": args.get("fiat", "UAH").upper(),
+        "side": args.get("side", "SELL").upper(), "amounts": args.get("amounts") or args.get("amount", "20000"),
+        "volume": args.get("volume"), "pages": args.get("pages"),
+    }
+    if exchange == "binance":
+        params.update(pay_types=_csv_arg(args, "paytypes"), merchant=args.get("merchant", "true").lower() == "true")
+    else:
+        params.update(payments=_csv_arg(args, "payments"), verified=args.get("verified", "false").lower() == "true")
+    return exchange + "_depth", params
+
+def rates_params_from_args(args) -> Tuple[Dict, float]:
+    params = {
+        "asset": args.get("asset", "USDT").upper(), "fiat": args.get("fiat", "UAH").upper(),
+        "side": args.get("side", "SELL").upper(), "amount": args.get("amount", "20000"),
+        "merchant_binance": args.get("merchant_binance", "true").lower() == "true",
+        "paytypes_binance": _csv_arg(args, "paytypes_binance"),
+        "verified_bybit": args.get("verified_bybit", "false").lower() == "true",
+        "payments_bybit": _csv_arg(args, "payments_bybit"),
+    }
+    # общий дедлайн на весь агрегат (сек); всё, что не успело — помечаем timeout
+    try:
+        deadline = float(args.get("deadline", RATES_DEADLINE))
+    except ValueError:
+        deadline = RATES_DEADLINE
+    return params, max(0.5, min(deadline, RATES_DEADLINE_MAX))
+
+def rates_sources(params: Dict) -> Dict[str, Tuple[str, Dict]]:
+    """Имя блока в ответе /api/rates → (источник, параметры get_quote)."""
+    common = {"asset": params["asset"], "fiat": params["fiat"], "side": params["side"], "amount": params["amount"]}
+    return {
+        "binance": ("binance", {**common, "pay_types": params["paytypes_binance"], "merchant": params["merchant_binance"]}),
+        "bybit":   ("bybit", {**common, "payments": params["payments_bybit"], "verified": params["verified_bybit"]}),
+        "google":  ("gf", {"asset": params["asset"], "fiat": params["fiat"]}),
+    }
+
+def rates_payload(params: Dict, out: Dict, errors: Dict, deadline: float) -> Dict:
+    return {
+        "ok": True,
+        "params": params,
+        "google": out.get("google"),
+        "binance": out.get("binance"),
+        "bybit": out.get("bybit"),
+        "errors": errors,
+        "deadline": deadline,
+        "timestamp": int(time.time())
+    }
+
+def stream_subs_from_args(args) -> Tuple[List[Dict], List[Tuple[str, Dict]]]:
+    """?subs=[{"tag", "source", "params"}, ...] → (исходный список, [(source, params)]); ValueError при мусоре."""
+    try:
+        raw = json.loads(args.get("subs") or "[]")
+        if not isinstance(raw, list) or not raw or len(raw) > STREAM_MAX_SUBS:
+            raise ValueError(f"subs: нужен список из 1..{STREAM_MAX_SUBS} подписок")
+        specs = [(str(x.get("source")), x.get("params") or {}) for x in raw]
+    except AttributeError:
+        raise ValueError("subs: элементы должны быть объектами")
+    for source, _ in specs:
+        normalize_quote_params(source, {})
+    return raw, specs
+
+# ====================== Матрица спредов ================================
+# Один вызов вместо сотен запросов из браузера: все связки (биржа × фиат × сторона × фильтр оплат)
+# берутся через get_quote параллельно (кэш/опрос → повторные матрицы почти бесплатны),
+# затем премии к GF/XE и арбитраж «купить на одной связке — продать на другой» считаются
+# векторно по float-массивам, а не попарно в Decimal.
+MATRIX_MAX_SPECS = int(os.getenv("P2P_MATRIX_MAX_SPECS", "200"))
+MATRIX_TOP_MAX   = 100
+MATRIX_WORKERS   = int(os.getenv("P2P_MATRIX_WORKERS", "4"))       # меньше HTTP_HOST_CONCURRENCY: хосту остаётся запас
+
+# свой пул: сотня связок в _RATES_POOL заняла бы его целиком, и /api/rates, поллер и поток
+# ждали бы в очереди за чужой матрицей
+_MATRIX_POOL = ThreadPoolExecutor(max_workers=MATRIX_WORKERS, thread_name_prefix="matrix")
+
+def _filter_groups(raw: Optional[str]) -> List[List[str]]:
+    """'A,B;C;' → [['A','B'], ['C'], []] — варианты фильтра оплат через ';', пустой вариант = без фильтра."""
+    if not raw:
+        return [[]]
+    groups, seen = [], set()
+    for part in raw.split(";"):
+        g = _csv_list(part)
+        if tuple(g) not in seen:
+            seen.add(tuple(g))
+            groups.append(g)
+    return groups
+
+def spread_matrix_params_from_args(args) -> Tuple[Dict, float]:
+    asset = args.get("asset", "USDT").upper()
+    params = {
+        "asset": asset,
+        "fiats": [f.upper() for f in _csv_arg(args, "fiats")] or ["UAH"],
+        "sides": [x.upper() for x in _csv_arg(args, "sides")] or ["BUY", "SELL"],
+        "amount": args.get("amount", "20000"),
+        "merchant_binance": args.get("merchant_binance", "true").lower() == "true",
+        "verified_bybit": args.get("verified_bybit", "false").lower() == "true",
+        "paytypes_binance": _filter_groups(args.get("paytypes_binance")),
+        "payments_bybit": _filter_groups(args.get("payments_bybit")),
+        "exchanges": [x.lower() for x in _csv_arg(args, "exchanges")] or ["binance", "bybit"],
+        "refs": [x.lower() for x in _csv_arg(args, "refs")] or ["gf", "xe"],
+        # стейблы сравниваем с USD: у GF/XE котировки USDT-UAH нет или она хуже
+        "ref_asset": (args.get("ref_asset") or ("USD" if asset in XE_STABLES else asset)).upper(),
+    }
+    try:
+        top = int(args.get("top", "10"))
+    except ValueError:
+        top = 10
+    params["top"] = max(1, min(top, MATRIX_TOP_MAX))
+    _, deadline = rates_params_from_args(args)
+    return params, deadline
+
+def spread_matrix_specs(params: Dict) -> Dict[str, Tuple[str, Dict, Dict]]:
+    """Имя связки → (источник, параметры get_quote, описание для ответа). ValueError, если связок слишком много."""
+    specs: Dict[str, Tuple[str, Dict, Dict]] = {}
+    for fiat in params["fiats"]:
+        for ref in params["refs"]:
+            if ref == "gf":
+                specs[f"ref:gf:{fiat}"] = ("gf", {"asset": params["ref_asset"], "fiat": fiat}, {"fiat": fiat, "ref": "gf"})
+            elif ref == "xe":
+                specs[f"ref:xe:{fiat}"] = ("xe", {"from": params["ref_asset"], "to": fiat}, {"fiat": fiat, "ref": "xe"})
+        for side in params["sides"]:
+            common = {"asset": params["asset"], "fiat": fiat, "side": side, "amount": params["amount"]}
+            if "binance" in params["exchanges"]:
+                for g in params["paytypes_binance"]:
+                    specs[f"binance:{fiat}:{side}:{','.join(g)}"] = (
+                        "binance", {**common, "pay_types": g, "merchant": params["merchant_binance"]},
+                        {"exchange": "binance", "fiat": fiat, "side": side, "filter": g},
+                    )
+            if "bybit" in params["exchanges"]:
+                for g in params["payments_bybit"]:
+                    specs[f"bybit:{fiat}:{side}:{','.join(g)}"] = (
+                        "bybit", {**common, "payments": g, "verified": params["verified_bybit"]},
+                        {"exchange": "bybit", "fiat": fiat, "side": side, "filter": g},
+                    )
+    if len(specs) > MATRIX_MAX_SPECS:
+        raise ValueError(f"слишком много связок: {len(specs)} > {MATRIX_MAX_SPECS}")
+    return specs
+
+def _top_pairs(buy: List[float], sell: List[float], k: int) -> List[Tuple[int, int, float]]:
+    """
+    K лучших пар (i, j, spread%) по матрице sell[j] / buy[i] − 1.
+    buy — цены, по которым актив покупается (BUY), sell — по которым продаётся (SELL).
+    """
+    if not buy or not sell:
+        return []
+    if NUMPY_OK:
+        b = np.asarray(buy, dtype=np.float64)
+        s_ = np.asarray(sell, dtype=np.float64)
+        m = (s_[None, :] / b[:, None] - 1.0) * 100.0
+        flat = m.ravel()
+        k = min(k, flat.size)
+        idx = np.argpartition(-flat, k - 1)[:k]
+        idx = idx[np.argsort(-flat[idx])]
+        return [(int(x) // len(sell), int(x) % len(sell), float(flat[x])) for x in idx]
+    return heapq.nlargest(
+        k, ((i, j, (sv / bv - 1.0) * 100.0) for i, bv in enumerate(buy) for j, sv in enumerate(sell)),
+        key=lambda t: t[2],
+    )
+
+def spread_matrix(params: Dict, deadline: float) -> Dict:
+    started = time.perf_counter()
+    specs = spread_matrix_specs(params)
+    results, statuses = run_parallel({
+        name: (lambda src=src, qp=qp: get_quote(src, qp)) for name, (src, qp, _) in specs.items()
+    }, deadline, _MATRIX_POOL)
+
+    refs: Dict[str, Dict[str, float]] = {fiat: {} for fiat in params["fiats"]}
+    quotes: List[Dict] = []
+    for name, (src, _, info) in specs.items():
+        if name not in results:
+            continue
+        data, meta = results[name]
+        statuses[name].update(meta)
+        if "ref" in info:
+            if data.get("price"):
+                refs[info["fiat"]][info["ref"]] = float(data["price"])
+            continue
+        if data.get("avg") is None:
+            continue
+        quotes.append({"id": name, **info, "avg": float(data["avg"]),
+                       "best": (float(data["prices"][0]) if data.get("prices") else None)})
+
+    # премия каждой связки к каждому референсу — одним векторным делением
+    ref_names = params["refs"]
+    premium_rows = []
+    if quotes:
+        avgs = [q["avg"] for q in quotes]
+        for ref in ref_names:
+            ref_vals = [refs[q["fiat"]].get(ref) for q in quotes]
+            if NUMPY_OK:
+                r = np.array([v if v else np.nan for v in ref_vals], dtype=np.float64)
+                pct = ((np.asarray(avgs, dtype=np.float64) / r - 1.0) * 100.0).tolist()
+            else:
+                pct = [(a / v - 1.0) * 100.0 if v else float("nan") for a, v in zip(avgs, ref_vals)]
+            premium_rows.append(pct)
+    for i, q in enumerate(quotes):
+        q["premium"] = {ref: (round(row[i], 4) if row[i] == row[i] else None) for ref, row in zip(ref_names, premium_rows)}
+
+    # арбитраж внутри фиата: купить (BUY) на одной связке → продать (SELL) на другой
+    top: List[Tuple[float, Dict]] = []
+    for fiat in params["fiats"]:
+        buy = [q for q in quotes if q["fiat"] == fiat and q["side"] == "BUY"]
+        sell = [q for q in quotes if q["fiat"] == fiat and q["side"] == "SELL"]
+        for i, j, pct in _top_pairs([q["avg"] for q in buy], [q["avg"] for q in sell], params["top"]):
+            top.append((pct, {"fiat": fiat, "buy": buy[i]["id"], "sell": sell[j]["id"],
+                              "buy_price": buy[i]["avg"], "sell_price": sell[j]["avg"], "spread_pct": round(pct, 4)}))
+    top.sort(key=lambda t: t[0], reverse=True)
+
+    return {
+        "ok": True,
+        "params": params,
+        "quotes": quotes,
+        "references": refs,
+        "top": [row for _, row in top[:params["top"]]],
+        "errors": {name: st for name, st in statuses.items() if st["status"] != "ok"},
+        "engine": "numpy" if NUMPY_OK else "python",
+        "deadline": deadline,
+        "elapsed": round(time.perf_counter() - started, 3),
+        "timestamp": int(time.time()),
+    }
+
+# ====================== Пакетные котировки (NDJSON) ===================
+# POST /api/quotes/batch: десятки связок за один запрос. Одинаковые спецификации (после
+# нормализации) запрашиваются один раз, готовое в кэше/у поллера отдаётся сразу, остальное
+# идёт в пул с лимитом одновременных вызовов на источник — общим для всех пакетов, чтобы
+# один большой пакет не выедал биржам лимиты. Ответ — NDJSON по мере готовности.
+BATCH_MAX_SPECS = int(os.getenv("P2P_BATCH_MAX_SPECS", "500"))
+BATCH_DEADLINE  = float(os.getenv("P2P_BATCH_DEADLINE", "30"))
+BATCH_WORKERS   = int(os.getenv("P2P_BATCH_WORKERS", "24"))
+BATCH_LIMITS = {"binance": 6, "bybit": 6, "gf": 4, "xe": 2, "binance_depth": 2, "bybit_depth": 2}
+BATCH_LIMITS.update(json.loads(os.getenv("P2P_BATCH_LIMITS", "{}")))
+
+_BATCH_POOL = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="batch")
+_BATCH_SEMS = {src: threading.BoundedSemaphore(max(1, n)) for src, n in BATCH_LIMITS.items()}
+
+def batch_params_from_json(body) -> Tuple[List[Dict], float]:
+    """{"specs": [{"id"?, "source", "params"}, ...], "deadline"?} или просто список → (specs, deadline)."""
+    if isinstance(body, list):
+        body = {"specs": body}
+    if not isinstance(body, dict):
+        raise ValueError("нужен JSON-объект {\"specs\": [...]} или список спецификаций")
+    specs = body.get("specs")
+    if not isinstance(specs, list) or not specs or len(specs) > BATCH_MAX_SPECS:
+        raise ValueError(f"specs: нужен список из 1..{BATCH_MAX_SPECS} спецификаций")
+    deadline = min(max(float(body.get("deadline") or BATCH_DEADLINE), 0.5), RATES_DEADLINE_MAX)
+    return specs, deadline
+
+def batch_plan(specs: List[Dict]) -> Tuple[Dict[str, Tuple[str, Dict, List[int]]], List[Dict]]:
+    """
+    → (уникальные ключи: key → (source, norm, индексы спецификаций), строки-ошибки для мусорных спецификаций).
+    """
+    plan: Dict[str, Tuple[str, Dict, List[int]]] = {}
+    bad: List[Dict] = []
+    for i, x in enumerate(specs):
+        try:
+            if not isinstance(x, dict):
+                raise ValueError("спецификация должна быть объектом")
+            source = str(x.get("source"))
+            norm = normalize_quote_params(source, x.get("params") or {})
+        except (ValueError, TypeError, AttributeError) as e:
+            bad.append(_batch_line(i, specs[i], status="invalid", error=str(e)))
+            continue
+        key = quote_key(source, norm)
+        if key in plan:
+            plan[key][2].append(i)
+        else:
+            plan[key] = (source, norm, [i])
+    return plan, bad
+
+def _batch_line(i: int, spec, **fields) -> Dict:
+    line = {"index": i}
+    if isinstance(spec, dict) and "id" in spec:
+        line["id"] = spec["id"]
+    line.update(fields)
+    return line
+
+def _batch_fetch(source: str, norm: Dict, key: str) -> Tuple[Dict, Dict]:
+    sem = _BATCH_SEMS.get(source)
+    if sem is None:
+        return get_quote_normalized(source, norm, key)
+    with sem:
+        return get_quote_normalized(source, norm, key)
+
+def run_batch(specs: List[Dict], deadline: float):
+    """Генератор строк результата (dict) по мере готовности; последняя — сводка {"done": true, ...}."""
+    started = time.perf_counter()
+    plan, bad = batch_plan(specs)
+    counts = {"ok": 0, "error": 0, "timeout": 0, "invalid": len(bad)}
+    yield from bad
+
+    def lines(key: str, **fields):
+        source, norm, idx = plan[key]
+        counts[fields["status"]] += len(idx)
+        for i in idx:
+            yield _batch_line(i, specs[i], source=source, params=norm, **fields)
+
+    pending: Dict = {}
+    for key, (source, norm, _) in plan.items():
+        hit = cached_quote(source, key)
+        if hit is not None:
+            yield from lines(key, status="ok", data=hit[0], **hit[1])
+        else:
+            pending[_BATCH_POOL.submit(_batch_fetch, source, norm, key)] = key
+    try:
+        for fut in as_completed(pending, timeout=max(0.0, deadline - (time.perf_counter() - started))):
+            key = pending.pop(fut)
+            exc = fut.exception()
+            if exc is not None:
+                yield from lines(key, status="error", error=str(exc))
+            else:
+                data, meta = fut.result()
+                yield from lines(key, status="ok", data=data, **meta)
+    except FuturesTimeout:
+        for fut, key in pending.items():
+            fut.cancel()
+            yield from lines(key, status="timeout")
+    yield {"done": True, "specs": len(specs), "unique": len(plan), **counts,
+           "elapsed": round(time.perf_counter() - started, 3)}
+
+# ====================== Быстрые ответы (orjson, ETag, сжатие) ==========
+# Ответ = неизменная часть (данные котировки, список методов оплаты, коды XE) + изменчивая
+# (cached/age/stale/refreshing). Неизменная часть сериализуется один раз на объект из кэша —
+# тот же объект отдаётся, пока запись свежа, — и склеивается с изменчивой на лету.
+# ETag считается по неизменной части: If-None-Match → 304, пока данные те же; возраст и
+# попадание в кэш дублируются заголовками Age / X-Cache. Большие тела (каталоги оплат,
+# /api/xe/codes) сжимаются gzip/br; варианты полностью неизменных тел хранятся по ETag.
+BODY_CACHE_SIZE    = int(os.getenv("P2P_BODY_CACHE_SIZE", "2000"))
+COMPRESS_MIN_BYTES = int(os.getenv("P2P_COMPRESS_MIN_BYTES", "2048"))
+COMPRESS_VARIANTS  = 64
+
+def _json_default(o):
+    if isinstance(o, (QuoteBook, FixedRows)):
+        return o.to_json()
+    if isinstance(o, Decimal):
+        return str(o)          # как DefaultJSONProvider во Flask
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    raise TypeError(f"не сериализуется в JSON: {type(o).__name__}")
+
+def dumps_bytes(obj) -> bytes:
+    if ORJSON_OK:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+def _flask_json_default(o, _base=app.json.default):
+    """jsonify (/api/rates и др.): компактные котировки — как в dumps_bytes, остальное — как во Flask."""
+    return o.to_json() if isinstance(o, (QuoteBook, FixedRows)) else _base(o)
+
+app.json.default = _flask_json_default
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+
+class _BodyCache:
+    """(id объекта, вид) → (объект, байты, ETag). Объект держим ссылкой — id не переиспользуется, пока запись жива."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._data: "OrderedDict[Tuple[int, str], Tuple[object, bytes, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, obj, kind: str, build: Callable[[object], object]) -> Tuple[bytes, str]:
+        k = (id(obj), kind)
+        with self._lock:
+            hit = self._data.get(k)
+            if hit is not None and hit[0] is obj:
+                self._data.move_to_end(k)
+                self.hits += 1
+                return hit[1], hit[2]
+        body = dumps_bytes(build(obj))
+        tag = _etag(body)
+        with self._lock:
+            self.misses += 1
+            self._data[k] = (obj, body, tag)
+            self._data.move_to_end(k)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+        return body, tag
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {"entries": len(self._data), "hits": self.hits, "misses": self.misses,
+                    "orjson": ORJSON_OK, "brotli": BROTLI_OK}
+
+BODIES = _BodyCache(BODY_CACHE_SIZE)
+_VARIANTS: "OrderedDict[Tuple[str, str], bytes]" = OrderedDict()
+_VARIANTS_LOCK = threading.Lock()
+
+def _compress(body: bytes, enc: str) -> bytes:
+    return brotli.compress(body, quality=5) if enc == "br" else gzip.compress(body, compresslevel=6)
+
+def _negotiate(size: int) -> Optional[str]:
+    """Кодирование по Accept-Encoding; None — отдаём как есть."""
+    if size < COMPRESS_MIN_BYTES:
+        return None
+    accept = request.accept_encodings
+    return "br" if BROTLI_OK and accept["br"] else "gzip" if accept["gzip"] else None
+
+_ENC_SUFFIX = {"br": "-br", "gzip": "-gz"}
+
+def variant_etag(etag: str, enc: Optional[str], stable: bool) -> str:
+    """
+    ETag конкретного представления. Сильный — только если тело целиком определяется etag (stable),
+    и у каждого кодирования свой суффикс: байты gzip, br и несжатого тела разные (RFC 9110 §8.8.1).
+    Тело с подклеенными age/cached/stale меняется при тех же данных — ему слабый W/.
+    """
+    tag = etag[:-1] + _ENC_SUFFIX.get(enc, "") + '"'
+    return tag if stable else "W/" + tag
+
+def _encode_body(body: bytes, etag: Optional[str], enc: Optional[str]) -> bytes:
+    """Сжатие в enc. etag — только для полностью неизменного тела: вариант запоминается."""
+    if enc is None:
+        return body
+    if etag is None:
+        return _compress(body, enc)
+    k = (etag, enc)
+    with _VARIANTS_LOCK:
+        out = _VARIANTS.get(k)
+        if out is not None:
+            _VARIANTS.move_to_end(k)
+            return out
+    out = _compress(body, enc)
+    with _VARIANTS_LOCK:
+        _VARIANTS[k] = out
+        while len(_VARIANTS) > COMPRESS_VARIANTS:
+            _VARIANTS.popitem(last=False)
+    return out
+
+def _splice(prefix: bytes, extra: Dict) -> bytes:
+    """b'{...}' + {"a": 1} → b'{...,"a":1}' без повторной сериализации prefix."""
+    if not extra:
+        return prefix
+    tail = dumps_bytes(extra)
+    return prefix[:-1] + (b"," if len(prefix) > 2 else b"") + tail[1:]
+
+def fast_response(body: bytes, etag: str, headers: Optional[Dict[str, str]] = None, stable: bool = False) -> Response:
+    """
+    JSON-ответ с ETag/304 и сжатием; stable=True — тело целиком определяется ETag (можно хранить
+    сжатым и отдавать сильный валидатор), иначе ETag слабый (см. variant_etag).
+    """
+    enc = _negotiate(len(body))
+    tag = variant_etag(etag, enc, stable)
+    # If-None-Match сравнивается слабо (RFC 9110 §13.1.2)
+    if request.if_none_match.contains_weak(tag.removeprefix("W/").strip('"')):
+        resp = Response(status=304)
+    else:
+        resp = Response(_encode_body(body, etag if stable else None, enc), mimetype="application/json")
+        if enc:
+            resp.headers["Content-Encoding"] = enc
+    resp.headers["ETag"] = tag
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["Vary"] = "Accept-Encoding"
+    if headers:
+        resp.headers.update(headers)
+    return resp
+
+def _wrap_ok(d: Dict) -> Dict:
+    return {"ok": True, **d}
+
+def _wrap_data(d: Dict) -> Dict:
+    return {"ok": True, "data": d}
+
+def quote_response(data: Dict, meta: Dict, wrap_data: bool = False) -> Response:
+    """{"ok": true, **data, **meta} (или {"ok": true, "data": data, **meta}) из закэшированных байтов data."""
+    prefix, etag = BODIES.get(data, "data" if wrap_data else "ok", _wrap_data if wrap_data else _wrap_ok)
+    state = "STALE" if meta.get("stale") else "HIT" if meta.get("cached") else "MISS"
+    return fast_response(_splice(prefix, meta), etag, {"X-Cache": state, "Age": str(int(meta.get("age") or 0))})
 
 # ====================== API ================================
+def _upstream_error(e: Exception):
+    # 503 — upstream не вызывался (цепь разомкнута / нет токена), 502 — upstream ответил ошибкой
+    return jsonify({"ok": False, "error": str(e)}), 503 if isinstance(e, UpstreamUnavailable) else 502
+
 @app.route("/api/binance_rate")
 def api_binance_rate():
-    asset = request.args.get("asset", "USDT").upper()
-    fiat = request.args.get("fiat", "UAH").upper()
-    side = request.args.get("side", "SELL").upper()
-    pay_csv = (request.args.get("paytypes") or "").strip()
-    paytypes = [p for p in (pay_csv.split(",") if pay_csv else []) if p]
-    amount = request.args.get("amount", "20000")
-    merchant = request.args.get("merchant", "true").lower() == "true"
     try:
-        d = fetch_binance(asset, fiat, side, paytypes, amount, rows=10, merchant=merchant)
-        return jsonify({"ok": True, **d})
+        d, meta = get_quote("binance", binance_params_from_args(request.args))
+        return quote_response(d, meta)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 502
+        return _upstream_error(e)
 
 @app.route("/api/binance/paytypes")
 def api_binance_paytypes():
-    asset    = (request.args.get("asset") or "USDT").upper()
+    # asset не влияет на ответ: каталог обходит стакан PAYTYPES_ASSET
     fiat     = (request.args.get("fiat") or "UAH").upper()
     side     = (request.args.get("side") or "SELL").upper()
-    amount   = request.args.get("amount", "20000")
     merchant = request.args.get("merchant_binance", "true").lower() == "true"
+    cat = BINANCE_PAYTYPES.get(fiat, side, merchant)
+    if not cat["items"] and cat["error"]:
+        return jsonify({"ok": False, **cat}), 502
+    items = cat.pop("items")
+    prefix, etag = BODIES.get(items, "paytypes", lambda x: {"ok": True, "items": x})
+    return fast_response(_splice(prefix, cat), etag)
+
+@app.route("/api/depth")
+def api_depth():
+    try:
+        source, params = depth_params_from_args(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
     try:
-        items = discover_binance_paytypes(asset, fiat, side, amount, merchant)
-        return jsonify({"ok": True, "items": items})
+        data, meta = get_quote(source, params)
+        return quote_response(data, meta)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e), "items": []}), 502
+        return _upstream_error(e)
 
 @app.route("/api/bybit_rate")
 def api_bybit_rate():
-    token = request.args.get("asset", "USDT").upper()
-    fiat  = request.args.get("fiat", "UAH").upper()
-    side  = request.args.get("side", "SELL").upper()
-    amount= request.args.get("amount", "20000")
-    verified = request.args.get("verified", "false").lower() == "true"
-    pay_csv  = (request.args.get("payments") or "").strip()
-    payments = [p for p in (pay_csv.split(",") if pay_csv else []) if p]
     try:
-        d = fetch_bybit(token, fiat, side, payments, amount, rows=10, verified=verified)
-        return jsonify({"ok": True, **d})
+        d, meta = get_quote("bybit", bybit_params_from_args(request.args))
+        return quote_response(d, meta)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 502
+        return _upstream_error(e)
 
 @app.route("/api/bybit/payments")
 def api_bybit_payments():
     fiat = (request.args.get("fiat") or "UAH").upper()
-    items = BYBIT_PAYMENTS_MAP.get(fiat, [])
-    items = sorted(items, key=lambda x: (x["name"].lower(), int(x["id"])))
-    return jsonify({"ok": True, "fiat": fiat, "items": items})
+    entry = BYBIT_PAYMENTS.get(fiat)
+    return fast_response(entry.body, entry.etag, stable=True)
+
+@app.route("/api/bybit/payments/search")
+def api_bybit_payments_search():
+    fiat = (request.args.get("fiat") or "UAH").upper()
+    q = request.args.get("q", "")
+    try:
+        limit = max(1, min(int(request.args.get("limit", BYBIT_SEARCH_LIMIT)), 500))
+    except ValueError:
+        limit = BYBIT_SEARCH_LIMIT
+    return jsonify({"ok": True, "fiat": fiat, "q": q, "items": BYBIT_PAYMENTS.get(fiat).search(q, limit)})
 
 @app.route("/api/xe")
 def api_xe():
-    frm = request.args.get("from", "USD").upper()
-    to  = request.args.get("to",   "UAH").upper()
     try:
-        data = fetch_xe_universal(frm, to)
-        return jsonify({"ok": True, "data": data})
+        data, meta = get_quote("xe", xe_params_from_args(request.args))
+        return quote_response(data, meta, wrap_data=True)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 502
+        return _upstream_error(e)
 
 @app.route("/api/xe/codes")
 def api_xe_codes():
-    return jsonify({"ok": True, "codes": XE_CODES})
+    body, etag = BODIES.get(xe_codes(), "codes", lambda codes: {"ok": True, "codes": codes})
+    return fast_response(body, etag, stable=True)
 
 @app.route("/api/gf_rate")
 def api_gf_rate():
-    asset = request.args.get("asset", "USD").upper()
-    fiat  = request.args.get("fiat", "UAH").upper()
     try:
-        data = fetch_gf(asset, fiat)
-        return jsonify({"ok": True, **data})
+        data, meta = get_quote("gf", gf_params_from_args(request.args))
+        return quote_response(data, meta)
     except Exception as e:
-        return jsonify({"ok": False, "error": str(e)}), 502
+        return _upstream_error(e)
 
 @app.route("/api/rates")
 def api_rates():
-    asset  = request.args.get("asset", "USDT").upper()
-    fiat   = request.args.get("fiat", "UAH").upper()
-    side   = request.args.get("side", "SELL").upper()
-    amount = request.args.get("amount", "20000")
+    params, deadline = rates_params_from_args(request.args)
+    results, errors = run_parallel({
+        name: (lambda src=src, qp=qp: get_quote(src, qp))
+        for name, (src, qp) in rates_sources(params).items()
+    }, deadline)
+    out = {}
+    for name, (data, meta) in results.items():
+        out[name] = data
+        errors[name].update(meta)
+    return jsonify(rates_payload(params, out, errors, deadline))
 
-    merchant_binance = (request.args.get("merchant_binance", "true").lower() == "true")
-    paytypes_csv     = (request.args.get("paytypes_binance") or "").strip()
-    paytypes_binance = [p for p in (paytypes_csv.split(",") if paytypes_csv else []) if p]
+@app.route("/api/spreads/matrix")
+def api_spreads_matrix():
+    """
+    ?asset=USDT&fiats=UAH,KZT&sides=BUY,SELL&amount=20000
+     &paytypes_binance=Monobank;PrivatBank&payments_bybit=43;&refs=gf,xe&top=10
+    Варианты фильтра оплат разделяются ';' (пустой вариант — без фильтра).
+    """
+    params, deadline = spread_matrix_params_from_args(request.args)
+    try:
+        return jsonify(spread_matrix(params, deadline))
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
 
-    verified_bybit = (request.args.get("verified_bybit", "false").lower() == "true")
-    payments_csv   = (request.args.get("payments_bybit") or "").strip()
-    bybit_payments = [p for p in (payments_csv.split(",") if payments_csv else []) if p]
+@app.route("/api/stream")
+def api_stream():
+    """
+    SSE: ?subs=[{"tag": "binance", "source": "binance", "params": {...}}, ...]
+    Сначала event: subscribed со связкой tag → key, затем event: quote по изменениям.
+    """
+    try:
+        raw, specs = stream_subs_from_args(request.args)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
 
-    out = {"google": None, "binance": None, "bybit": None}
-    errors = {}
+    last_raw = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    last_id = int(last_raw) if last_raw and last_raw.isdigit() else None
+    keys = STREAM_HUB.subscribe(specs)
+    tags = [{"tag": x.get("tag") or x.get("source"), "key": k} for x, k in zip(raw, keys)]
 
-    try:
-        out["binance"] = fetch_binance(asset, fiat, side, paytypes_binance, amount, rows=10, merchant=merchant_binance)
-    except Exception as e:
-        errors["binance"] = str(e)
+    def gen():
+        try:
+            yield "retry: 3000\n\n"
+            yield _sse(None, "subscribed", json.dumps(tags, ensure_ascii=False))
+            evs, after = STREAM_HUB.initial(keys, last_id)
+            for ev_id, _, body in evs:
+                yield _sse(ev_id, "quote", body)
+            last_write = time.monotonic()
+            while True:
+                evs, after = STREAM_HUB.wait(keys, after, STREAM_HEARTBEAT)
+                for ev_id, _, body in evs:
+                    yield _sse(ev_id, "quote", body)
+                now = time.monotonic()
+                if evs:
+                    last_write = now
+                elif now - last_write >= STREAM_HEARTBEAT:
+                    yield ": hb\n\n"
+                    last_write = now
+        finally:
+            STREAM_HUB.unsubscribe(keys)
 
-    try:
-        out["bybit"] = fetch_bybit(asset, fiat, side, bybit_payments, amount, rows=10, verified=verified_bybit)
-    except Exception as e:
-        errors["bybit"] = str(e)
+    return Response(stream_with_context(gen()), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
 
+@app.route("/api/quotes/batch", methods=["POST"])
+def api_quotes_batch():
+    """
+    Тело: {"specs": [{"id": "a", "source": "binance", "params": {...}}, ...], "deadline": 30}.
+    Ответ — NDJSON: строка на каждую спецификацию (index, id, source, params, status, data|error),
+    в порядке готовности; последняя строка — сводка с "done": true.
+    """
     try:
-        out["google"] = fetch_gf(asset, fiat)
-    except Exception as e:
-        errors["google"] = str(e)
+        specs, deadline = batch_params_from_json(request.get_json(force=True, silent=True))
+    except (ValueError, TypeError) as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
 
-    return jsonify({
-        "ok": True,
-        "params": {
-            "asset": asset, "fiat": fiat, "side": side, "amount": amount,
-            "merchant_binance": merchant_binance, "paytypes_binance": paytypes_binance,
-            "verified_bybit": verified_bybit, "payments_bybit": bybit_payments
-        },
-        "google": out["google"],
-        "binance": out["binance"],
-        "bybit": out["bybit"],
-        "errors": errors or None,
-        "timestamp": int(time.time())
+    def gen():
+        for line in run_batch(specs, deadline):
+            yield json.dumps(line, ensure_ascii=False, default=_json_default) + "\n"
+
+    return Response(stream_with_context(gen()), mimetype="application/x-ndjson", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
     })
 
+@app.route("/api/history")
+def api_history():
+    """?source=binance&pair=USDT-UAH&side=SELL&from=<unix>&to=<unix>&step=<сек>"""
+    if not HISTORY.enabled:
+        return jsonify({"ok": False, "error": "история отключена (P2P_HISTORY=0)"}), 503
+    source = (request.args.get("source") or "").lower()
+    pair = request.args.get("pair") or ""
+    if source not in QUOTE_SOURCES or "-" not in pair:
+        return jsonify({"ok": False, "error": "нужны source и pair вида USDT-UAH"}), 400
+    try:
+        ts_from, ts_to, step = (
+            float(request.args[name]) if request.args.get(name) else None for name in ("from", "to", "step")
+        )
+        data = HISTORY.query(source, pair, request.args.get("side", ""), ts_from, ts_to, step)
+        return jsonify({"ok": True, **data})
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except sqlite3.Error as e:
+        return jsonify({"ok": False, "error": str(e)}), 500
+
+@app.route("/api/status")
+def api_status():
+    return jsonify({"ok": True, "cache": QUOTES.stats(), "ttl": CACHE_TTL, "xe_pool": XE_BROWSER_POOL.stats(),
+                    "http": HTTP.stats(), "poller": POLLER.stats(), "extract": extract_stats(),
+                    "paytypes": BINANCE_PAYTYPES.stats(), "bybit_payments": BYBIT_PAYMENTS.stats(),
+                    "rate_graph": RATE_GRAPH.stats(), "upstreams": GUARDS.stats(), "bodies": BODIES.stats(),
+                    "shared_store": STORE.stats() if STORE is not None else None, "record": record_stats(),
+                    "catalog_cache": catalog_cache_stats(),
+                    "xe_routes": XE_ROUTES.stats(), "stream": STREAM_HUB.stats(), "history": HISTORY.stats()})
+
+# ---- метрики: коллекторы поверх уже существующих счётчиков + учёт входящих запросов
+CallbackMetric("p2p_cache_events_total", "События кэша котировок", ("event",),
+               lambda: [((k,), v) for k, v in QUOTES.stats().items()
+                        if k in ("hits", "misses", "coalesced", "stale", "evictions")], kind="counter")
+CallbackMetric("p2p_cache_hit_ratio", "Доля ответов из кэша (hits+coalesced)/всего", (),
+               lambda: [((), QUOTES.stats()["hit_ratio"] or 0.0)])
+CallbackMetric("p2p_cache_entries", "Записей в кэше котировок", (), lambda: [((), QUOTES.stats()["entries"])])
+CallbackMetric("p2p_upstream_breaker_state", "Предохранитель: 0 closed, 1 half_open, 2 open", ("upstream",),
+               lambda: [((n,), {"closed": 0, "half_open": 1, "open": 2}[st["state"]]) for n, st in GUARDS.stats().items()])
+CallbackMetric("p2p_upstream_rate_per_min", "Текущий темп адаптивного лимитера", ("upstream",),
+               lambda: [((n,), st["rate_per_min"]) for n, st in GUARDS.stats().items()])
+CallbackMetric("p2p_upstream_throttles_total", "Ответы 429 по upstream", ("upstream",),
+               lambda: [((n,), st["throttles"]) for n, st in GUARDS.stats().items()], kind="counter")
+CallbackMetric("p2p_playwright_events_total", "Запуски/падения браузера и пересоздания страниц", ("event",),
+               lambda: [(("launches",), XE_BROWSER_POOL.launches), (("crashes",), XE_BROWSER_POOL.crashes),
+                        (("recycles",), XE_BROWSER_POOL.recycles), (("navigations",), XE_BROWSER_POOL.navigations)],
+               kind="counter")
+
+@app.before_request
+def _metrics_start():
+    request.environ["p2p.t0"] = time.perf_counter()
+    REQUEST_INFLIGHT.inc()
+
+@app.after_request
+def _metrics_finish(resp):
+    t0 = request.environ.get("p2p.t0")
+    if t0 is not None:
+        rule = request.url_rule.rule if request.url_rule is not None else "other"
+        REQUEST_SECONDS.observe(time.perf_counter() - t0, rule, str(resp.status_code))
+    return resp
+
+@app.teardown_request
+def _metrics_teardown(exc):
+    if request.environ.pop("p2p.t0", None) is not None:
+        REQUEST_INFLIGHT.dec()
+
+@app.route("/metrics")
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+@app.route("/api/upstreams")
+def api_upstreams():
+    return jsonify({"ok": True, "upstreams": GUARDS.stats()})
+
 @app.route("/healthz")
 def healthz():
-    return "ok"
+    # процесс жив — всегда 200; разомкнутые предохранители видны в теле
+    down = [name for name, st in GUARDS.stats().items() if st["state"] != "closed"]
+    return "degraded: " + ", ".join(down) if down else "ok"
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True, use_reloader=False)
+    app.run(host="0.0.0.0", port=int(os.getenv("P2P_PORT", "5000")), debug=True, use_reloader=False)
@@ -114,16 +114,12 @@ async function refreshP2PRefsForPanel(panel, pair) {
 function showSpreadsForPanel(panel, basePrice) {
     const refs = __p2pRefs[panel];
     const fmtPct = (p) => (p > 0 ? '+' : '') + p.toFixed(2) + '%';
-
-    if (panel === 'xe') {
-        if (basePrice == null) { xe_spread_bin.textContent = 'N/A'; xe_spread_byb.textContent = 'N/A'; return; }
-        xe_spread_bin.textContent = (refs.bin == null) ? 'N/A' : fmtPct((refs.bin - basePrice) / basePrice * 100);
-        xe_spread_byb.textContent = (refs.byb == null) ? 'N/A' : fmtPct((refs.byb - basePrice) / basePrice * 100);
-    } else {
-        if (basePrice == null) { gf_spread_bin.textContent = 'N/A'; gf_spread_byb.textContent = 'N/A'; return; }
-        gf_spread_bin.textContent = (refs.bin == null) ? 'N/A' : fmtPct((refs.bin - basePrice) / basePrice * 100);
-        gf_spread_byb.textContent = (refs.byb == null) ? 'N/A' : fmtPct((refs.byb - basePrice) / basePrice * 100);
-    }
+    const bin = (basePrice == null || refs.bin == null) ? 'N/A' : fmtPct((refs.bin - basePrice) / basePrice * 100);
+    const byb = (basePrice == null || refs.byb == null) ? 'N/A' : fmtPct((refs.byb - basePrice) / basePrice * 100);
+    inFrame(panel + ':spread', () => {
+        setText($(panel + '_spread_bin'), bin);
+        setText($(panel + '_spread_byb'), byb);
+    });
 }
 
 
@@ -151,15 +147,20 @@ function isFavoriteForFiat(ddId, item) {
     return idx; // -1 если не нашли
 }
 
-/* сортировка: избранные идут первыми, сохраняя их относительный порядок из списка FAVORITES; остальные — по имени */
+/* сортировка: избранные идут первыми, сохраняя их относительный порядок из списка FAVORITES; остальные — по имени.
+   Ранг избранности считается один раз на элемент, а не в каждом сравнении. */
+const __collator = new Intl.Collator('ru', { sensitivity: 'base' });
 function sortFavoritesFirst(ddId, arr) {
     const fav = [];
     const rest = [];
-    arr.forEach(it => (isFavoriteForFiat(ddId, it) >= 0 ? fav.push(it) : rest.push(it)));
+    arr.forEach(it => {
+        const rank = isFavoriteForFiat(ddId, it);
+        if (rank >= 0) fav.push([rank, it]); else rest.push(it);
+    });
 
-    fav.sort((a, b) => isFavoriteForFiat(ddId, a) - isFavoriteForFiat(ddId, b));
-    rest.sort((a, b) => String(a.name || a.id || '').localeCompare(String(b.name || b.id || ''), 'ru', { sensitivity: 'base' }));
-    return [...fav, ...rest];
+    fav.sort((a, b) => a[0] - b[0]);
+    rest.sort((a, b) => __collator.compare(String(a.name || a.id || ''), String(b.name || b.id || '')));
+    return { list: [...fav.map(x => x[1]), ...rest], favIds: new Set(fav.map(x => String(x[1].id))) };
 }
 
 /* интервалы */
@@ -187,15 +188,69 @@ const $ = (id) => document.getElementById(id);
 function fmtSmart(n) { const v = Number(n); if (!isFinite(v)) return '—'; const o = v >= 1_000_000 ? { minimumFractionDigits: 0, maximumFractionDigits: 2 } : { minimumFractionDigits: 2, maximumFractionDigits: 6 }; return v.toLocaleString('ru-RU', o); }
 function fmt(n) { return Number(n).toLocaleString('ru-RU', { minimumFractionDigits: 2, maximumFractionDigits: 6 }); }
 function fmtShort(n) { return Number(n).toLocaleString('ru-RU', { maximumFractionDigits: 6 }); }
+/** свежесть данных из кэша сервера: '' либо ' · кэш 12с' */
+function fmtAge(js) { return (js && js.cached && js.age != null) ? ' · кэш ' + Math.round(js.age) + 'с' : ''; }
 function showLoader(id) { const el = $(id); if (el) el.style.display = 'flex'; }
 function hideLoader(id) { const el = $(id); if (el) el.style.display = 'none'; }
 function setAnimatedText(el, text, prevNumeric, nextNumeric) {
     if (!el) return;
-    el.textContent = text;
+    if (el.textContent !== text) el.textContent = text;
     if (typeof prevNumeric === 'number' && typeof nextNumeric === 'number' && isFinite(prevNumeric) && isFinite(nextNumeric) && prevNumeric !== nextNumeric) {
         el.classList.remove('updated'); void el.offsetWidth; el.classList.add('updated');
     }
 }
+function setText(el, text) { if (el && el.textContent !== text) el.textContent = text; }
+
+/* ===== батч отрисовки =====
+   Обновления из опроса и SSE не пишут в DOM сразу: каждое ставит задачу по ключу (панель),
+   все задачи выполняются в одном requestAnimationFrame. Повтор ключа до кадра заменяет задачу —
+   рисуется только последнее состояние; в фоновой вкладке кадров нет, и очередь не растёт. */
+const __frameJobs = new Map();
+let __frameId = 0;
+function inFrame(key, fn) {
+    __frameJobs.set(key, fn);
+    if (!__frameId) __frameId = requestAnimationFrame(flushFrame);
+}
+function flushFrame() {
+    __frameId = 0;
+    const jobs = [...__frameJobs.values()];
+    __frameJobs.clear();
+    jobs.forEach(fn => { try { fn(); } catch (err) { console.error('render failed:', err); } });
+}
+
+/* ===== таблицы объявлений: keyed-diff =====
+   Строка привязана к ключу (ник трейдера; повторы — ник#2, ник#3), переживает обновления
+   и меняет только ячейки с другим текстом; порядок правится перестановкой, лишние строки удаляются. */
+const AD_COLS = [
+    (it, i) => String(i + 1),
+    (it) => String(it.name || '-'),
+    (it) => fmt(it.price),
+    (it) => String(it.volume ?? '-'),
+    (it) => String(it.min ?? '-'),
+    (it) => String(it.max ?? '-'),
+];
+const __adRows = new WeakMap(); // tbody → Map(key → tr)
+
+function patchAdRows(tb, items) {
+    if (!tb) return;
+    const prev = __adRows.get(tb) || new Map();
+    const next = new Map();
+    const seen = new Map();
+    items.forEach((it, i) => {
+        const base = String(it.name || '-');
+        const n = (seen.get(base) || 0) + 1; seen.set(base, n);
+        const key = n > 1 ? base + '#' + n : base;
+        let tr = prev.get(key);
+        if (tr) prev.delete(key);
+        else { tr = document.createElement('tr'); AD_COLS.forEach(() => tr.appendChild(document.createElement('td'))); }
+        AD_COLS.forEach((col, c) => setText(tr.cells[c], col(it, i)));
+        const at = tb.children[i];
+        if (at !== tr) tb.insertBefore(tr, at || null);
+        next.set(key, tr);
+    });
+    prev.forEach(tr => tr.remove());
+    __adRows.set(tb, next);
+}
 
 /* ===== раскрытие блоков фильтров (контейнеры) ===== */
 function toggleFilters(id, btn) {
@@ -274,8 +329,8 @@ function buildMenuSkeleton(ddId, triggerRect, maxWidth = 520) {
         padding: '8px'
     });
     const input = document.createElement('input');
-    input.id = ddId + '_search';
     input.placeholder = 'Поиск метода...';
+    input.value = searchState[ddId] || '';
     Object.assign(input.style, {
         width: '100%', padding: '10px 12px',
         borderRadius: '10px', border: '1px solid var(--border, #242a36)',
@@ -347,10 +402,7 @@ function buildMenuSkeleton(ddId, triggerRect, maxWidth = 520) {
     });
 
     // поиск
-    input.addEventListener('input', () => {
-        searchState[ddId] = (input.value || '').toLowerCase().trim();
-        renderDropdownOptions(ddId);
-    });
+    input.addEventListener('input', () => onSearchInput(ddId, input));
     // фокус сразу
     setTimeout(() => input.focus(), 0);
 
@@ -396,13 +448,7 @@ function mdropToggle(ddId) {
         renderDropdownOptions(ddId);
         window.addEventListener('keydown', escCloser, true);
         window.addEventListener('resize', closeAllDropdowns, true);
-        window.addEventListener('scroll', (e) => {
-            // если скроллится именно выпадашка (.mdrop-fly или её содержимое) — не закрываем
-            if (e.target.closest && e.target.closest('.mdrop-fly')) {
-                return;
-            }
-            closeAllDropdowns();
-        }, true);
+        window.addEventListener('scroll', scrollCloser, true);
     } catch (err) {
         console.error('mdropToggle error:', err);
         // фолбэк на встроенное меню под кнопкой
@@ -426,45 +472,13 @@ document.addEventListener('click', function (e) {
         console.error('delegated mdrop click failed:', err);
     }
 }, true);
-function openInline(ddId) {
-    const root = document.getElementById(ddId);
-    const menu = root?.querySelector('.mdrop-menu');
-    if (!menu) return;
-    menu.style.display = 'flex';
-
-    const input = document.getElementById(ddId + '_search');
-    if (input) {
-        input.value = searchState[ddId] || '';
-        input.oninput = () => {
-            searchState[ddId] = (input.value || '').toLowerCase().trim();
-            renderDropdownOptions(ddId);
-        };
-        setTimeout(() => input.focus(), 0);
-    }
-
-    // кнопки подтверждения/сброса
-    if (!menu.__wired) {
-        menu.addEventListener('click', (e) => {
-            e.stopPropagation();
-            if (e.target.closest('.js-confirm')) {
-                if (ddId === 'dd_binance') selectedBinance = new Set([...tempSelected[ddId]]);
-                if (ddId === 'dd_bybit') selectedBybit = new Set([...tempSelected[ddId]]);
-                updateCounters(); refreshNow(); closeAllDropdowns(); return;
-            }
-            if (e.target.closest('.js-reset')) {
-                tempSelected[ddId] = new Set(); renderDropdownOptions(ddId);
-                const cnt = document.getElementById(ddId === 'dd_binance' ? 'dd_binance_count' : 'dd_bybit_count');
-                if (cnt) cnt.textContent = '0';
-            }
-        });
-        menu.__wired = true;
-    }
-
-    renderDropdownOptions(ddId);
-}
-
 
 function escCloser(e) { if (e.key === 'Escape') closeAllDropdowns(); }
+/* прокрутка страницы закрывает меню; прокрутка самой выпадашки (.mdrop-fly или её содержимого) — нет */
+function scrollCloser(e) {
+    if (e.target.closest && e.target.closest('.mdrop-fly')) return;
+    closeAllDropdowns();
+}
 
 function openInline(ddId) {
     const root = document.getElementById(ddId);
@@ -476,10 +490,8 @@ function openInline(ddId) {
     const input = document.getElementById(ddId + '_search');
     if (input) {
         input.value = searchState[ddId] || '';
-        input.oninput = () => {
-            searchState[ddId] = (input.value || '').toLowerCase().trim();
-            renderDropdownOptions(ddId);
-        };
+        input.oninput = () => onSearchInput(ddId, input);
+        setTimeout(() => input.focus(), 0);
     }
     // кнопки
     wireInlineMenu(ddId);
@@ -508,38 +520,6 @@ function wireInlineMenu(ddId) {
     menu.__wired = true;
 }
 
-/* универсальная отрисовка плиток: сначала ищем грид в портале, иначе — во встроенном меню */
-function renderDropdownOptions(ddId) {
-    const isBin = ddId === 'dd_binance';
-    const items = filteredItems(ddId);
-    const portal = document.getElementById('__mdrop_portal');
-    const portalGrid = portal?.querySelector('#' + (isBin ? 'dd_binance_grid' : 'dd_bybit_grid'));
-    const inlineGrid = document.getElementById(isBin ? 'dd_binance_grid' : 'dd_bybit_grid');
-    const grid = portalGrid || inlineGrid;
-    if (!grid) return;
-
-    grid.innerHTML = '';
-    const temp = tempSelected[ddId];
-
-    items.forEach(it => {
-        const id = String(it.id), name = it.name || id;
-        const pill = document.createElement('div');
-        pill.className = 'mdrop-pill' + (temp.has(id) ? ' active' : '');
-        pill.textContent = name;
-        pill.title = name;
-        pill.addEventListener('click', () => {
-            if (temp.has(id)) temp.delete(id); else temp.add(id);
-            pill.classList.toggle('active');
-            const cnt = document.getElementById(isBin ? 'dd_binance_count' : 'dd_bybit_count');
-            if (cnt) cnt.textContent = String(temp.size);
-        });
-        grid.appendChild(pill);
-    });
-
-    const cnt = document.getElementById(isBin ? 'dd_binance_count' : 'dd_bybit_count');
-    if (cnt) cnt.textContent = String(temp.size);
-}
-
 /* закрыть всё: и портал, и встроенные меню */
 function closeAllDropdowns() {
     // встроенные
@@ -557,63 +537,144 @@ function closeAllDropdowns() {
 
     window.removeEventListener('keydown', escCloser, true);
     window.removeEventListener('resize', closeAllDropdowns, true);
-    window.removeEventListener('scroll', closeAllDropdowns, true);
+    window.removeEventListener('scroll', scrollCloser, true);
 }
 
 
-/* ===== логика плиток и поиска ===== */
+/* ===== логика плиток и поиска =====
+   Отфильтрованный и отсортированный список запоминается на (список, запрос, фиат): прокрутка
+   и повторные открытия меню его не пересчитывают. */
+const __pickCache = { dd_binance: null, dd_bybit: null };
+const __haystack = new WeakMap(); // item → строка для поиска
 function filteredItems(ddId) {
     const list = (ddId === 'dd_binance') ? binanceItems : bybitItems;
     const q = (searchState[ddId] || '').toLowerCase().trim();
+    const fiat = (document.getElementById('fiat')?.value || '').toUpperCase();
+    const c = __pickCache[ddId];
+    if (c && c.list === list && c.q === q && c.fiat === fiat) return c;
     let arr = list;
     if (q) {
-        arr = list.filter(it => (String(it.name || '') + ' ' + String(it.id || '')).toLowerCase().includes(q));
+        arr = list.filter(it => {
+            let h = __haystack.get(it);
+            if (h === undefined) { h = (String(it.name || '') + ' ' + String(it.id || '')).toLowerCase(); __haystack.set(it, h); }
+            return h.includes(q);
+        });
     }
-    return sortFavoritesFirst(ddId, arr);
+    return (__pickCache[ddId] = { list, q, fiat, ...sortFavoritesFirst(ddId, arr) });
+}
+
+/* поиск по методам: отрисовка — через SEARCH_DEBOUNCE_MS после последнего нажатия */
+const SEARCH_DEBOUNCE_MS = 150;
+const __searchTimers = {};
+function onSearchInput(ddId, input) {
+    input = input || document.getElementById(ddId + '_search');
+    if (!input) return;
+    clearTimeout(__searchTimers[ddId]);
+    __searchTimers[ddId] = setTimeout(() => {
+        const q = (input.value || '').toLowerCase().trim();
+        if (q === searchState[ddId]) return;
+        searchState[ddId] = q;
+        const view = pickerView(ddId);
+        if (view) view.scroller.scrollTop = 0;
+        renderDropdownOptions(ddId);
+    }, SEARCH_DEBOUNCE_MS);
+}
+
+/* ===== виртуализация списка методов =====
+   В сетке (2 колонки, строка PICK_ROW_H = высота плитки + зазор) живут только плитки видимых строк
+   плюс PICK_OVERSCAN сверху и снизу; остальная высота списка — отступами сетки. Плитки
+   переиспользуются по id, клики обрабатывает один делегированный обработчик на сетке. */
+const PICK_COLS = 2, PICK_PILL_H = 34, PICK_ROW_H = PICK_PILL_H + 8, PICK_OVERSCAN = 4;
+const __pickViews = new WeakMap(); // grid → {ddId, grid, scroller, pills: Map(id → pill)}
+
+function pickerGrid(ddId) {
+    const gridId = ddId === 'dd_binance' ? 'dd_binance_grid' : 'dd_bybit_grid';
+    // сначала грид в портале, иначе — во встроенном меню
+    return $('__mdrop_portal')?.querySelector('#' + gridId) || document.getElementById(gridId);
+}
+
+function pickerView(ddId) {
+    const grid = pickerGrid(ddId);
+    if (!grid) return null;
+    let view = __pickViews.get(grid);
+    if (view) return view;
+    view = { ddId, grid, scroller: grid.closest('.mdrop-body') || grid.parentElement, pills: new Map() };
+    grid.addEventListener('click', (e) => {
+        const pill = e.target.closest('.mdrop-pill');
+        if (!pill) return;
+        const temp = tempSelected[ddId];
+        const id = pill.dataset.id;
+        if (temp.has(id)) temp.delete(id); else temp.add(id);
+        setPillActive(pill, temp.has(id));
+        updatePickCount(ddId);
+    });
+    view.scroller.addEventListener('scroll', () => inFrame(ddId + ':pick', () => renderPickerWindow(view)), { passive: true });
+    __pickViews.set(grid, view);
+    return view;
 }
 
 function renderDropdownOptions(ddId) {
-    const isBin = ddId === 'dd_binance';
-    const list = filteredItems(ddId);
-    const portal = $('__mdrop_portal');
-    if (!portal) return;
-    const grid = portal.querySelector('#' + (isBin ? 'dd_binance_grid' : 'dd_bybit_grid'));
-    if (!grid) return;
-    grid.innerHTML = '';
+    const view = pickerView(ddId);
+    if (view) renderPickerWindow(view);
+    updatePickCount(ddId);
+}
 
-    const temp = tempSelected[ddId];
+function renderPickerWindow(view) {
+    const { ddId, grid, scroller } = view;
+    const { list, favIds } = filteredItems(ddId);
+    const rows = Math.ceil(list.length / PICK_COLS);
+    const gridTop = grid.getBoundingClientRect().top - scroller.getBoundingClientRect().top + scroller.scrollTop;
+    const y = scroller.scrollTop - gridTop;
+    const visible = Math.ceil((scroller.clientHeight || 420) / PICK_ROW_H);
+    // список укоротился (поиск), а прокрутка ещё старая — показываем его конец, а не пустое окно
+    const first = Math.max(0, Math.min(Math.floor(y / PICK_ROW_H) - PICK_OVERSCAN, rows - visible - PICK_OVERSCAN));
+    const last = Math.min(rows, Math.max(Math.ceil(y / PICK_ROW_H) + visible, first + visible) + PICK_OVERSCAN);
 
-    list.forEach(it => {
-        const id = String(it.id);
-        const name = it.name || id;
-
-        const isFavIdx = isFavoriteForFiat(ddId, it);
-        const pill = document.createElement('div');
-        pill.className = 'mdrop-pill' + (temp.has(id) ? ' active' : '') + (isFavIdx >= 0 ? ' fav' : '');
-        pill.innerHTML = (isFavIdx >= 0 ? '<span class="fav-star" title="Избранный метод">★</span>' : '') +
-            '<span class="pill-title"></span>';
-        pill.querySelector('.pill-title').textContent = name;
-
-        Object.assign(pill.style, pillStyle(temp.has(id)));
-        pill.title = name;
-
-        pill.addEventListener('click', () => {
-            if (temp.has(id)) temp.delete(id); else temp.add(id);
-            Object.assign(pill.style, pillStyle(temp.has(id)));
-            const cnt = $(isBin ? 'dd_binance_count' : 'dd_bybit_count');
-            if (cnt) cnt.textContent = String(temp.size);
-        });
+    grid.style.paddingTop = (first * PICK_ROW_H) + 'px';
+    grid.style.paddingBottom = (Math.max(0, rows - last) * PICK_ROW_H) + 'px';
 
-        grid.appendChild(pill);
+    const temp = tempSelected[ddId];
+    const old = view.pills;
+    const next = new Map();
+    list.slice(first * PICK_COLS, last * PICK_COLS).forEach((it, i) => {
+        const id = String(it.id);
+        let pill = old.get(id);
+        if (pill) old.delete(id); else { pill = document.createElement('div'); pill.dataset.id = id; }
+        fillPill(pill, it.name || id, favIds.has(id));
+        setPillActive(pill, temp.has(id));
+        const at = grid.children[i];
+        if (at !== pill) grid.insertBefore(pill, at || null);
+        next.set(id, pill);
     });
+    old.forEach(pill => pill.remove());
+    view.pills = next;
+}
+
+function fillPill(pill, name, fav) {
+    if (pill.__name === name && pill.__fav === fav) return;
+    pill.__name = name; pill.__fav = fav;
+    pill.classList.add('mdrop-pill');
+    pill.classList.toggle('fav', fav);
+    pill.innerHTML = (fav ? '<span class="fav-star" title="Избранный метод">★</span>' : '') + '<span class="pill-title"></span>';
+    pill.querySelector('.pill-title').textContent = name;
+    pill.title = name;
+}
 
-    const cnt = $(isBin ? 'dd_binance_count' : 'dd_bybit_count');
-    if (cnt) cnt.textContent = String(temp.size);
+function setPillActive(pill, active) {
+    if (pill.__active === active) return;
+    pill.__active = active;
+    pill.classList.toggle('active', active);
+    Object.assign(pill.style, pillStyle(active));
+}
+
+function updatePickCount(ddId) {
+    setText($(ddId === 'dd_binance' ? 'dd_binance_count' : 'dd_bybit_count'), String(tempSelected[ddId].size));
 }
 
 function pillStyle(active) {
     return {
-        minHeight: '34px',
+        height: PICK_PILL_H + 'px',      // фиксированная высота — на ней держится виртуализация
+        boxSizing: 'border-box',
         padding: '6px 10px',
         borderRadius: '10px',
         border: '1px solid ' + (active ? 'color-mix(in oklab, var(--accent, #22c55e) 80%, var(--border, #242a36))' : 'var(--border, #242a36)'),
@@ -637,7 +698,31 @@ function updateCounters() {
     $('dd_bybit_count').textContent = String(selectedBybit.size);
 }
 
-/* ===== API-справочники ===== */
+/* ===== API-справочники =====
+   Ответ запоминается вместе с ETag; повторный запрос идёт с If-None-Match, и на 304 список
+   остаётся тем же объектом — меню, кэш фильтрации и выбранные методы не пересобираются. */
+const __catalogs = new Map(); // url → {etag, items}; последние CATALOGS_KEEP адресов
+const CATALOGS_KEEP = 16;
+async function fetchCatalog(url) {
+    const prev = __catalogs.get(url);
+    const r = await fetch(url, { cache: 'no-store', headers: prev?.etag ? { 'If-None-Match': prev.etag } : {} });
+    if (r.status === 304 && prev) return prev.items;
+    const js = await r.json();
+    const items = js.items || [];
+    __catalogs.delete(url);
+    __catalogs.set(url, { etag: r.headers.get('ETag'), items });
+    if (__catalogs.size > CATALOGS_KEEP) __catalogs.delete(__catalogs.keys().next().value);
+    return items;
+}
+
+/** выкинуть из выбора методы, которых нет в новом списке; если меню открыто — перерисовать */
+function applyCatalog(ddId, items, selected) {
+    const ids = new Set(items.map(it => String(it.id)));
+    [...selected].forEach(id => { if (!ids.has(id)) selected.delete(id); });
+    updateCounters();
+    if ($(ddId)?.classList.contains('open')) renderDropdownOptions(ddId);
+}
+
 async function loadBinancePaytypes() {
     const asset = $('asset').value;
     const fiat = $('fiat').value;
@@ -646,10 +731,11 @@ async function loadBinancePaytypes() {
     const merch = $('merchant_binance')?.checked ? 'true' : 'false';
     const url = '/api/binance/paytypes?' + new URLSearchParams({ asset, fiat, side, amount, merchant_binance: merch });
     try {
-        const r = await fetch(url); const js = await r.json();
-        binanceItems = js.items || [];
-        [...selectedBinance].forEach(id => { if (!binanceItems.find(it => String(it.id) === id)) selectedBinance.delete(id); });
-        updateCounters(); return binanceItems;
+        const items = await fetchCatalog(url);
+        if (items === binanceItems) return binanceItems;
+        binanceItems = items;
+        applyCatalog('dd_binance', binanceItems, selectedBinance);
+        return binanceItems;
     } catch {
         binanceItems = []; selectedBinance.clear(); updateCounters(); return [];
     }
@@ -657,10 +743,11 @@ async function loadBinancePaytypes() {
 async function loadBybitPayments() {
     const fiat = $('fiat').value;
     try {
-        const r = await fetch('/api/bybit/payments?fiat=' + encodeURIComponent(fiat)); const js = await r.json();
-        bybitItems = js.items || [];
-        [...selectedBybit].forEach(id => { if (!bybitItems.find(it => String(it.id) === id)) selectedBybit.delete(id); });
-        updateCounters(); return bybitItems;
+        const items = await fetchCatalog('/api/bybit/payments?fiat=' + encodeURIComponent(fiat));
+        if (items === bybitItems) return bybitItems;
+        bybitItems = items;
+        applyCatalog('dd_bybit', bybitItems, selectedBybit);
+        return bybitItems;
     } catch { bybitItems = []; selectedBybit.clear(); updateCounters(); return []; }
 }
 
@@ -679,6 +766,34 @@ function paramsFromUI() {
 }
 
 /* ===== загрузка котировок ===== */
+/** отрисовка карточки p2p (prefix: 'binance' | 'bybit'); возвращает новый AVG или null */
+function renderP2P(prefix, data, fiat, prevAvg) {
+    if (!data || !data.ok) {
+        inFrame(prefix, () => {
+            const e = $(prefix + '_error');
+            e.style.display = ''; setText(e, data ? 'Ошибка: ' + (data.error || 'unknown') : 'Ошибка сети');
+            $(prefix + '_status').style.display = 'none';
+            setText($(prefix + '_avg'), '—'); setText($(prefix + '_prices'), '—'); patchAdRows($(prefix + '_tbody'), []);
+        });
+        return null;
+    }
+    const next = data.avg ?? null;
+    inFrame(prefix, () => {
+        const ok = $(prefix + '_status');
+        $(prefix + '_error').style.display = 'none'; ok.style.display = ''; setText(ok, 'OK' + fmtAge(data));
+        setAnimatedText($(prefix + '_avg'), (next != null ? fmt(next) : '—') + ' ' + fiat, prevAvg, next);
+        setText($(prefix + '_prices'), data.prices && data.prices.length ? ('#3–5: ' + data.prices.slice(2, 5).map(fmt).join(' • ')) : '—');
+        patchAdRows($(prefix + '_tbody'), data.items || []);
+    });
+    return next;
+}
+
+/** отметка «обновлено: ЧЧ:ММ:СС» — тоже в кадре */
+function stampUpdated() {
+    const text = '• обновлено: ' + new Date().toLocaleTimeString('ru-RU');
+    inFrame('ts', () => setText($('ts'), text));
+}
+
 async function loadBinance() {
     const p = paramsFromUI();
     const url = '/api/binance_rate?' + new URLSearchParams({
@@ -688,26 +803,9 @@ async function loadBinance() {
     showLoader('binance_loader');
     try {
         const res = await fetch(url); const data = await res.json();
-        const e = $('binance_error'); const ok = $('binance_status');
-        if (!data.ok) {
-            e.style.display = ''; e.textContent = 'Ошибка: ' + (data.error || 'unknown'); ok.style.display = 'none';
-            $('binance_avg').textContent = '—'; $('binance_prices').textContent = '—'; $('binance_tbody').innerHTML = ''; lastBinanceAvg = null;
-        } else {
-            e.style.display = 'none'; ok.style.display = '';
-            const next = data.avg ?? null;
-            setAnimatedText($('binance_avg'), (next != null ? fmt(next) : '—') + ' ' + p.fiat, lastBinanceAvg, next);
-            $('binance_prices').textContent = data.prices && data.prices.length ? ('#3–5: ' + data.prices.slice(2, 5).map(fmt).join(' • ')) : '—';
-            const tb = $('binance_tbody'); tb.innerHTML = '';
-            (data.items || []).forEach((it, i) => {
-                const tr = document.createElement('tr');
-                tr.innerHTML = `<td>${i + 1}</td><td>${it.name || '-'}</td><td>${fmt(it.price)}</td><td>${it.volume ?? '-'}</td><td>${it.min ?? '-'}</td><td>${it.max ?? '-'}</td>`;
-                tb.appendChild(tr);
-            });
-            lastBinanceAvg = next;
-        }
+        lastBinanceAvg = renderP2P('binance', data, p.fiat, lastBinanceAvg);
     } catch {
-        const e = $('binance_error'); e.style.display = ''; e.textContent = 'Ошибка сети';
-        $('binance_status').style.display = 'none'; $('binance_avg').textContent = '—'; $('binance_prices').textContent = '—'; $('binance_tbody').innerHTML = ''; lastBinanceAvg = null;
+        lastBinanceAvg = renderP2P('binance', null, p.fiat, lastBinanceAvg);
     } finally { hideLoader('binance_loader'); updateSpreads(); }
 }
 
@@ -720,26 +818,9 @@ async function loadBybit() {
     showLoader('bybit_loader');
     try {
         const res = await fetch(url); const data = await res.json();
-        const e = $('bybit_error'); const ok = $('bybit_status');
-        if (!data.ok) {
-            e.style.display = ''; e.textContent = 'Ошибка: ' + (data.error || 'unknown'); ok.style.display = 'none';
-            $('bybit_avg').textContent = '—'; $('bybit_prices').textContent = '—'; $('bybit_tbody').innerHTML = ''; lastBybitAvg = null;
-        } else {
-            e.style.display = 'none'; ok.style.display = '';
-            const next = data.avg ?? null;
-            setAnimatedText($('bybit_avg'), (next != null ? fmt(next) : '—') + ' ' + p.fiat, lastBybitAvg, next);
-            $('bybit_prices').textContent = data.prices && data.prices.length ? ('#3–5: ' + data.prices.slice(2, 5).map(fmt).join(' • ')) : '—';
-            const tb = $('bybit_tbody'); tb.innerHTML = '';
-            (data.items || []).forEach((it, i) => {
-                const tr = document.createElement('tr');
-                tr.innerHTML = `<td>${i + 1}</td><td>${it.name || '-'}</td><td>${fmt(it.price)}</td><td>${it.volume ?? '-'}</td><td>${it.min ?? '-'}</td><td>${it.max ?? '-'}</td>`;
-                tb.appendChild(tr);
-            });
-            lastBybitAvg = next;
-        }
+        lastBybitAvg = renderP2P('bybit', data, p.fiat, lastBybitAvg);
     } catch {
-        const e = $('bybit_error'); e.style.display = ''; e.textContent = 'Ошибка сети';
-        $('bybit_status').style.display = 'none'; $('bybit_avg').textContent = '—'; $('bybit_prices').textContent = '—'; $('bybit_tbody').innerHTML = ''; lastBybitAvg = null;
+        lastBybitAvg = renderP2P('bybit', null, p.fiat, lastBybitAvg);
     } finally { hideLoader('bybit_loader'); updateSpreads(); }
 }
 
@@ -788,6 +869,37 @@ function updateQuery(params) {
 }
 function applyXE() { refreshXENow(); const pr = currentXePair(); if (pr) updateQuery({ xe_from: pr.from, xe_to: pr.to }); }
 
+/** отрисовка XE; js — ответ /api/xe (или null при сетевой ошибке); true — если цена есть */
+function renderXE(js, pr) {
+    const pair = `${pr.from}-${pr.to}`;
+    if (js && js.ok) {
+        const d = js.data;
+        const next = d.price;
+        const prev = window.__lastXePrice;
+        window.__lastXePrice = next;
+        inFrame('xe', () => {
+            setText($('xe_pair'), pair);
+            $('xe_error').style.display = 'none';
+            setAnimatedText($('xe_price'), fmtSmart(next) + ' ' + pr.to, prev, next);
+            setText($('xe_ts'), 'TS: ' + new Date(d.ts * 1000).toLocaleTimeString('ru-RU') + fmtAge(js));
+            setText($('xe_src'), d.source || 'xe');
+            $('xe_link').href = d.url || '#';
+        });
+        return true;
+    }
+    window.__lastXePrice = null;
+    inFrame('xe', () => {
+        const err = $('xe_error');
+        setText($('xe_pair'), pair);
+        err.style.display = '';
+        setText(err, js ? 'Ошибка XE: ' + (js.error || 'unknown') : 'Ошибка сети/парсинга XE');
+        ['xe_price', 'xe_ts', 'xe_src'].forEach(id => setText($(id), '—'));
+        $('xe_link').href = '#';
+    });
+    showSpreadsForPanel('xe', null);
+    return false;
+}
+
 async function loadXE() {
     const pr = currentXePair();
     const err = $('xe_error');
@@ -799,46 +911,13 @@ async function loadXE() {
     try {
         const r = await fetch(url);
         const js = await r.json();
-        $('xe_pair').textContent = `${pr.from}-${pr.to}`;
-
-        if (js.ok) {
-            // УСПЕХ
-            err.style.display = 'none';
-            const d = js.data;
-            const next = d.price;
-
-            setAnimatedText($('xe_price'), fmtSmart(next) + ' ' + pr.to, window.__lastXePrice, next);
-            $('xe_ts').textContent = 'TS: ' + new Date(d.ts * 1000).toLocaleTimeString('ru-RU');
-            $('xe_src').textContent = d.source || 'xe';
-            $('xe_link').href = d.url || '#';
-            window.__lastXePrice = next;
-
+        if (renderXE(js, pr)) {
             // подтягиваем p2p-референсы под ЭТУ ЖЕ пару и рисуем спреды
             await refreshP2PRefsForPanel('xe', pr);
-            showSpreadsForPanel('xe', next);
-        } else {
-            // ОШИБКА ОТ БЭКЕНДА
-            err.style.display = '';
-            err.textContent = 'Ошибка XE: ' + (js.error || 'unknown');
-            $('xe_price').textContent = '—';
-            $('xe_ts').textContent = '—';
-            $('xe_src').textContent = '—';
-            $('xe_link').href = '#';
-            $('xe_spread_bin').textContent = 'N/A';
-            $('xe_spread_byb').textContent = 'N/A';
-            window.__lastXePrice = null;
+            showSpreadsForPanel('xe', window.__lastXePrice);
         }
     } catch {
-        // СЕТЕВАЯ/ПАРСИНГ-ОШИБКА
-        err.style.display = '';
-        err.textContent = 'Ошибка сети/парсинга XE';
-        $('xe_price').textContent = '—';
-        $('xe_ts').textContent = '—';
-        $('xe_src').textContent = '—';
-        $('xe_link').href = '#';
-        $('xe_spread_bin').textContent = 'N/A';
-        $('xe_spread_byb').textContent = 'N/A';
-        window.__lastXePrice = null;
+        renderXE(null, pr);
     } finally {
         hideLoader('xe_loader');
         updateSpreads(); // теперь пустышка — оставлена для совместимости
@@ -847,69 +926,173 @@ async function loadXE() {
 /* ===== Google Finance ===== */
 function currentGfPair() { const f = ($('gf_from').value || '').toUpperCase().trim(); const t = ($('gf_to').value || '').toUpperCase().trim(); if (!f || !t) return null; return { from: f, to: t }; }
 function applyGF() { refreshGFNow(); const pr = currentGfPair(); if (pr) updateQuery({ gf_from: pr.from, gf_to: pr.to }); }
+/** отрисовка GF; js — ответ /api/gf_rate (или null при сетевой ошибке); true — если цена есть */
+function renderGF(js, pr) {
+    const pair = `${pr.from}-${pr.to}`;
+    if (js && js.ok) {
+        const next = js.price;
+        const prev = lastGfPrice;
+        lastGfPrice = next;
+        inFrame('gf', () => {
+            setText($('gf_pair'), pair);
+            $('gf_error').style.display = 'none';
+            setAnimatedText($('gf_price'), fmtShort(next) + ' ' + pr.to, prev, next);
+            setText($('gf_ts'), 'TS: ' + new Date(js.ts * 1000).toLocaleTimeString('ru-RU') + fmtAge(js));
+            $('gf_link').href = js.url || '#';
+        });
+        return true;
+    }
+    lastGfPrice = null;
+    inFrame('gf', () => {
+        const e = $('gf_error');
+        setText($('gf_pair'), pair);
+        e.style.display = '';
+        setText(e, js ? 'GF ошибка: ' + (js.error || 'unknown') : 'Ошибка сети/парсинга GF');
+        ['gf_price', 'gf_ts'].forEach(id => setText($(id), '—'));
+        $('gf_link').href = '#';
+    });
+    showSpreadsForPanel('gf', null);
+    return false;
+}
+
 async function loadGF() {
     const pr = currentGfPair();
     const e = $('gf_error');
     if (!pr) { e.style.display = ''; e.textContent = 'Укажите пары GF (From/To).'; return; }
 
-    $('gf_pair').textContent = `${pr.from}-${pr.to}`;
     const url = '/api/gf_rate?' + new URLSearchParams({ asset: pr.from, fiat: pr.to });
     showLoader('gf_loader');
 
     try {
         const r = await fetch(url);
         const js = await r.json();
-
-        if (js.ok) {
-            // УСПЕХ
-            e.style.display = 'none';
-            const next = js.price;
-
-            setAnimatedText($('gf_price'), fmtShort(next) + ' ' + pr.to, lastGfPrice, next);
-            $('gf_ts').textContent = 'TS: ' + new Date(js.ts * 1000).toLocaleTimeString('ru-RU');
-            $('gf_link').href = js.url || '#';
-            lastGfPrice = next;
-
+        if (renderGF(js, pr)) {
             await refreshP2PRefsForPanel('gf', pr);
-            showSpreadsForPanel('gf', next);
-        } else {
-            // ОШИБКА ОТ БЭКЕНДА
-            e.style.display = '';
-            e.textContent = 'GF ошибка: ' + (js.error || 'unknown');
-            $('gf_price').textContent = '—';
-            $('gf_ts').textContent = '—';
-            $('gf_link').href = '#';
-            $('gf_spread_bin').textContent = 'N/A';
-            $('gf_spread_byb').textContent = 'N/A';
-            lastGfPrice = null;
+            showSpreadsForPanel('gf', lastGfPrice);
         }
     } catch {
-        // СЕТЕВАЯ/ПАРСИНГ-ОШИБКА
-        e.style.display = '';
-        e.textContent = 'Ошибка сети/парсинга GF';
-        $('gf_price').textContent = '—';
-        $('gf_ts').textContent = '—';
-        $('gf_link').href = '#';
-        $('gf_spread_bin').textContent = 'N/A';
-        $('gf_spread_byb').textContent = 'N/A';
-        lastGfPrice = null;
+        renderGF(null, pr);
     } finally {
         hideLoader('gf_loader');
         updateSpreads();
     }
-} function refreshGFNow() { loadGF(); if (gfTimer) clearInterval(gfTimer); gfTimer = setInterval(loadGF, GF_REFRESH_MS); }
+}
+function refreshGFNow() {
+    if (streamActive()) { showLoader('gf_loader'); restartStream(); return; }
+    loadGF(); if (gfTimer) clearInterval(gfTimer); gfTimer = setInterval(loadGF, GF_REFRESH_MS);
+}
+
+/* ===== поток обновлений (SSE) =====
+   Один EventSource на вкладку: сервер шлёт только изменившиеся котировки подписанных пар.
+   Если EventSource недоступен или поток не поднимается — откатываемся на setInterval-опрос. */
+let stream = null;
+let streamBroken = !window.EventSource;
+let streamFailures = 0;
+let streamRestartTimer = null;
+const streamTags = new Map(); // key → [tag, ...]
+
+function streamActive() { return !streamBroken; }
+
+/** подписки под текущее состояние UI: tag → {source, params} */
+function streamSubs() {
+    const p = paramsFromUI();
+    const binParams = (asset, fiat) => ({ asset, fiat, side: p.side, amount: p.amount, pay_types: p.paytypes_binance, merchant: p.merchant_binance });
+    const bybParams = (asset, fiat) => ({ asset, fiat, side: p.side, amount: p.amount, payments: p.payments_bybit, verified: p.verified_bybit });
+    const subs = [
+        { tag: 'binance', source: 'binance', params: binParams(p.asset, p.fiat) },
+        { tag: 'bybit', source: 'bybit', params: bybParams(p.asset, p.fiat) },
+    ];
+    const xe = currentXePair(); const gf = currentGfPair();
+    if (xe) subs.push({ tag: 'xe', source: 'xe', params: { from: xe.from, to: xe.to } });
+    if (gf) subs.push({ tag: 'gf', source: 'gf', params: { asset: gf.from, fiat: gf.to } });
+    // p2p-референсы для спредов XE/GF — те же пары, что и у панелей
+    [['xe', xe], ['gf', gf]].forEach(([panel, pr]) => {
+        __p2pRefs[panel].pair = pr ? `${pr.from}-${pr.to}` : null;
+        __p2pRefs[panel].bin = null; __p2pRefs[panel].byb = null;
+        if (!pr || !isPairSupportedOnP2P(pr.from, pr.to)) return;
+        const A = mapAssetForP2P(pr.from);
+        subs.push({ tag: panel + '_ref_bin', source: 'binance', params: binParams(A, pr.to) });
+        subs.push({ tag: panel + '_ref_byb', source: 'bybit', params: bybParams(A, pr.to) });
+    });
+    return subs;
+}
+
+function onStreamQuote(tag, msg) {
+    const js = msg.ok ? { ok: true, ...msg.data, cached: msg.cached, age: msg.age } : { ok: false, error: msg.error };
+    const fiat = (msg.params && msg.params.fiat) || $('fiat').value;
+    if (tag === 'binance') {
+        lastBinanceAvg = renderP2P('binance', js, fiat, lastBinanceAvg); hideLoader('binance_loader');
+        stampUpdated();
+    } else if (tag === 'bybit') {
+        lastBybitAvg = renderP2P('bybit', js, fiat, lastBybitAvg); hideLoader('bybit_loader');
+        stampUpdated();
+    } else if (tag === 'xe') {
+        const pr = currentXePair(); hideLoader('xe_loader');
+        if (pr && renderXE(msg.ok ? { ok: true, data: msg.data, cached: msg.cached, age: msg.age } : js, pr)) showSpreadsForPanel('xe', window.__lastXePrice);
+    } else if (tag === 'gf') {
+        const pr = currentGfPair(); hideLoader('gf_loader');
+        if (pr && renderGF(js, pr)) showSpreadsForPanel('gf', lastGfPrice);
+    } else {
+        // xe_ref_bin / gf_ref_byb ...
+        const [panel, , ex] = tag.split('_');
+        const avg = (msg.ok && msg.data && msg.data.avg != null) ? Number(msg.data.avg) : null;
+        __p2pRefs[panel][ex] = avg;
+        const base = panel === 'xe' ? window.__lastXePrice : lastGfPrice;
+        if (base != null) showSpreadsForPanel(panel, base);
+    }
+}
+
+function openStream() {
+    if (stream) { stream.close(); stream = null; }
+    streamTags.clear();
+    const es = new EventSource('/api/stream?' + new URLSearchParams({ subs: JSON.stringify(streamSubs()) }));
+    stream = es;
+    es.addEventListener('open', () => { streamFailures = 0; });
+    es.addEventListener('subscribed', (ev) => {
+        streamTags.clear();
+        JSON.parse(ev.data).forEach(({ tag, key }) => {
+            if (!streamTags.has(key)) streamTags.set(key, []);
+            streamTags.get(key).push(tag);
+        });
+    });
+    es.addEventListener('quote', (ev) => {
+        const msg = JSON.parse(ev.data);
+        (streamTags.get(msg.key) || []).forEach(tag => onStreamQuote(tag, msg));
+    });
+    es.addEventListener('error', () => {
+        if (stream !== es) return;
+        // EventSource сам переподключается (с Last-Event-ID); сдаёмся после серии неудач подряд
+        if (es.readyState === EventSource.CLOSED || ++streamFailures >= 3) fallbackToPolling();
+    });
+}
+
+/** пересобрать подписки (смена фильтров/пар) — с небольшой склейкой частых вызовов */
+function restartStream() {
+    if (streamRestartTimer) clearTimeout(streamRestartTimer);
+    streamRestartTimer = setTimeout(() => { streamRestartTimer = null; if (streamActive()) openStream(); }, 50);
+}
+
+function fallbackToPolling() {
+    streamBroken = true;
+    if (stream) { stream.close(); stream = null; }
+    console.warn('SSE недоступен — переключаемся на опрос');
+    refreshNow(); refreshXENow(); refreshGFNow();
+}
 
 /* ===== глобальные обновления ===== */
 function refreshNow() {
-    loadBinance(); loadBybit();
-    $('ts').textContent = '• обновлено: ' + new Date().toLocaleTimeString('ru-RU');
+    if (streamActive()) {
+        showLoader('binance_loader'); showLoader('bybit_loader'); restartStream();
+        return;
+    }
+    loadBinance(); loadBybit(); stampUpdated();
     if (timer) clearInterval(timer);
-    timer = setInterval(() => {
-        loadBinance(); loadBybit();
-        $('ts').textContent = '• обновлено: ' + new Date().toLocaleTimeString('ru-RU');
-    }, REFRESH_MS);
+    timer = setInterval(() => { loadBinance(); loadBybit(); stampUpdated(); }, REFRESH_MS);
+}
+function refreshXENow() {
+    if (streamActive()) { showLoader('xe_loader'); restartStream(); return; }
+    loadXE(); if (xeTimer) clearInterval(xeTimer); xeTimer = setInterval(loadXE, XE_REFRESH_MS);
 }
-function refreshXENow() { loadXE(); if (xeTimer) clearInterval(xeTimer); xeTimer = setInterval(loadXE, XE_REFRESH_MS); }
 function apply(ev) { ev.preventDefault(); refreshNow(); refreshXENow(); refreshGFNow(); }
 
 /* ===== swap From/To ===== */